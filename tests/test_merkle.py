@@ -0,0 +1,77 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from util.db import DatabaseManager
+from token.merkle import IndexTokens
+
+_SOURCE = '''import os
+
+
+def first(a):
+   return a + 1
+
+
+class Second(object):
+
+   def method(self, b):
+      return [b, b]
+'''
+
+
+class IndexTokensTest(unittest.TestCase):
+
+   def setUp(self):
+      self.root = tempfile.mkdtemp()
+      self.path = os.path.join(self.root, "mod.py")
+      self.db_path = os.path.join(self.root, "index.db")
+      self.Write(_SOURCE)
+      self.db = DatabaseManager(self.db_path)
+
+   def tearDown(self):
+      shutil.rmtree(self.root)
+
+   def Write(self, text):
+      with open(self.path, 'w') as f:
+         f.write(text)
+      # a newer mtime than the stored record
+      mtime = time.time() + (1 if os.path.exists(self.db_path) else 0)
+      os.utime(self.path, (mtime, mtime))
+
+   def Rows(self):
+      with sqlite3.connect(self.db_path) as conn:
+         return dict(conn.execute('''
+            SELECT tid, file_tokens.type || ' ' || lrow || ' ' || lcol || ' ' || name
+            FROM file_tokens
+            JOIN file_hash_mapping ON file_hash_mapping.hid = file_tokens.hid
+         ''').fetchall())
+
+   def Index(self):
+      self.db.UpdateRepository(self.root, ["mod.py"])
+      return IndexTokens(self.db, self.root, workers=1)
+
+   def testEditKeepsUnchangedRows(self):
+      self.assertEqual(self.Index(), 1)
+      old = self.Rows()
+      self.assertTrue(old)
+      # a line above shifts the class, the changed def is rewritten
+      self.Write("# header\n" + _SOURCE.replace("a + 1", "a + 2"))
+      self.assertEqual(self.Index(), 1)
+      new = self.Rows()
+      kept = set(old) & set(new)
+      self.assertTrue(kept)
+      for tid in kept:
+         kind, L, rest = old[tid].split(' ', 2)
+         self.assertEqual(new[tid], f"{kind} {int(L) + 1} {rest}")
+      self.assertIn("2", [row.rsplit(' ', 1)[1] for row in new.values()])
+      # the old content's rows are gone once moved
+      with sqlite3.connect(self.db_path) as conn:
+         self.assertEqual(conn.execute('SELECT COUNT(DISTINCT hid) FROM file_tokens').fetchone()[0], 1)
+         self.assertEqual(conn.execute('SELECT COUNT(*) FROM token_replacements').fetchone()[0], 0)
+
+
+if __name__ == "__main__":
+   unittest.main()
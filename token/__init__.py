@@ -0,0 +1,23 @@
+# Run from the repository root (python -m ...), this package shadows the
+# standard library's `token` module, which `tokenize` and through it
+# logging, inspect, concurrent.futures and asyncio import. Re-export the
+# standard module's names here so both keep working.
+import os as _os
+import sysconfig as _sysconfig
+import importlib.util as _importlib_util
+
+
+def _LoadStdlibToken():
+   path = _os.path.join(_sysconfig.get_paths()["stdlib"], "token.py")
+   if not _os.path.isfile(path):
+      return
+   spec = _importlib_util.spec_from_file_location("_stdlib_token", path)
+   module = _importlib_util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   globals().update(
+      (name, value) for name, value in vars(module).items()
+      if not name.startswith("__") or name == "__all__"
+   )
+
+
+_LoadStdlibToken()
@@ -0,0 +1,368 @@
+from array import array
+from bisect import bisect_right
+
+from .common import Token, TokenType, TokenLang
+
+# no node / absent value
+NONE = -1
+
+# data tags
+DATA_NONE = 0
+DATA_INT = 1
+DATA_DICT = 2
+
+# attr tags of a dict data key
+_ATTR_NONE = 0
+_ATTR_STR = 1
+_ATTR_TOKENS = 2
+_ATTR_TOKEN_LISTS = 3
+
+_TOKEN_TYPES = {t.value: t for t in TokenType}
+_TOKEN_LANGS = {t.value: t for t in TokenLang}
+
+# layout tokens, left out of file_tokens rows
+_LAYOUT_KINDS = (TokenType.SPACE.value, TokenType.BR.value, TokenType.INDENT.value)
+
+# node fields: (name, array typecode), each array indexed by node id
+_FIELDS = (
+   ("kind", 'B'),          # TokenType value
+   ("name", 'i'),          # string id of Token.N
+   ("L", 'i'),
+   ("C", 'i'),
+   ("O", 'i'),
+   ("lang", 'b'),          # TokenLang value or NONE
+   ("langver", 'i'),       # or NONE
+   ("first", 'i'),         # first token index in the extract token list
+   ("last", 'i'),          # last token index covered by the node subtree
+   ("parent", 'i'),        # node id or NONE for top-level nodes
+   ("first_child", 'i'),
+   ("next_sibling", 'i'),
+   ("slot", 'i'),          # string id of the parent data key holding the
+                           # node, NONE for the top level
+   ("group", 'i'),         # list index in a list-of-lists data value
+   ("data_tag", 'B'),
+   ("data", 'q'),          # int data, or for DATA_DICT the attrs index
+)
+
+
+class TokenArena(object):
+   """
+   Decorated tree flattened into parallel arrays, nodes in preorder.
+
+   Nodes are the tokens of the tree: decorated ones (class, def, import...)
+   and the extract tokens below them. Children are linked through
+   first_child / next_sibling and tagged with the data key ("children",
+   "decorator", "path", ...) they sit in; a token listed in two keys (a
+   class base also being one of its children) gets one node per key.
+   Other dict data values (e.g. "name") are kept in the attrs table:
+   for node z with data_tag DATA_DICT, attrs[data[z]] is the key count,
+   followed by (key id, attr tag, value) per key in insertion order.
+
+   Arrays and the string table pickle as plain buffers, and a preorder walk
+   is a range over node ids.
+   """
+
+   def __init__(self):
+      for field, typecode in _FIELDS:
+         setattr(self, field, array(typecode))
+      self.attrs = array('i')
+      self.strings = []
+      self._string_ids = {}
+
+   def __len__(self):
+      return len(self.kind)
+
+   def __getstate__(self):
+      state = dict(self.__dict__)
+      del state["_string_ids"]
+      return state
+
+   def __setstate__(self, state):
+      self.__dict__.update(state)
+      self._string_ids = {s: k for k, s in enumerate(self.strings)}
+
+   def _String(self, s):
+      sid = self._string_ids.get(s, None)
+      if sid is None:
+         sid = self._string_ids[s] = len(self.strings)
+         self.strings.append(s)
+      return sid
+
+   def GetName(self, z):
+      return self.strings[self.name[z]]
+
+   def GetSlot(self, z):
+      slot = self.slot[z]
+      return None if slot == NONE else self.strings[slot]
+
+   def Children(self, z, slot="children"):
+      """Child node ids of z held in data key slot (all keys if None)."""
+      sid = NONE if slot is None else self._string_ids.get(slot, None)
+      if sid is None:
+         return
+      c = self.first_child[z]
+      while c != NONE:
+         if slot is None or self.slot[c] == sid:
+            yield c
+         c = self.next_sibling[c]
+
+   def Roots(self):
+      z = 0 if len(self) else NONE
+      while z != NONE:
+         yield z
+         z = self.next_sibling[z]
+
+   def SubtreeEnd(self, z):
+      """Node id past the subtree of z, whose nodes are z..end-1."""
+      while z != NONE:
+         if self.next_sibling[z] != NONE:
+            return self.next_sibling[z]
+         z = self.parent[z]
+      return len(self)
+
+   def GetAttr(self, z, key, default=None):
+      """Non-list dict data value of node z (e.g. the def/class "name")."""
+      if self.data_tag[z] != DATA_DICT:
+         return default
+      p = self.data[z]
+      for k in range(self.attrs[p]):
+         kid, tag, value = self.attrs[p+1+3*k:p+4+3*k]
+         if self.strings[kid] != key:
+            continue
+         if tag == _ATTR_STR:
+            return self.strings[value]
+         if tag == _ATTR_NONE:
+            return None
+         return default
+      return default
+
+   def _AddNode(self, t, first, parent, slot, group):
+      z = len(self.kind)
+      self.kind.append(t.T.value)
+      self.name.append(self._String(t.N))
+      self.L.append(t.L)
+      self.C.append(t.C)
+      self.O.append(t.O)
+      self.lang.append(NONE if t.lang is None else t.lang.value)
+      self.langver.append(NONE if t.langver is None else t.langver)
+      self.first.append(first)
+      self.last.append(first)
+      self.parent.append(parent)
+      self.first_child.append(NONE)
+      self.next_sibling.append(NONE)
+      self.slot.append(slot)
+      self.group.append(group)
+      data = t.data
+      if data is None:
+         self.data_tag.append(DATA_NONE)
+         self.data.append(0)
+      elif type(data) == int:
+         self.data_tag.append(DATA_INT)
+         self.data.append(data)
+      elif type(data) == dict:
+         self.data_tag.append(DATA_DICT)
+         self.data.append(len(self.attrs))
+      else:
+         raise ValueError(f"Unsupported token data: {type(data).__name__}")
+      return z
+
+   def FileTokenRows(self, hid, base_tid, tids=None):
+      """
+      file_tokens rows (tid, pid, type, lrow, lcol, hid, name, langid,
+      langv) of the non-layout nodes, node z getting tid base_tid + z.
+
+      Args:
+         tids: tid of each node instead; a node with tid -t is already
+               stored as row t and left out
+      """
+      for z in range(len(self)):
+         if self.kind[z] in _LAYOUT_KINDS:
+            continue
+         parent = self.parent[z]
+         if tids is None:
+            tid = base_tid + z
+            pid = None if parent == NONE else base_tid + parent
+         else:
+            tid = tids[z]
+            if tid < 0:
+               continue
+            pid = None if parent == NONE else abs(tids[parent])
+         lang = self.lang[z]
+         langver = self.langver[z]
+         yield (
+            tid,
+            pid,
+            self.kind[z],
+            self.L[z],
+            self.C[z],
+            hid,
+            self.strings[self.name[z]],
+            TokenLang.NONE.value if lang == NONE else lang,
+            None if langver == NONE else langver,
+         )
+
+   def MatchFileTokenRows(self, rows):
+      """
+      tid of each node from its stored file_tokens rows (tid, pid, type,
+      lrow, lcol, name): 0 for layout nodes, NONE for nodes whose row is
+      not found. Rows match by parent and content, the parent first.
+      """
+      rows_of = {}
+      for tid, pid, kind, L, C, name in rows:
+         rows_of.setdefault((pid, kind, L, C, name), []).append(tid)
+      tids = array('q', [NONE]) * len(self)
+      for z in range(len(self)):
+         if self.kind[z] in _LAYOUT_KINDS:
+            tids[z] = 0
+            continue
+         parent = self.parent[z]
+         if parent == NONE:
+            pid = None
+         else:
+            pid = tids[parent]
+            if pid == NONE:
+               continue
+         # a token in two data keys has two identical rows: any will do
+         found = rows_of.get((pid, self.kind[z], self.L[z], self.C[z], self.strings[self.name[z]]), None)
+         if found:
+            tids[z] = found.pop()
+      return tids
+
+   def ToTree(self, tokens=None):
+      """
+      Compatibility adapter: the Decorate() output this arena was built
+      from, nested Token objects with data dicts.
+
+      Args:
+         tokens: extract token list given to FromTree, reused for the leaf
+                 tokens so they keep their identity; leaves are rebuilt
+                 from the arena without it
+      """
+      n = len(self)
+      leaves = {}
+      out = [None] * n
+      for z in range(n):
+         if self.data_tag[z] != DATA_DICT:
+            t = leaves.get(self.O[z], None)
+            if t is None:
+               first = self.first[z]
+               if (
+                  tokens is not None and
+                  tokens[first].O == self.O[z] and
+                  tokens[first].N == self.strings[self.name[z]]
+               ):
+                  t = tokens[first]
+               else:
+                  t = self._NewToken(z)
+               leaves[self.O[z]] = t
+            out[z] = t
+         else:
+            out[z] = self._NewToken(z)
+
+      # dict data: keys in order, lists filled from the children
+      for z in range(n):
+         if self.data_tag[z] != DATA_DICT:
+            continue
+         data = {}
+         p = self.data[z]
+         for k in range(self.attrs[p]):
+            kid, tag, value = self.attrs[p+1+3*k:p+4+3*k]
+            key = self.strings[kid]
+            if tag == _ATTR_NONE:
+               data[key] = None
+            elif tag == _ATTR_STR:
+               data[key] = self.strings[value]
+            elif tag == _ATTR_TOKENS:
+               data[key] = []
+            else:
+               data[key] = [[] for _ in range(value)]
+         out[z].data = data
+         c = self.first_child[z]
+         while c != NONE:
+            value = data[self.strings[self.slot[c]]]
+            if self.group[c] != NONE:
+               value = value[self.group[c]]
+            value.append(out[c])
+            c = self.next_sibling[c]
+      return [out[z] for z in self.Roots()]
+
+   def _NewToken(self, z):
+      lang = self.lang[z]
+      langver = self.langver[z]
+      tag = self.data_tag[z]
+      return Token(
+         self.strings[self.name[z]],
+         _TOKEN_TYPES[self.kind[z]],
+         self.L[z],
+         self.C[z],
+         None if lang == NONE else _TOKEN_LANGS[lang],
+         None if langver == NONE else langver,
+         self.data[z] if tag == DATA_INT else None,
+         self.O[z],
+      )
+
+   @classmethod
+   def FromTree(cls, tokens, tree):
+      """
+      Flatten a decorated tree.
+
+      Args:
+         tokens: extract token list the tree was decorated from
+         tree: Decorate(tokens)
+      """
+      arena = cls()
+      offsets = array('q', (t.O for t in tokens))
+      index = {id(t): z for z, t in enumerate(tokens)}
+      def _First(t):
+         z = index.get(id(t), None)
+         if z is None:
+            # decorated or made up token: the one of the text it starts in
+            z = max(bisect_right(offsets, t.O) - 1, 0)
+         return z
+
+      children_id = arena._String("children")
+      # (token, parent node, slot, group); pushing child lists reversed
+      # keeps the nodes in preorder
+      stack = [(t, NONE, NONE, NONE) for t in reversed(tree)]
+      last_child = {NONE: NONE}
+      while stack:
+         t, parent, slot, group = stack.pop()
+         z = arena._AddNode(t, _First(t), parent, slot, group)
+         prev = last_child.get(parent, NONE)
+         if prev == NONE:
+            if parent != NONE:
+               arena.first_child[parent] = z
+         else:
+            arena.next_sibling[prev] = z
+         last_child[parent] = z
+         if type(t.data) != dict:
+            continue
+
+         attrs = arena.attrs
+         attrs.append(len(t.data))
+         items = []
+         for key, value in t.data.items():
+            kid = children_id if key == "children" else arena._String(key)
+            if value is None:
+               attrs.extend((kid, _ATTR_NONE, 0))
+            elif type(value) == str:
+               attrs.extend((kid, _ATTR_STR, arena._String(value)))
+            elif isinstance(value, list) and value and isinstance(value[0], list):
+               attrs.extend((kid, _ATTR_TOKEN_LISTS, len(value)))
+               for g, sub in enumerate(value):
+                  items.extend((x, z, kid, g) for x in sub)
+            elif isinstance(value, list):
+               attrs.extend((kid, _ATTR_TOKENS, 0))
+               items.extend((x, z, kid, NONE) for x in value)
+            else:
+               raise ValueError(f"Unsupported token data: {key}={type(value).__name__}")
+         stack.extend(reversed(items))
+
+      # subtree spans, children after their parent in preorder
+      last = arena.last
+      parents = arena.parent
+      for z in range(len(arena)-1, -1, -1):
+         p = parents[z]
+         if p != NONE and last[z] > last[p]:
+            last[p] = last[z]
+      return arena
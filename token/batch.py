@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from util.sysfs import ReadText
+from util.filetype import ClassifyFile, TEXT
+
+from .cache import GetCache
+from .lang import GetLanguage
+from .pack import PackTokens, UnpackTokens
+
+# tasks queued per worker, to keep workers busy without submitting every
+# path of a large repository up front
+_QUEUE_PER_WORKER = 4
+
+
+def _TokenizeFile(path, cache_path=None):
+   language = GetLanguage(path)
+   if language is None:
+      return None
+   try:
+      if ClassifyFile(path) != TEXT:
+         return None
+      text = ReadText(path)
+   except (OSError, UnicodeDecodeError):
+      return None
+   if cache_path is not None:
+      return GetCache(cache_path).GetPacked(text, language)
+   return PackTokens(language.Decorate(language.Lex(text)))
+
+
+def TokenizeFiles(paths, workers=None, packed=False, cache_path=None):
+   """
+   Tokenize and decorate files in a process pool.
+
+   Workers send results back as PackTokens buffers rather than pickled
+   Token objects; results are yielded as soon as a file is done, so not in
+   the order of paths.
+
+   Args:
+      paths: File paths to tokenize
+      workers: Number of worker processes (default: os.cpu_count())
+      packed: Yield the packed buffers instead of unpacking them
+      cache_path: ParseCache file shared by the workers (see
+                  cache.CachePathForDatabase), None to always parse
+
+   Yields:
+      (path, tokens): tokens is None if the file is not in a supported
+         language, is not text (util.filetype: binary or generated) or
+         cannot be read as text
+   """
+   workers = workers or os.cpu_count() or 1
+   paths = iter(paths)
+   with ProcessPoolExecutor(max_workers=workers) as executor:
+      pending = {}
+      def _Submit():
+         for path in paths:
+            pending[executor.submit(_TokenizeFile, path, cache_path)] = path
+            if len(pending) >= workers * _QUEUE_PER_WORKER:
+               break
+      _Submit()
+      while pending:
+         done, _ = wait(pending, return_when=FIRST_COMPLETED)
+         for future in done:
+            path = pending.pop(future)
+            buf = future.result()
+            if buf is None or packed:
+               yield path, buf
+            else:
+               yield path, UnpackTokens(buf)
+         _Submit()
@@ -0,0 +1,97 @@
+"""
+Decorate benchmark: the iterative TokenDecorate against the recursive
+engine it replaced, on real files and on generated deeply nested code.
+
+   python -m token.bench [file.py ...]
+"""
+import os
+import sys
+import time
+from types import GeneratorType
+
+from .decorate import TokenDecorate, TokenDecorateEnv, _EnterScope
+from .python import Lex, decorate_map_root
+
+
+def _TokenDecorateRecursive(env, i=0, j=-1):
+   # the engine before TokenDecorate kept its own stack: one python call
+   # per nested scope, driving generator handlers recursively
+   scope, j = _EnterScope(env, i, j)
+   while env.HasNext() and env.i <= j:
+      token = env.GetToken(env.i)
+      decorate_map = env.GetDecorateMap()
+      matched = False
+      if token.N in decorate_map:
+         for fn in decorate_map[token.N]:
+            ret = fn(env, scope)
+            if type(ret) == GeneratorType:
+               try:
+                  request = next(ret)
+                  while True:
+                     request = ret.send(_TokenDecorateRecursive(env, *request))
+               except StopIteration as e:
+                  ret = e.value
+            if ret:
+               matched = True
+      if not matched:
+         env.decorate_default_fn(env, scope)
+   env.scope_stack.pop()
+   return scope
+
+
+def _Time(fn, tokens, repeat):
+   best = None
+   for _ in range(repeat):
+      env = TokenDecorateEnv(tokens, decorate_map_root)
+      t0 = time.perf_counter()
+      fn(env)
+      t = time.perf_counter() - t0
+      best = t if best is None else min(best, t)
+   return best
+
+
+def BenchFiles(paths, repeat=3):
+   """Best-of-repeat decorate time of both engines over files."""
+   iterative = 0.0
+   recursive = 0.0
+   for path in paths:
+      with open(path, 'r') as f:
+         tokens = Lex(f.read())
+      iterative += _Time(lambda env: TokenDecorate(env), tokens, repeat)
+      recursive += _Time(lambda env: _TokenDecorateRecursive(env), tokens, repeat)
+   return iterative, recursive
+
+
+def NestedCode(depth):
+   """depth nested if blocks, one space of indent per level."""
+   lines = []
+   for d in range(depth):
+      lines.append(' ' * d + 'if a:\n')
+      lines.append(' ' * (d+1) + 'x = f(1, 2)\n')
+   return ''.join(lines)
+
+
+def BenchDepth(depth):
+   """
+   Returns:
+      (iterative seconds, recursive seconds or None on RecursionError)
+   """
+   tokens = Lex(NestedCode(depth))
+   iterative = _Time(lambda env: TokenDecorate(env), tokens, 1)
+   try:
+      recursive = _Time(lambda env: _TokenDecorateRecursive(env), tokens, 1)
+   except RecursionError:
+      recursive = None
+   return iterative, recursive
+
+
+if __name__ == "__main__":
+   paths = sys.argv[1:] or [os.path.join(os.path.dirname(__file__), '..', 'samples', 'python.py')]
+   iterative, recursive = BenchFiles(paths)
+   print(f'files: {len(paths)}')
+   print(f'  iterative {iterative*1000:.1f}ms  recursive {recursive*1000:.1f}ms  ({recursive/iterative:.2f}x)')
+   print(f'nesting (recursion limit {sys.getrecursionlimit()}):')
+   for depth in (100, 1000, 5000):
+      iterative, recursive = BenchDepth(depth)
+      recursive = 'RecursionError' if recursive is None else f'{recursive*1000:.1f}ms'
+      print(f'  depth {depth}: iterative {iterative*1000:.1f}ms  recursive {recursive}')
@@ -0,0 +1,217 @@
+"""
+Parse cache: decorated token trees keyed by (content hash, tokenizer
+version), as PackTokens buffers in a size-bounded in-memory LRU backed by
+an SQLite file of zlib-compressed buffers.
+
+The tokenizer version hashes the sources of the language module and of
+the lexer/extract/decorate/pack modules, so editing a rule table stops the
+entries made with the old one from being used. Several checkouts on
+different versions may share a cache file: each open records when its
+versions were last used, and only the entries of versions unused for
+_STALE_SECONDS are dropped. New entries are written _COMMIT_EVERY at a
+time, and on Close (at process exit for the cache of GetCache).
+"""
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+
+from .pack import PackTokens, UnpackTokens
+
+# modules whose source is part of every tokenizer version
+_ENGINE_MODULES = ("common", "extract", "decorate", "lexer", "merkle", "pack")
+
+# age after which the entries of an unused tokenizer version are dropped
+_STALE_SECONDS = 30 * 24 * 3600
+
+# parsed trees written to the cache file per transaction
+_COMMIT_EVERY = 64
+
+_versions = {}
+
+# ParseCache of this process, see GetCache
+_cache = None
+
+
+def TokenizerVersion(language):
+   """Hex digest of the sources producing the trees of a language module."""
+   version = _versions.get(language.__name__, None)
+   if version is not None:
+      return version
+   h = hashlib.sha256()
+   folder = os.path.dirname(os.path.abspath(__file__))
+   paths = [os.path.join(folder, name + ".py") for name in _ENGINE_MODULES]
+   paths.append(language.__file__)
+   for path in paths:
+      h.update(os.path.basename(path).encode())
+      try:
+         with open(path, 'rb') as f:
+            h.update(f.read())
+      except OSError:
+         pass
+   version = _versions[language.__name__] = h.hexdigest()[:16]
+   return version
+
+
+def ContentHash(text: str) -> bytes:
+   return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).digest()
+
+
+def CachePathForDatabase(db_path):
+   """On-disk cache file kept next to an index database."""
+   return os.path.splitext(db_path)[0] + ".parsecache"
+
+
+def GetCache(cache_path):
+   """
+   ParseCache of this process for cache_path, opened on first use; lets
+   pool workers share one connection across their tasks. It is closed,
+   its pending entries written, when the process exits (pool workers
+   included, which skip atexit).
+   """
+   global _cache
+   if _cache is None or _cache.path != cache_path:
+      if _cache is not None:
+         _cache.Close()
+      _cache = ParseCache(cache_path)
+      Finalize(_cache, _cache.Close, exitpriority=0)
+   return _cache
+
+
+class ParseCache(object):
+   """
+   Args:
+      path: SQLite file of the on-disk tier, None for memory only
+      max_bytes: bound of the packed buffers kept in memory
+   """
+
+   def __init__(self, path=None, max_bytes=64 << 20):
+      self.path = path
+      self.max_bytes = max_bytes
+      self.lru = OrderedDict()
+      self.lru_bytes = 0
+      self.hits = 0
+      self.misses = 0
+      self.conn = None
+      # (hash, lang, version, compressed buffer) rows not written yet
+      self.pending = []
+      # (lang, version) -> when it was last marked used and its stale
+      # peers dropped
+      self.checked = {}
+
+   def _Connect(self):
+      if self.conn is None and self.path is not None:
+         self.conn = sqlite3.connect(self.path, timeout=60)
+         self.conn.execute('PRAGMA journal_mode=WAL')
+         self.conn.execute('PRAGMA synchronous=NORMAL')
+         self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS parse_trees (
+               hash BLOB NOT NULL,
+               lang TEXT NOT NULL,
+               version TEXT NOT NULL,
+               buf BLOB NOT NULL,
+               PRIMARY KEY (hash, lang, version)
+            )
+         ''')
+         self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS parse_versions (
+               lang TEXT NOT NULL,
+               version TEXT NOT NULL,
+               used REAL NOT NULL,
+               PRIMARY KEY (lang, version)
+            )
+         ''')
+         self.conn.commit()
+      return self.conn
+
+   def _DropStale(self, conn, lang, version):
+      now = time.time()
+      # re-marked now and then so a long-lived process keeps its entries
+      if now - self.checked.get((lang, version), 0) < 3600:
+         return
+      self.checked[(lang, version)] = now
+      conn.execute(
+         'INSERT OR REPLACE INTO parse_versions (lang, version, used) VALUES (?, ?, ?)',
+         (lang, version, now),
+      )
+      stale = [
+         row[0] for row in conn.execute(
+            'SELECT version FROM parse_versions WHERE lang = ? AND used < ?',
+            (lang, now - _STALE_SECONDS),
+         )
+      ]
+      for old in stale:
+         conn.execute('DELETE FROM parse_trees WHERE lang = ? AND version = ?', (lang, old))
+         conn.execute('DELETE FROM parse_versions WHERE lang = ? AND version = ?', (lang, old))
+      conn.commit()
+
+   def _Remember(self, key, buf):
+      lru = self.lru
+      if key in lru:
+         lru.move_to_end(key)
+         return
+      lru[key] = buf
+      self.lru_bytes += len(buf)
+      while self.lru_bytes > self.max_bytes and lru:
+         _, old = lru.popitem(last=False)
+         self.lru_bytes -= len(old)
+
+   def GetPacked(self, text, language):
+      """
+      PackTokens buffer of language.Decorate(language.Lex(text)), from the
+      cache when the same content was parsed by the same tokenizer.
+      """
+      lang = language.__name__.rpartition('.')[2]
+      version = TokenizerVersion(language)
+      content_hash = ContentHash(text)
+      key = (content_hash, lang, version)
+      buf = self.lru.get(key, None)
+      if buf is not None:
+         self.lru.move_to_end(key)
+         self.hits += 1
+         return buf
+
+      conn = self._Connect()
+      if conn is not None:
+         self._DropStale(conn, lang, version)
+         row = conn.execute(
+            'SELECT buf FROM parse_trees WHERE hash = ? AND lang = ? AND version = ?',
+            (content_hash, lang, version),
+         ).fetchone()
+         if row is not None:
+            buf = zlib.decompress(row[0])
+            self._Remember(key, buf)
+            self.hits += 1
+            return buf
+
+      self.misses += 1
+      buf = PackTokens(language.Decorate(language.Lex(text)))
+      self._Remember(key, buf)
+      if conn is not None:
+         self.pending.append((content_hash, lang, version, zlib.compress(buf, 1)))
+         if len(self.pending) >= _COMMIT_EVERY:
+            self.Flush()
+      return buf
+
+   def Parse(self, text, language):
+      """Decorated tokens of text; a fresh tree on every call."""
+      return UnpackTokens(self.GetPacked(text, language))
+
+   def Flush(self):
+      """Write the entries parsed since the last Flush in one transaction."""
+      if self.pending and self.conn is not None:
+         self.conn.executemany(
+            'INSERT OR REPLACE INTO parse_trees (hash, lang, version, buf) VALUES (?, ?, ?, ?)',
+            self.pending,
+         )
+         self.conn.commit()
+      del self.pending[:]
+
+   def Close(self):
+      self.Flush()
+      if self.conn is not None:
+         self.conn.close()
+         self.conn = None
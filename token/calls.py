@@ -0,0 +1,374 @@
+"""
+Call sites of a decorated python tree: a name or dotted name followed by
+'(', attributed to the def/class (or module) whose body holds it, and
+resolved within the file against local def/class names, class members
+(self.m / cls.m, then the class bases) and the names imports bind.
+
+IndexCalls stores them for the files whose content changed, and carries
+the resolution across modules through the stored symbol and import
+indexes (IndexResolver): names re-exported by a package and members
+inherited from classes of other modules. The targets of the other files
+are resolved again from their stored local targets, so a change in the
+modules they call into is followed without parsing them.
+"""
+import os
+from keyword import kwlist
+from concurrent.futures import ProcessPoolExecutor
+
+from util.instrument import Stage
+from util.filetype import TEXT
+
+from .common import TokenType
+from .symbols import ExtractSymbols, IsPythonFile, ModuleNames, ParseFile
+from .imports import ImportBindings
+
+_LAYOUT_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+   TokenType.COMMENT,
+)
+
+_KEYWORDS = frozenset(kwlist)
+
+# names a method gets its class or instance through
+_SELF_NAMES = ("self", "cls")
+
+# files parsed per worker task
+_CHUNK_SIZE = 64
+
+
+class CallSite(object):
+   """
+   Args:
+      caller: qualified name of the def/class or module making the call
+      callee: called name as written ("f", "self.m", "os.path.join");
+              ".m" for a method of an expression ("x().m", "''.join")
+      L, C: position of the callee name
+      target: qualified name the callee resolves to, None if unknown
+              (builtins, expressions, names of unindexed scopes)
+
+   local is the target as resolved within the file, kept when IndexCalls
+   resolves target across modules.
+   """
+
+   def __init__(self, caller, callee, L, C, target=None):
+      self.caller = caller
+      self.callee = callee
+      self.L = L
+      self.C = C
+      self.target = target
+      self.local = target
+
+   def __repr__(self):
+      return f'({self.caller}->{self.callee},#{self.L}-#{self.C})'
+
+
+def _IsName(t):
+   return t.T == TokenType.SYM and t.N.isidentifier() and t.N not in _KEYWORDS
+
+
+def _Callee(tokens, k, start):
+   # dotted name ending right before the '(' at k, from tokens[start:]:
+   # (name, first token)
+   j = k - 1
+   while j >= start and tokens[j].T in _LAYOUT_TYPES:
+      j -= 1
+   if j < start or not _IsName(tokens[j]):
+      return None, None
+   parts = [tokens[j].N]
+   while j >= 2 and tokens[j-1].N == '.' and _IsName(tokens[j-2]):
+      j -= 2
+      parts.append(tokens[j].N)
+   parts.reverse()
+   if j >= 1 and tokens[j-1].N == '.':
+      return '.' + '.'.join(parts), tokens[j]
+   return '.'.join(parts), tokens[j]
+
+
+class _Resolver(object):
+
+   def __init__(self, symbols, bindings, module):
+      self.symbols = {s.qualname: s for s in symbols}
+      self.bindings = bindings
+      self.module = module
+
+   def _Qualify(self, container, name):
+      return f"{container}.{name}" if container else name
+
+   def Name(self, name, scope):
+      """Qualified name of a plain name used in scope, or None."""
+      # the scope itself, then the enclosing functions: class bodies are
+      # not visible from the functions inside them
+      first = True
+      while scope != self.module:
+         symbol = self.symbols.get(scope, None)
+         if symbol is None:
+            break
+         if first or symbol.kind == TokenType.FUNC:
+            qualname = self._Qualify(scope, name)
+            if qualname in self.symbols:
+               return qualname
+         first = False
+         scope = symbol.container
+      qualname = self._Qualify(self.module, name)
+      if qualname in self.symbols:
+         return qualname
+      return self.bindings.get(name, None)
+
+   def Member(self, klass, name):
+      """Qualified name of attribute name of a class, through its bases."""
+      seen = set()
+      stack = [klass]
+      fallback = None
+      while stack:
+         klass = stack.pop(0)
+         if klass in seen:
+            continue
+         seen.add(klass)
+         qualname = f"{klass}.{name}"
+         symbol = self.symbols.get(klass, None)
+         if qualname in self.symbols:
+            return qualname
+         if symbol is None:
+            # a class of another module: the first one is the best guess
+            if fallback is None:
+               fallback = qualname
+            continue
+         for base in symbol.bases:
+            if not base.replace('.', '').isidentifier():
+               continue
+            head, _, rest = base.partition('.')
+            resolved = self.Name(head, symbol.container)
+            if resolved is not None:
+               stack.append(resolved + ('.' + rest if rest else ''))
+      return fallback
+
+   def Callee(self, callee, caller):
+      if callee.startswith('.'):
+         return None
+      head, _, rest = callee.partition('.')
+      symbol = self.symbols.get(caller, None)
+      if head in _SELF_NAMES and rest and '.' not in rest and symbol is not None:
+         klass = self.symbols.get(symbol.container, None)
+         if symbol.kind == TokenType.FUNC and klass is not None and klass.kind == TokenType.KLASS:
+            return self.Member(klass.qualname, rest)
+      resolved = self.Name(head, caller)
+      if resolved is None:
+         return None
+      if not rest:
+         return resolved
+      if resolved in self.symbols and self.symbols[resolved].kind == TokenType.KLASS and '.' not in rest:
+         return self.Member(resolved, rest)
+      return f"{resolved}.{rest}"
+
+
+def _DecoratorCalls(t, caller, resolver, out):
+   # "@a.b(...)" calls a.b in the scope holding the def/class, then the
+   # calls of its arguments
+   param = t.data.get("param", None)
+   if param is None:
+      return
+   path = [x for x in t.data["path"] if x.T not in _LAYOUT_TYPES]
+   if path and all(_IsName(x) or x.N == '.' for x in path):
+      callee = ''.join(x.N for x in path)
+      out.append(CallSite(caller, callee, path[0].L, path[0].C, resolver.Callee(callee, caller)))
+   for k, x in enumerate(param):
+      if x.N == '(':
+         callee, first = _Callee(param, k, 0)
+         if callee is not None:
+            out.append(CallSite(caller, callee, first.L, first.C, resolver.Callee(callee, caller)))
+
+
+def ExtractCalls(tree, module="", is_package=False):
+   """
+   Call sites of a decorated python tree in source order per scope;
+   decorators with arguments ("@app.route(...)") are calls of the scope
+   holding the decorated def/class.
+
+   Args:
+      module: dotted module name (see symbols.ModuleName)
+      is_package: the module is a package __init__, for relative imports
+   """
+   resolver = _Resolver(ExtractSymbols(tree, module), ImportBindings(module, is_package, tree), module)
+   out = []
+   # (tokens, next index, caller, first index of the scope body)
+   stack = [(tree, 0, module, 0)]
+   while stack:
+      tokens, k, caller, start = stack.pop()
+      n = len(tokens)
+      while k < n:
+         t = tokens[k]
+         k += 1
+         data = t.data
+         if type(data) == dict:
+            children = data.get("children", None)
+            if children is None:
+               if t.N == '@' and "path" in data:
+                  _DecoratorCalls(t, caller, resolver, out)
+               continue
+            for d in data.get("decorator", None) or ():
+               _DecoratorCalls(d, caller, resolver, out)
+            stack.append((tokens, k, caller, start))
+            name = data.get("name", None)
+            if name is not None and t.N in ("def", "class"):
+               qualname = f"{caller}.{name}" if caller else name
+               # past the def/class name, not a callee
+               k = 0
+               while k < len(children) and children[k].T in _LAYOUT_TYPES:
+                  k += 1
+               stack.append((children, k + 1, qualname, k + 1))
+            else:
+               stack.append((children, 0, caller, 0))
+            break
+         if t.N != '(':
+            continue
+         callee, first = _Callee(tokens, k - 1, start)
+         if callee is not None:
+            out.append(CallSite(caller, callee, first.L, first.C, resolver.Callee(callee, caller)))
+   return out
+
+
+class IndexResolver(object):
+   """
+   Call targets resolved across modules through the stored indexes of a
+   DatabaseManager (IndexSymbols and IndexImports output): a target
+   ExtractCalls left as a guess is followed through the names a module
+   imports ("from .sub import X" in pkg/__init__.py makes pkg.X
+   pkg.sub.X) and through the bases of the classes it names.
+   """
+
+   def __init__(self, db):
+      rows, bases = db.GetSymbolTable()
+      self.modules = db.GetModules()
+      module_of = {path: module for module, path in self.modules.items()}
+      # qualname -> (kind, module)
+      self.symbols = {}
+      names = {}
+      for sid, filepath, qualname, kind, _, _, _, _ in rows:
+         names[sid] = qualname
+         self.symbols.setdefault(qualname, (kind, module_of.get(filepath, None)))
+      self.bases = {}
+      for sid, base in bases:
+         self.bases.setdefault(names[sid], []).append(base)
+      # module -> {name: target} of its from-imports
+      self.imported = {}
+      for src, target, fallback in db.GetImportTargets():
+         module = module_of.get(src, None)
+         if module is not None and fallback is not None:
+            self.imported.setdefault(module, {}).setdefault(target.rpartition('.')[2], target)
+      self.resolved = {}
+
+   def _Known(self, name):
+      return name in self.symbols or name in self.modules
+
+   def _Base(self, klass, base):
+      # qualified name of a class base as written in the module of klass
+      if not base.replace('.', '').isidentifier():
+         return None
+      module = self.symbols[klass][1]
+      head, _, rest = base.partition('.')
+      if module is not None and f"{module}.{head}" in self.symbols:
+         head = f"{module}.{head}"
+      elif head in self.imported.get(module, ()):
+         head = self.imported[module][head]
+      elif head not in self.modules:
+         return None
+      return head + ('.' + rest if rest else '')
+
+   def _Resolve(self, name):
+      if self._Known(name):
+         return name
+      if name in self.resolved:
+         return self.resolved[name]
+      # a cycle of imports or bases ends unresolved
+      self.resolved[name] = None
+      container, _, last = name.rpartition('.')
+      container = container and self._Resolve(container)
+      out = None
+      if container:
+         qualname = f"{container}.{last}"
+         if self._Known(qualname):
+            out = qualname
+         elif container in self.modules:
+            target = self.imported.get(container, {}).get(last, None)
+            if target is not None:
+               out = self._Resolve(target)
+         elif self.symbols[container][0] == TokenType.KLASS.value:
+            for base in self.bases.get(container, ()):
+               base = self._Base(container, base)
+               out = base and self._Resolve(f"{base}.{last}")
+               if out:
+                  break
+      self.resolved[name] = out
+      return out
+
+   def Resolve(self, target):
+      """Indexed qualified name of a call target, or target itself."""
+      if target is None:
+         return None
+      return self._Resolve(target) or target
+
+
+def _FileCalls(task):
+   full_path, module, is_package, cache_path = task
+   tree = ParseFile(full_path, cache_path)
+   if tree is None:
+      return []
+   with Stage("extract", full_path):
+      return ExtractCalls(tree, module, is_package)
+
+
+def IndexCalls(db, root_path, workers=None, cache_path=None, force=False):
+   """
+   Bring the stored call sites of a DatabaseManager up to date with its
+   python files; run after IndexSymbols and IndexImports, whose indexes
+   resolve the callees across modules (IndexResolver).
+
+   Args:
+      workers: worker processes parsing the stale files (default:
+               os.cpu_count(), 1 parses in this process)
+      cache_path: ParseCache file of the workers, None to always parse
+      force: extract the calls of every file again; not needed to follow
+             changes of other modules, the stored targets of unchanged
+             files are resolved again on every run
+
+   Returns:
+      list: files whose call sites were extracted
+   """
+   hashes = {path: hid for path, hid in db.GetFileHashes(TEXT).items() if IsPythonFile(path)}
+   names = ModuleNames(hashes)
+   known = db.GetCallSources()
+   stale = [path for path, hid in hashes.items() if force or known.get(path, None) != hid]
+   tasks = [
+      (
+         os.path.join(root_path, path),
+         names[path],
+         os.path.splitext(os.path.basename(path))[0] == "__init__",
+         cache_path,
+      )
+      for path in stale
+   ]
+   resolver = IndexResolver(db)
+   def _Entries(results):
+      for path, calls in zip(stale, results):
+         with Stage("resolve", path):
+            for call in calls:
+               call.target = resolver.Resolve(call.target)
+         yield path, hashes[path], calls
+
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      db.UpdateFileCalls(_Entries(map(_FileCalls, tasks)))
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         db.UpdateFileCalls(_Entries(executor.map(_FileCalls, tasks, chunksize=_CHUNK_SIZE)))
+
+   # stored targets whose resolution changed with the modules they name
+   with Stage("retarget"):
+      db.UpdateCallTargets([
+         (local, resolver.Resolve(local))
+         for local, target in db.GetCallTargets()
+         if resolver.Resolve(local) != target
+      ])
+   return stale
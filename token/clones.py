@@ -0,0 +1,252 @@
+"""
+Clone detection by winnowing.
+
+Token streams are normalised (identifiers, numbers and strings become
+placeholders, layout and comments are dropped) so renamed copies look the
+same, hashed as k-grams, and winnowed: the minimum hash of every window of
+w consecutive k-grams is kept, which guarantees that any shared run of at
+least w+k-1 normalised tokens shares a fingerprint. Fingerprints are kept
+per function and per file content in an indexed table, and clone pairs
+come out of one self-join on the fingerprint instead of comparing units
+pairwise.
+"""
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from util.instrument import Stage
+from util.budget import BoundedMap, FileCost
+from util.sysfs import ReadText
+from util.filetype import TEXT
+
+from .common import TokenType
+from .lang import GetLanguage
+
+# k-gram length in normalised tokens and winnowing window in k-grams
+K = 10
+W = 6
+
+_MOD = (1 << 61) - 1
+_BASE = 1000003
+
+_SKIP_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+   TokenType.COMMENT,
+)
+
+# placeholders
+_IDENTIFIER = zlib.crc32(b'$id')
+_NUMBER = zlib.crc32(b'$num')
+_STRING = zlib.crc32(b'$str')
+
+# files fingerprinted per worker task
+_CHUNK_SIZE = 64
+
+_ids = {}
+
+
+def _Id(t, keywords):
+   # stable id of a normalised token
+   N = t.N
+   if t.T == TokenType.STRING:
+      return _STRING
+   if t.T == TokenType.SYM and N not in keywords:
+      if N[0].isdigit():
+         return _NUMBER
+      if N.isidentifier():
+         return _IDENTIFIER
+   i = _ids.get(N, None)
+   if i is None:
+      i = _ids[N] = zlib.crc32(N.encode('utf-8', 'surrogatepass'))
+   return i
+
+
+def NormalizeTokens(tokens, keywords=()):
+   """Normalised token ids of an extract token list."""
+   return [_Id(t, keywords) for t in tokens if t.T not in _SKIP_TYPES]
+
+
+def _Leaves(t):
+   # tokens of a decorated subtree in order: a decorated node stands for
+   # its keyword, followed by its children
+   out = []
+   stack = [iter([t])]
+   while stack:
+      x = next(stack[-1], None)
+      if x is None:
+         stack.pop()
+         continue
+      out.append(x)
+      if type(x.data) == dict and "children" in x.data:
+         stack.append(iter(x.data["children"]))
+   return out
+
+
+def Fingerprints(ids, k=K, w=W):
+   """Winnowed k-gram hashes of normalised token ids, as a set."""
+   n = len(ids) - k + 1
+   if n <= 0:
+      return set()
+   top = pow(_BASE, k - 1, _MOD)
+   h = 0
+   for x in ids[:k]:
+      h = (h * _BASE + x) % _MOD
+   hashes = [h]
+   for i in range(k, len(ids)):
+      h = ((h - ids[i-k] * top) * _BASE + ids[i]) % _MOD
+      hashes.append(h)
+   if n <= w:
+      return {min(hashes)}
+   # rightmost minimum of each window, through a monotonic deque
+   out = set()
+   window = deque()
+   for i, h in enumerate(hashes):
+      while window and hashes[window[-1]] >= h:
+         window.pop()
+      window.append(i)
+      if window[0] <= i - w:
+         window.popleft()
+      if i >= w - 1:
+         out.add(hashes[window[0]])
+   return out
+
+
+def CloneUnits(tokens, tree, keywords=(), k=K, w=W):
+   """
+   Fingerprinted units of a file: the file itself ("") and each def
+   (qualified name in the file) long enough to be fingerprinted.
+
+   Args:
+      tokens: Lex() output
+      tree: Decorate(tokens), None for the file unit only
+
+   Returns:
+      list: (name, L, fingerprints)
+   """
+   out = []
+   fingerprints = Fingerprints(NormalizeTokens(tokens, keywords), k, w)
+   if fingerprints:
+      out.append(("", 0, fingerprints))
+   # (child iterator, enclosing qualified name)
+   stack = [(iter(tree or ()), "")]
+   while stack:
+      t = next(stack[-1][0], None)
+      if t is None:
+         stack.pop()
+         continue
+      data = t.data
+      if type(data) != dict or "children" not in data:
+         continue
+      qualname = stack[-1][1]
+      name = data.get("name", None)
+      if t.N in ("def", "class") and name is not None:
+         qualname = f"{qualname}.{name}" if qualname else name
+      if t.N == "def":
+         ids = NormalizeTokens(_Leaves(t), keywords)
+         if len(ids) >= k + w - 1:
+            out.append((qualname, t.L, Fingerprints(ids, k, w)))
+      stack.append((iter(data["children"]), qualname))
+   return out
+
+
+def _FileUnits(full_path):
+   language = GetLanguage(full_path)
+   try:
+      with Stage("read", full_path):
+         text = ReadText(full_path)
+   except (OSError, UnicodeDecodeError):
+      return []
+   with Stage("tokenize", full_path):
+      tokens = language.Lex(text)
+   with Stage("decorate", full_path):
+      tree = language.Decorate(tokens)
+   with Stage("extract", full_path):
+      return CloneUnits(tokens, tree, language.keywords)
+
+
+def IndexClones(db, root_path, workers=None, budget=None):
+   """
+   Store the clone units of the file hashes of a DatabaseManager that have
+   none yet (run after UpdateRepository or UpdateRepositories).
+
+   Args:
+      workers: worker processes (default: os.cpu_count(), 1 works in this
+               process)
+      budget: util.budget.MemoryBudget bounding the results not stored
+              yet, as IndexPostings
+
+   Returns:
+      int: number of file hashes fingerprinted
+   """
+   done = db.GetCloneHashes()
+   paths = {
+      hid: path for hid, path in db.GetContentPaths(root_path, TEXT).items()
+      if hid not in done and GetLanguage(path) is not None
+   }
+   hids = list(paths)
+   tasks = [paths[hid] for hid in hids]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      db.UpdateCloneUnits(zip(hids, map(_FileUnits, tasks)))
+   elif budget is not None:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         db.UpdateCloneUnits(zip(hids, BoundedMap(executor, _FileUnits, tasks, budget, FileCost)))
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         db.UpdateCloneUnits(zip(hids, executor.map(_FileUnits, tasks, chunksize=_CHUNK_SIZE)))
+   return len(hids)
+
+
+def ClonePairs(db, min_similarity=0.8, max_frequency=64):
+   """
+   Clone pairs of the fingerprinted units of a DatabaseManager, functions
+   with functions and files with files; a def is not paired with the defs
+   nested in it, whose fingerprints it holds.
+
+   Args:
+      min_similarity: Jaccard similarity of the fingerprint sets, shared
+                      fingerprints over those of either unit; a small
+                      unit contained in a larger one scores low
+      max_frequency: fingerprints held by more units are boilerplate and
+                     left out of the join
+
+   Returns:
+      list: ((repository, filepath, name, L), (repository, filepath,
+            name, L), similarity), most similar first; name is "" for a
+            whole file, repository "" for the files of UpdateRepository
+   """
+   return [
+      ((repo_a, path_a, name_a, L_a), (repo_b, path_b, name_b, L_b), similarity)
+      for repo_a, path_a, name_a, L_a, repo_b, path_b, name_b, L_b, similarity
+      in db.GetClonePairs(min_similarity, max_frequency)
+   ]
+
+
+def CloneGroups(pairs):
+   """
+   Connected groups of clone pairs ((unit, unit, ...) tuples whose first
+   two items are the units), largest first.
+   """
+   parent = {}
+   def _Find(x):
+      root = x
+      while parent.get(root, root) != root:
+         root = parent[root]
+      while x != root:
+         x, parent[x] = parent[x], root
+      return root
+
+   for pair in pairs:
+      a = _Find(pair[0])
+      b = _Find(pair[1])
+      if a != b:
+         parent[b] = a
+   groups = {}
+   for x in list(parent):
+      groups.setdefault(_Find(x), []).append(x)
+   for root in groups:
+      groups[root].append(root)
+   return sorted((sorted(set(g)) for g in groups.values()), key=len, reverse=True)
@@ -28,11 +28,12 @@ class TokenLang(Enum):
 
 
 class Token(object):
-   def __init__(self, N, T, L, C, lang=None, langver=None, data=None):
+   def __init__(self, N, T, L, C, lang=None, langver=None, data=None, O=-1):
       self.N = N # name
       self.T = T # type
       self.L = L # line number
       self.C = C # line column
+      self.O = O # text offset
       self.lang = lang
       self.langver = langver
       self.data = data
@@ -0,0 +1,68 @@
+from .common import Token, TokenType, TokenLang
+from .decorate import TokenDecorate, TokenDecorateEnv
+from .lexer import LexerRules, CompileLexer
+
+lang = TokenLang.CPP
+
+# reserved words, not identifiers
+keywords = frozenset((
+   "alignas", "alignof", "asm", "auto", "bool", "break", "case", "catch",
+   "char", "class", "const", "constexpr", "const_cast", "continue",
+   "decltype", "default", "delete", "do", "double", "dynamic_cast", "else",
+   "enum", "explicit", "export", "extern", "false", "float", "for",
+   "friend", "goto", "if", "inline", "int", "long", "mutable", "namespace",
+   "new", "noexcept", "nullptr", "operator", "private", "protected",
+   "public", "register", "reinterpret_cast", "return", "short", "signed",
+   "sizeof", "static", "static_assert", "static_cast", "struct", "switch",
+   "template", "this", "throw", "true", "try", "typedef", "typeid",
+   "typename", "union", "unsigned", "using", "virtual", "void", "volatile",
+   "while",
+))
+
+lexer_rules = LexerRules(
+   strings=[
+      ('"', '"', False),
+      ("'", "'", False),
+   ],
+   line_comments=['//'],
+   block_comments=[('/*', '*/')],
+)
+
+
+def Lex(text: str):
+   return CompileLexer(lexer_rules).Lex(text)
+
+
+def _DecorateInclude(env, scope):
+   # '#' [space] include (<a/b.h> | "a/b.h")
+   t0 = env.GetToken(env.i)
+   i = env.i+1
+   while i < env.n and env.GetToken(i).T == TokenType.SPACE:
+      i += 1
+   if i >= env.n or env.GetToken(i).N != 'include':
+      return False
+   data_path = []
+   t = Token("include", TokenType.BLOCK, t0.L, t0.C, TokenLang.CPP, None, data={"path": data_path}, O=t0.O)
+   for i in range(i+1, env.n):
+      token = env.GetToken(i)
+      if token.T == TokenType.BR:
+         break
+      if token.T == TokenType.STRING:
+         data_path.append(Token(token.N[1:-1], TokenType.MOD, token.L, token.C+1, O=token.O+1))
+      elif token.T == TokenType.SYM and token.N not in ('<', '>'):
+         data_path.append(token)
+   else:
+      i = env.n
+   env.i = i
+   scope.tokens.append(t)
+   return True
+
+
+decorate_map_root = {
+   "#": [_DecorateInclude],
+}
+
+
+def Decorate(tokens):
+   env = TokenDecorateEnv(tokens, decorate_map_root)
+   return TokenDecorate(env).tokens
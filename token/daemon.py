@@ -0,0 +1,372 @@
+"""
+Query daemon: an index kept warm in memory and served over a Unix socket.
+
+A QueryEngine holds the symbol table, the interned identifier names, the
+most used posting lists, the scope indexes of recent files and a parse
+cache. The daemon serves it one JSON request per line; every request first
+checks the SQLite data_version, and a commit by any writer starts a new
+generation that drops the index derived state (parsed contents stay, they
+are keyed by content).
+
+The command line uses the daemon of an index when it runs, and otherwise
+a QueryEngine of its own over the database:
+
+   python -m token.daemon serve index.db
+   python -m token.daemon query index.db FindSymbol pkg.mod.Class
+   python -m token.daemon query index.db FindReferences '["loads", "dumps"]' true
+
+An index split by util.shards.ShardedDatabase is served with --shards N
+(python -m token.daemon serve index.db --shards 4).
+"""
+import os
+import sys
+import json
+import socket
+import sqlite3
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from util.db import DatabaseManager
+from util.shards import ShardedDatabase, ShardPath
+from util.sysfs import ReadText
+
+from .lang import GetLanguage
+from .cache import ParseCache, CachePathForDatabase
+from .symbols import ExtractSymbols, ModuleName
+from .postings import DecodePostings
+from .scopeindex import ScopeIndex
+
+# posting lists (per name) and scope indexes (per file) kept in memory
+_POSTING_LISTS = 4096
+_SCOPE_INDEXES = 256
+
+
+def SocketPathForDatabase(db_path):
+   """Unix socket of the daemon serving an index database."""
+   return os.path.splitext(db_path)[0] + ".sock"
+
+
+class _LRU(OrderedDict):
+
+   def __init__(self, size):
+      super().__init__()
+      self.size = size
+
+   def Get(self, key, load):
+      value = self.get(key, None)
+      if value is not None:
+         self.move_to_end(key)
+         return value
+      value = self[key] = load(key)
+      if len(self) > self.size:
+         self.popitem(last=False)
+      return value
+
+
+class QueryEngine(object):
+   """
+   Query methods over an index database, with the derived state resident
+   between calls; not thread-safe.
+
+   Args:
+      parse_cache: ParseCache of Outline, by default one next to the database
+      shards: shard count of an index of util.shards.ShardedDatabase, None
+              for a single database
+   """
+
+   def __init__(self, db_path, parse_cache=None, shards=None):
+      if shards is None:
+         self.db = DatabaseManager(db_path)
+         paths = [db_path]
+      else:
+         self.db = ShardedDatabase(db_path, shards)
+         paths = [ShardPath(db_path, i, shards) for i in range(shards)]
+      self.parse_cache = parse_cache or ParseCache(CachePathForDatabase(db_path))
+      self.generation = 0
+      # data_version of every database file
+      self._conns = [sqlite3.connect(path, check_same_thread=False) for path in paths]
+      self._version = None
+      self._Reset()
+
+   def _Reset(self):
+      self._symbols = None
+      self._identifiers = None
+      self._postings = _LRU(_POSTING_LISTS)
+      self._scopes = _LRU(_SCOPE_INDEXES)
+      self._root_path = None
+
+   def Refresh(self):
+      """Start a new generation if the database changed since the last call."""
+      version = tuple(conn.execute('PRAGMA data_version').fetchone()[0] for conn in self._conns)
+      if version != self._version:
+         if self._version is not None:
+            self.generation += 1
+         self._version = version
+         self._Reset()
+      return self.generation
+
+   def Close(self):
+      for conn in self._conns:
+         conn.close()
+      if isinstance(self.db, ShardedDatabase):
+         self.db.close()
+      self.parse_cache.Close()
+
+   # symbols
+
+   def _SymbolTable(self):
+      if self._symbols is None:
+         rows, bases = self.db.GetSymbolTable()
+         by_sid = {}
+         table = {"qualname": {}, "name": {}, "container": {}, "base": {}}
+         for sid, filepath, qualname, kind, L, C, name, container in rows:
+            row = by_sid[sid] = (filepath, qualname, kind, L, C)
+            table["qualname"].setdefault(qualname, []).append(row)
+            table["name"].setdefault(name, []).append(row)
+            table["container"].setdefault(container, []).append(row)
+         for sid, base in bases:
+            row = by_sid.get(sid, None)
+            found = table["base"].setdefault(base, [])
+            # a class listing one base twice is found once
+            if row is not None and (not found or found[-1] is not row):
+               found.append(row)
+         for rows in table["base"].values():
+            rows.sort(key=lambda row: (row[0], row[3]))
+         self._symbols = table
+      return self._symbols
+
+   def FindSymbol(self, qualname):
+      return self._SymbolTable()["qualname"].get(qualname, [])
+
+   def FindSymbolsByName(self, name):
+      return self._SymbolTable()["name"].get(name, [])
+
+   def ListMembers(self, qualname):
+      return self._SymbolTable()["container"].get(qualname, [])
+
+   def FindSubclasses(self, base):
+      return self._SymbolTable()["base"].get(base, [])
+
+   # calls
+
+   def FindCallers(self, qualname):
+      return self.db.FindCallers(qualname)
+
+   def FindCallees(self, qualname):
+      return self.db.FindCallees(qualname)
+
+   def FindUnresolvedCalls(self, name):
+      return self.db.FindUnresolvedCalls(name)
+
+   # identifier references
+
+   def _PostingList(self, name):
+      # [((repository, filepath), offsets)] of one identifier, in order
+      return [
+         ((repository, filepath), DecodePostings(buf))
+         for repository, filepath, _, buf in self.db.GetPostings([name])
+      ]
+
+   def FindReferences(self, names, match_all=False):
+      """
+      token.postings.FindReferences, from the resident posting lists; names
+      may be a single name (e.g. from the command line).
+      """
+      if isinstance(names, str):
+         names = [names]
+      if self._identifiers is None:
+         self._identifiers = frozenset(self.db.GetIdentifiers())
+      names = sorted(set(names))
+      known = [name for name in names if name in self._identifiers]
+      if not known or match_all and len(known) < len(names):
+         return []
+      lists = {name: self._postings.Get(name, self._PostingList) for name in known}
+      if match_all:
+         files = set.intersection(*({location for location, _ in rows} for rows in lists.values()))
+      out = [
+         (location[0], location[1], name, offsets)
+         for name, rows in lists.items()
+         for location, offsets in rows
+         if not match_all or location in files
+      ]
+      out.sort(key=lambda row: row[:3])
+      return out
+
+   # positions
+
+   def _ScopeIndex(self, filepath):
+      buf = self.db.GetScopeIndex(filepath)
+      return None if buf is None else ScopeIndex.FromBytes(buf)
+
+   def SymbolAt(self, filepath, L, C=0):
+      """Qualified name (in the file) of the def/class holding (L, C), or None."""
+      index = self._scopes.Get(filepath, self._ScopeIndex)
+      if index is None:
+         return None
+      return index.LookupSymbols([(L, C)])[0]
+
+   def Outline(self, filepath):
+      """(qualname, kind, L, C) of the defs/classes of a file, parsed through the parse cache."""
+      if self._root_path is None:
+         self._root_path = self.db.GetRootPath() or ""
+      full_path = os.path.join(self._root_path, filepath)
+      language = GetLanguage(full_path)
+      if language is None:
+         return []
+      try:
+         text = ReadText(full_path)
+      except (OSError, UnicodeDecodeError):
+         return []
+      tree = self.parse_cache.Parse(text, language)
+      return [
+         (s.qualname, s.kind.value, s.L, s.C)
+         for s in ExtractSymbols(tree, ModuleName(filepath))
+      ]
+
+   QUERIES = (
+      "FindSymbol", "FindSymbolsByName", "ListMembers", "FindSubclasses",
+      "FindCallers", "FindCallees", "FindUnresolvedCalls",
+      "FindReferences", "SymbolAt", "Outline",
+   )
+
+   def Execute(self, op, args):
+      """Result of query op with a JSON argument list."""
+      if op not in self.QUERIES:
+         raise ValueError(f"Unknown query: {op}")
+      self.Refresh()
+      return getattr(self, op)(*args)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+   def handle(self):
+      server = self.server
+      for line in self.rfile:
+         try:
+            request = json.loads(line)
+            result, generation = server.executor.submit(server.Execute, request["op"], request.get("args", [])).result()
+            response = {"ok": True, "generation": generation, "result": result}
+         except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+         self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+         self.wfile.flush()
+
+
+class QueryDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+   """
+   Server of a QueryEngine on a Unix socket; connections are served by
+   threads, queries one at a time by the thread owning the engine.
+   """
+   daemon_threads = True
+
+   def __init__(self, db_path, socket_path=None, shards=None):
+      self.engine = QueryEngine(db_path, shards=shards)
+      self.executor = ThreadPoolExecutor(max_workers=1)
+      socket_path = socket_path or SocketPathForDatabase(db_path)
+      if os.path.exists(socket_path):
+         # left by a daemon that did not stop cleanly, unless one answers
+         if _Connect(socket_path) is not None:
+            raise OSError(f"A daemon is serving {socket_path}")
+         os.unlink(socket_path)
+      super().__init__(socket_path, _Handler)
+
+   def Execute(self, op, args):
+      return self.engine.Execute(op, args), self.engine.generation
+
+   def server_close(self):
+      super().server_close()
+      try:
+         os.unlink(self.server_address)
+      except OSError:
+         pass
+      self.executor.submit(self.engine.Close).result()
+      self.executor.shutdown()
+
+
+def _Connect(socket_path, timeout=None):
+   sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   sock.settimeout(timeout)
+   try:
+      sock.connect(socket_path)
+   except OSError:
+      sock.close()
+      return None
+   return sock
+
+
+class Client(object):
+   """
+   Connection to a QueryDaemon; Connect() returns None when none runs.
+   """
+
+   def __init__(self, sock):
+      self.sock = sock
+      self.file = sock.makefile('rwb')
+
+   @classmethod
+   def Connect(cls, socket_path, timeout=30):
+      sock = _Connect(socket_path, timeout)
+      return None if sock is None else cls(sock)
+
+   def Query(self, op, *args):
+      self.file.write(json.dumps({"op": op, "args": args}).encode('utf-8') + b'\n')
+      self.file.flush()
+      line = self.file.readline()
+      if not line:
+         raise ConnectionError("Query daemon closed the connection")
+      response = json.loads(line)
+      if not response["ok"]:
+         raise RuntimeError(response["error"])
+      return response["result"]
+
+   def Close(self):
+      self.file.close()
+      self.sock.close()
+
+
+def Query(db_path, op, *args, socket_path=None, shards=None):
+   """
+   Result of a query on an index: through its daemon when one runs,
+   otherwise on the database directly (shards: see QueryEngine). Results
+   are JSON shaped (lists).
+   """
+   client = Client.Connect(socket_path or SocketPathForDatabase(db_path))
+   if client is not None:
+      try:
+         return client.Query(op, *args)
+      finally:
+         client.Close()
+   engine = QueryEngine(db_path, shards=shards)
+   try:
+      return json.loads(json.dumps(engine.Execute(op, list(args))))
+   finally:
+      engine.Close()
+
+
+def _Arg(text):
+   # JSON values (numbers, lists, true) as such, anything else as a string
+   try:
+      return json.loads(text)
+   except ValueError:
+      return text
+
+
+if __name__ == "__main__":
+   shards = None
+   if "--shards" in sys.argv[:-1]:
+      i = sys.argv.index("--shards")
+      shards = int(sys.argv[i + 1])
+      del sys.argv[i:i + 2]
+   if len(sys.argv) >= 3 and sys.argv[1] == "serve":
+      with QueryDaemon(sys.argv[2], shards=shards) as server:
+         try:
+            server.serve_forever()
+         except KeyboardInterrupt:
+            pass
+   elif len(sys.argv) >= 4 and sys.argv[1] == "query":
+      result = Query(sys.argv[2], sys.argv[3], *map(_Arg, sys.argv[4:]), shards=shards)
+      print(json.dumps(result, indent=1))
+   else:
+      print(__doc__)
+      sys.exit(2)
@@ -1,3 +1,7 @@
+from array import array
+from bisect import bisect_left
+from types import GeneratorType
+
 from .common import Token, TokenType
 
 class TokenScope(object):
@@ -20,6 +24,9 @@ class TokenDecorateEnv(object):
       self.scope_stack = None
       self.decorate_stack = [decorate_map_root]
       self.decorate_default_fn = decorate_default_fn
+      # see GetBracketEnds, GetLineTable
+      self.bracket_ends = None
+      self.line_table = None
 
    def HasNext(self):
       return self.i < self.n
@@ -30,8 +37,59 @@ class TokenDecorateEnv(object):
    def GetDecorateMap(self):
       return self.decorate_stack[-1]
 
+   def GetBracketEnds(self, pairs):
+      """BuildBracketEnds of the tokens, built on first use."""
+      if self.bracket_ends is None:
+         self.bracket_ends = BuildBracketEnds(self.tokens, pairs)
+      return self.bracket_ends
 
-def TokenDecorate(env, i=0, j=-1):
+   def GetLineTable(self, pairs, empty_types):
+      """TokenLineTable of the tokens, built on first use."""
+      if self.line_table is None:
+         self.line_table = TokenLineTable(self.tokens, self.GetBracketEnds(pairs), pairs, empty_types)
+      return self.line_table
+
+
+def BuildBracketEnds(tokens, pairs):
+   """
+   Bracket matches of a token list in one pass.
+
+   A scan from an opening bracket stops after its closing bracket, or at
+   the first closing bracket not matching the innermost open one, which
+   ends every bracket still open. Unclosed brackets end at len(tokens).
+
+   Args:
+      tokens: Token list
+      pairs: opening -> closing bracket names
+
+   Returns:
+      array: ends[i] is the index after the scan from the opening bracket
+             at i, or ~that index (negative) for a recovered mismatch or
+             unclosed bracket; 0 for other tokens
+   """
+   n = len(tokens)
+   ends = array('q', bytes(8 * n))
+   closing = set(pairs.values())
+   brackets = closing.union(pairs)
+   stack = []
+   for j in [j for j, t in enumerate(tokens) if t.N in brackets]:
+      name = tokens[j].N
+      if name in pairs:
+         stack.append(j)
+      elif stack:
+         i = stack[-1]
+         if pairs[tokens[i].N] == name:
+            ends[stack.pop()] = j+1
+         else:
+            for i in stack:
+               ends[i] = ~(j+1)
+            stack.clear()
+   for i in stack:
+      ends[i] = ~n
+   return ends
+
+
+def _EnterScope(env, i, j):
    if j < 0:
       j = env.n - 1
    scope = TokenScope([], {})
@@ -40,16 +98,225 @@ def TokenDecorate(env, i=0, j=-1):
    else:
       env.scope_stack = [scope]
    env.i = i
-   while env.HasNext() and env.i <= j:
-      token = env.GetToken(env.i)
-      decorate_map = env.GetDecorateMap()
-      matched = False
-      if token.N in decorate_map:
-         for fn in decorate_map[token.N]:
-            ret = fn(env, scope)
-            if ret:
-               matched = True
-      if not matched:
-         env.decorate_default_fn(env, scope)
-   env.scope_stack.pop()
-   return scope
+   return scope, j
+
+
+def TokenDecorate(env, i=0, j=-1):
+   """
+   Decorate tokens i..j (inclusive) of env into a scope.
+
+   Handlers of env.GetDecorateMap() are called as fn(env, scope) and return
+   whether they matched. A handler needing the tokens of a subscope
+   decorated is a generator: it yields (i, j) and gets the TokenScope sent
+   back. Suspended handlers are kept on an explicit stack, so nesting depth
+   is not bound by the recursion limit.
+   """
+   tokens = env.tokens
+   default_fn = env.decorate_default_fn
+   # suspended parents: (scope, j, handlers, next handler, matched, generator)
+   stack = []
+   scope, j = _EnterScope(env, i, j)
+   fns = None
+   while True:
+      if fns is None:
+         i = env.i
+         if i < env.n and i <= j:
+            fns = env.GetDecorateMap().get(tokens[i].N, None)
+            if fns is None:
+               default_fn(env, scope)
+               continue
+            k = 0
+            matched = False
+         else:
+            # scope done: hand it to the handler waiting for it
+            env.scope_stack.pop()
+            if not stack:
+               return scope
+            subscope = scope
+            scope, j, fns, k, matched, gen = stack.pop()
+            try:
+               request = gen.send(subscope)
+            except StopIteration as e:
+               if e.value:
+                  matched = True
+            else:
+               stack.append((scope, j, fns, k, matched, gen))
+               scope, j = _EnterScope(env, *request)
+               fns = None
+               continue
+
+      while k < len(fns):
+         fn = fns[k]
+         k += 1
+         ret = fn(env, scope)
+         if type(ret) == GeneratorType:
+            try:
+               request = next(ret)
+            except StopIteration as e:
+               ret = e.value
+            else:
+               stack.append((scope, j, fns, k, matched, ret))
+               scope, j = _EnterScope(env, *request)
+               break
+         if ret:
+            matched = True
+      else:
+         if not matched:
+            default_fn(env, scope)
+      fns = None
+
+
+class TokenLazyChildren(list):
+   """
+   Children list of a scope decorated on first access: the tokens i..j of
+   env, decorated by TokenDecorate with env's map, then kept as the list
+   content. Any list read or write expands it first; pickling and copies
+   give a plain list.
+   """
+
+   def __init__(self, env, i, j):
+      list.__init__(self)
+      self.env = env
+      # token span of the scope
+      self.i = i
+      self.j = j
+
+   def Expand(self):
+      env = self.env
+      if env is not None:
+         self.env = None
+         state = env.i, env.scope_stack
+         env.scope_stack = None
+         list.extend(self, TokenDecorate(env, self.i, self.j).tokens)
+         env.i, env.scope_stack = state
+      return self
+
+   def IsExpanded(self):
+      return self.env is None
+
+   def __reduce_ex__(self, protocol):
+      return list, (list(self.Expand()),)
+
+
+def _ExpandFirst(name):
+   method = getattr(list, name)
+   def _Method(self, *args):
+      self.Expand()
+      return method(self, *args)
+   _Method.__name__ = name
+   return _Method
+
+
+for _name in (
+   "__len__", "__iter__", "__reversed__", "__getitem__", "__contains__",
+   "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__", "__repr__",
+   "__add__", "__mul__", "__iadd__", "__imul__", "__setitem__", "__delitem__",
+   "append", "extend", "insert", "pop", "remove", "clear", "index", "count",
+   "copy", "sort", "reverse",
+):
+   setattr(TokenLazyChildren, _name, _ExpandFirst(_name))
+del _name
+
+
+class TokenLineTable(object):
+   """
+   Per physical line summary of a token list, for indentation based scopes.
+
+   A logical line runs from a line start to the first line break not inside
+   brackets opened on it and not escaped by a backslash; the lines it spans
+   after its first one are continuation lines.
+
+   Attributes:
+      starts: first token index of each line
+      indent: INDENT width of each line, 0 if it has no INDENT
+      empty: the line holds only tokens of empty_types
+      cont: the line continues the logical line of a previous one
+      below: for a non-empty logical line start, the next one with a
+             smaller indent (monotonic stack), len(starts) if none
+      next_code: for a logical line start, the first non-empty logical
+             line start from it, len(starts) if none
+      line_of: line start token index -> line
+   """
+
+   def __init__(self, tokens, bracket_ends, pairs, empty_types):
+      n = len(tokens)
+      self.n = n
+      # logical line ends are decided by line breaks, backslashes and
+      # brackets only
+      specials = set(pairs)
+      specials.update(('\n', '\\'))
+      special = [q for q, t in enumerate(tokens) if t.N in specials]
+      names = [tokens[q].N for q in special]
+      self.special = special
+
+      starts = [0] if n else []
+      # index in special of the first special from each line start
+      first_special = [0] if n else []
+      for z in range(len(special)):
+         if names[z] == '\n' and special[z]+1 < n:
+            starts.append(special[z]+1)
+            first_special.append(z+1)
+      m = len(starts)
+      self.starts = array('q', starts)
+      self.line_of = dict(zip(starts, range(m)))
+
+      # line starting after the logical line end from each special (m past
+      # the last line), right to left; special_line[len(special)] = m
+      special_line = array('q', [m]) * (len(special)+1)
+      for z in range(len(special)-1, -1, -1):
+         q = special[z]
+         name = names[z]
+         if name == '\n':
+            special_line[z] = self.line_of.get(q+1, m)
+            continue
+         if name == '\\':
+            q += 2
+         else:
+            q = bracket_ends[q]
+            q = q if q >= 0 else ~q
+         special_line[z] = special_line[bisect_left(special, q, z+1)]
+      self.special_line = special_line
+
+      self.indent = array('q', bytes(8 * m))
+      self.empty = bytearray(m)
+      for k in range(m):
+         q = starts[k]
+         t = tokens[q]
+         if t.T == TokenType.INDENT:
+            self.indent[k] = t.data
+         while t.T in empty_types:
+            if t.N == '\n':
+               self.empty[k] = 1
+               break
+            q += 1
+            if q == n:
+               self.empty[k] = 1
+               break
+            t = tokens[q]
+
+      self.cont = bytearray(b'\x01') * m
+      chain = []
+      k = 0
+      while k < m:
+         self.cont[k] = 0
+         chain.append(k)
+         k = special_line[first_special[k]]
+      self.below = array('q', [m]) * m
+      self.next_code = array('q', [m]) * m
+      stack = []
+      code = m
+      for k in reversed(chain):
+         if not self.empty[k]:
+            w = self.indent[k]
+            while stack and self.indent[stack[-1]] >= w:
+               stack.pop()
+            if stack:
+               self.below[k] = stack[-1]
+            stack.append(k)
+            code = k
+         self.next_code[k] = code
+
+   def GetLogicalEnd(self, q):
+      """Index after the line break ending the logical line from token q."""
+      k = self.special_line[bisect_left(self.special, q)]
+      return self.starts[k] if k < len(self.starts) else self.n
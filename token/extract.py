@@ -1,3 +1,5 @@
+from itertools import accumulate
+
 from .common import Token, TokenType, IsSym
 
 def _ExtractDefaultFn(env, out):
@@ -18,6 +20,8 @@ class TokenExtractEnv(object):
       self.i = 0
       self.n = len(tokens)
       self.tokens = tokens
+      # text offset of every raw token; offsets[n] is the text length
+      self.offsets = list(accumulate(map(len, tokens), initial=0))
       self.extract_stack = [extract_map_root]
       self.extract_default_fn = extract_default_fn
 
@@ -27,6 +31,9 @@ class TokenExtractEnv(object):
    def GetToken(self, index):
       return self.tokens[index]
 
+   def GetOffset(self, index):
+      return self.offsets[index]
+
    def GetExtractMap(self):
       return self.extract_stack[-1]
 
@@ -36,7 +43,9 @@ def TokenExtract(env):
    env.C = 0
    out = []
    while env.HasNext():
-      token = env.GetToken(env.i)
+      i = env.i
+      k = len(out)
+      token = env.GetToken(i)
       extract_map = env.GetExtractMap()
       matched = False
       if token in extract_map:
@@ -47,6 +56,9 @@ def TokenExtract(env):
                break
       if not matched:
          env.extract_default_fn(env, out)
+      # handlers emit at most one token, starting at the raw token they got
+      if len(out) > k:
+         out[k].O = env.GetOffset(i)
    return out
 
 
@@ -56,12 +68,14 @@ def ExtractQuote(env, out):
    L = env.L
    C = env.C
    t = Token(start_token, TokenType.STRING, L, C)
+   C += len(start_token)
    for i in range(env.i+1, env.n):
       token = env.GetToken(i)
       if token == '\n':
+         # unterminated; leave line break to MarkLineNumber
          env.C = C
          out.append(t)
-         env.i = i+1
+         env.i = i
          return True
       t.N += token
       C += len(token)
@@ -0,0 +1,321 @@
+"""
+Module import graph of a repository.
+
+ExtractImports reads the import nodes of a decorated python tree,
+ResolveImports turns them into absolute module names, and IndexImports
+stores them per file in the database for the files whose content hash
+changed, parsing those in a process pool. Edges are kept as module names
+and joined with the module table at query time, so adding or removing a
+file re-targets the imports of unchanged files without reparsing them.
+
+ImportGraph holds the file-level edges in memory and answers direct and
+transitive (reverse) dependency queries, memoising closures and dropping
+only the memoised ones an edge change can affect.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from util.instrument import Stage
+from util.filetype import TEXT
+
+from .symbols import ModuleName, PackageDirs, IsPythonFile, ParseFile
+
+# files parsed per worker task
+_CHUNK_SIZE = 64
+
+
+def _Items(tokens):
+   # "a.b as c, d" -> [("a.b", "c"), ("d", None)]
+   items = []
+   item = []
+   alias = None
+   for t in tokens:
+      if t.N == ',':
+         if item:
+            items.append((''.join(item), alias or None))
+         item = []
+         alias = None
+      elif t.N == 'as':
+         alias = ''
+      elif alias is not None:
+         alias += t.N
+      else:
+         item.append(t.N)
+   if item:
+      items.append((''.join(item), alias or None))
+   return items
+
+
+def ExtractImports(tree, aliases=False):
+   """
+   Import statements of a decorated python tree, nested ones included.
+
+   Args:
+      aliases: keep the "as" names of the imported names
+
+   Returns:
+      list: (level, module, names, L) per statement; level is the count of
+            leading dots of a from-import, module the dotted name after
+            them ("" for "from . import x"), names the imported names of a
+            from-import or None for "import a.b, c" (module is then each
+            of the imported modules in turn); with aliases, names and
+            modules are (name, alias or None) pairs
+   """
+   out = []
+   stack = [iter(tree)]
+   while stack:
+      t = next(stack[-1], None)
+      if t is None:
+         stack.pop()
+         continue
+      data = t.data
+      if type(data) != dict:
+         continue
+      if t.N == "import" and "sym" in data:
+         path = data.get("path", None)
+         items = _Items(data["sym"])
+         if not aliases:
+            items = [name for name, alias in items]
+         if path is None:
+            for module in items:
+               out.append((0, module, None, t.L))
+         else:
+            level = 0
+            while level < len(path) and path[level].N == '.':
+               level += 1
+            out.append((level, ''.join(x.N for x in path[level:]), items, t.L))
+         continue
+      children = data.get("children", None)
+      if children is not None:
+         stack.append(iter(children))
+   return out
+
+
+def _Package(module, is_package):
+   package = module.split('.') if module else []
+   return package if is_package else package[:-1]
+
+
+def _Absolute(package, level, name):
+   # absolute module of a from-import, None beyond the top-level package
+   if not level:
+      return name
+   if level - 1 >= len(package):
+      return None
+   base = package[:len(package) - (level - 1)]
+   if name:
+      base = base + [name]
+   return '.'.join(base)
+
+
+def ResolveImports(module, is_package, imports):
+   """
+   Absolute import targets of ExtractImports output in a module.
+
+   Args:
+      module: dotted name of the importing module
+      is_package: the module is a package __init__
+
+   Returns:
+      list: (target, fallback, L); "from p import x" may import module p.x
+            or name x of module p, so the target p.x has the fallback p
+   """
+   package = _Package(module, is_package)
+   out = []
+   seen = set()
+   for level, name, names, L in imports:
+      name = _Absolute(package, level, name)
+      if not name:
+         continue
+      if names is None:
+         targets = [(name, None)]
+      else:
+         targets = [(name, None) if x == '*' else (f"{name}.{x}", name) for x in names]
+      for target, fallback in targets:
+         if (target, fallback) not in seen:
+            seen.add((target, fallback))
+            out.append((target, fallback, L))
+   return out
+
+
+def ImportBindings(module, is_package, tree):
+   """
+   Names the imports of a module bind, nested ones included, to what they
+   refer to: "import a.b" binds a to a, "import a.b as c" c to a.b, "from
+   .p import x as y" y to <package>.p.x.
+   """
+   package = _Package(module, is_package)
+   bindings = {}
+   for level, name, names, L in ExtractImports(tree, aliases=True):
+      if names is None:
+         name, alias = name
+         bindings[alias or name.partition('.')[0]] = name if alias else name.partition('.')[0]
+         continue
+      name = _Absolute(package, level, name)
+      if not name:
+         continue
+      for x, alias in names:
+         if x != '*':
+            bindings[alias or x] = f"{name}.{x}"
+   return bindings
+
+
+def _FileImports(task):
+   full_path, module, is_package, cache_path = task
+   tree = ParseFile(full_path, cache_path)
+   if tree is None:
+      return []
+   with Stage("extract", full_path):
+      return ResolveImports(module, is_package, ExtractImports(tree))
+
+
+def IndexImports(db, root_path, workers=None, cache_path=None, force=False):
+   """
+   Bring the module table and import edges of a DatabaseManager up to date
+   with its files (run after UpdateRepository).
+
+   Args:
+      workers: worker processes parsing the stale files (default:
+               os.cpu_count(), 1 parses in this process)
+      cache_path: ParseCache file of the workers, None to always parse
+      force: recompute the edges of every file, e.g. after packages moved
+
+   Returns:
+      list: files whose import edges were recomputed or dropped
+   """
+   hashes = {path: hid for path, hid in db.GetFileHashes(TEXT).items() if IsPythonFile(path)}
+   package_dirs = PackageDirs(hashes)
+   modules = {}
+   names = {}
+   # sorted so mod.py is taken over mod.pyi
+   for path in sorted(hashes):
+      name = names[path] = ModuleName(path, package_dirs)
+      modules.setdefault(name, path)
+   db.UpdateModules(modules)
+
+   known = db.GetImportSources()
+   stale = [path for path, hid in hashes.items() if force or known.get(path, None) != hid]
+   removed = [path for path in known if path not in hashes]
+   tasks = [
+      (
+         os.path.join(root_path, path),
+         names[path],
+         os.path.splitext(os.path.basename(path))[0] == "__init__",
+         cache_path,
+      )
+      for path in stale
+   ]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      results = map(_FileImports, tasks)
+      db.UpdateImports(((path, hashes[path], edges) for path, edges in zip(stale, results)), removed)
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         results = executor.map(_FileImports, tasks, chunksize=_CHUNK_SIZE)
+         db.UpdateImports(((path, hashes[path], edges) for path, edges in zip(stale, results)), removed)
+   return stale + removed
+
+
+class ImportGraph(object):
+   """
+   File-level import graph.
+
+   Args:
+      edges: (importing file, imported file) pairs, e.g.
+             DatabaseManager.GetImportEdges()
+   """
+
+   def __init__(self, edges=()):
+      self.deps = {}
+      self.rdeps = {}
+      # (file, reverse) -> frozenset of the files reachable from it
+      self.closures = {}
+      for src, dst in edges:
+         self.deps.setdefault(src, set()).add(dst)
+         self.rdeps.setdefault(dst, set()).add(src)
+
+   def Dependencies(self, path):
+      """Files path imports."""
+      return set(self.deps.get(path, ()))
+
+   def Dependents(self, path):
+      """Files importing path."""
+      return set(self.rdeps.get(path, ()))
+
+   def SetEdges(self, src, dsts):
+      """Replace the files src imports, dropping stale memoised closures."""
+      old = self.deps.get(src, set())
+      new = set(dsts)
+      changed = old ^ new
+      if not changed:
+         return
+      for dst in old - new:
+         self.rdeps[dst].discard(src)
+      for dst in new - old:
+         self.rdeps.setdefault(dst, set()).add(src)
+      if new:
+         self.deps[src] = new
+      else:
+         self.deps.pop(src, None)
+      # forward closures through src, reverse closures through a target
+      # gained or lost
+      stale = []
+      for key, closure in self.closures.items():
+         path, reverse = key
+         if reverse:
+            if any(dst == path or dst in closure for dst in changed):
+               stale.append(key)
+         elif src == path or src in closure:
+            stale.append(key)
+      for key in stale:
+         del self.closures[key]
+
+   def Update(self, edges, srcs=None):
+      """
+      Apply a new edge list.
+
+      Args:
+         edges: (src, dst) pairs of the files in srcs
+         srcs: files whose edges are given, None for all files
+      """
+      deps = {}
+      for src, dst in edges:
+         deps.setdefault(src, set()).add(dst)
+      if srcs is None:
+         srcs = set(self.deps) | set(deps)
+      for src in srcs:
+         self.SetEdges(src, deps.get(src, ()))
+
+   def Closure(self, path, reverse=False):
+      """
+      Files path imports directly or indirectly (reverse: files importing
+      path directly or indirectly), memoised.
+      """
+      key = (path, reverse)
+      closure = self.closures.get(key, None)
+      if closure is not None:
+         return closure
+      adjacent = self.rdeps if reverse else self.deps
+      closures = self.closures
+      seen = set()
+      stack = [path]
+      while stack:
+         z = stack.pop()
+         for y in adjacent.get(z, ()):
+            if y in seen:
+               continue
+            seen.add(y)
+            known = closures.get((y, reverse), None)
+            if known is not None:
+               seen |= known
+            else:
+               stack.append(y)
+      closure = closures[key] = frozenset(seen)
+      return closure
+
+   def Impacted(self, paths):
+      """Files that may be affected by changes of paths, paths included."""
+      out = set(paths)
+      for path in paths:
+         out |= self.Closure(path, reverse=True)
+      return out
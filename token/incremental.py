@@ -0,0 +1,282 @@
+from bisect import bisect_left
+
+from .common import TokenType
+from .decorate import TokenDecorate, TokenDecorateEnv
+from .python import (
+   Lex,
+   bracket_pairs,
+   decorate_map_root,
+   _FindBracketEnd,
+   _IsEmptyLine,
+   _EMPTY_LINE_TYPES,
+)
+
+
+class IncrementalTokens(object):
+   """
+   Extract-stage tokens of one python text, kept up to date under edits.
+
+   Edit() re-lexes from the start of the first edited line up to the first
+   line break after the edit where the new stream lines up with the old one
+   again, so its cost follows the edit size rather than the file size.
+   Tokens after the edit are reused and their L/O are shifted lazily: the
+   shift is kept pending (see Flush) and merged with the one of the next
+   edit. Decorate() re-decorates only the top-level chunks touched since
+   its previous call.
+   """
+
+   def __init__(self, text, tokens=None):
+      self.text = text
+      self.tokens = Lex(text) if tokens is None else tokens
+      # tokens[shift_i:] still need L += shift_L, O += shift_O
+      self.shift_i = len(self.tokens)
+      self.shift_L = 0
+      self.shift_O = 0
+      # top-level chunks (see _ScanChunks); None trees mark dirty chunks
+      self.chunk_starts = None
+      self.chunk_trees = None
+      self.chunk_nodes = None
+
+   def _HasShift(self):
+      return self.shift_L != 0 or self.shift_O != 0
+
+   def _ApplyShift(self, i, j, dL, dO):
+      tokens = self.tokens
+      for z in range(i, j):
+         t = tokens[z]
+         t.L += dL
+         t.O += dO
+
+   def GetOffset(self, i):
+      O = self.tokens[i].O
+      return O + self.shift_O if i >= self.shift_i else O
+
+   def GetLine(self, i):
+      L = self.tokens[i].L
+      return L + self.shift_L if i >= self.shift_i else L
+
+   def FindToken(self, offset):
+      """Index of the last token starting at or before offset (0 if none)."""
+      lo = 0
+      hi = len(self.tokens)
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self.GetOffset(mid) <= offset:
+            lo = mid + 1
+         else:
+            hi = mid
+      return max(lo - 1, 0)
+
+   def Flush(self):
+      """Apply the pending shift and return the up-to-date token list."""
+      if self._HasShift():
+         self._ApplyShift(self.shift_i, len(self.tokens), self.shift_L, self.shift_O)
+      self.shift_i = len(self.tokens)
+      self.shift_L = 0
+      self.shift_O = 0
+      return self.tokens
+
+   def Edit(self, start, end, new_text):
+      """
+      Replace text[start:end] with new_text.
+
+      Returns:
+         (i, j): index range of the re-lexed tokens in the updated stream
+      """
+      text = self.text
+      tokens = self.tokens
+      n = len(tokens)
+      if start < 0 or end < start or end > len(text):
+         raise ValueError(f"Invalid edit range: [{start}, {end})")
+      text2 = text[:start] + new_text + text[end:]
+      dO = len(new_text) - (end - start)
+      dL = new_text.count('\n') - text.count('\n', start, end)
+
+      # resynchronise at the start of the line holding the first touched
+      # token; a token right after a BR token never starts inside a string
+      r = self.FindToken(start - 1) if n else 0
+      while r > 0 and tokens[r-1].T != TokenType.BR:
+         r -= 1
+      R = self.GetOffset(r) if r < n else 0
+      L = self.GetLine(r) if r < n else 0
+
+      # re-lex whole lines until the new stream ends on a line break that
+      # maps to a token right after a line break in the old stream
+      W = _NextLineEnd(text2, max(start + len(new_text) - 1, R))
+      lines = 1
+      while True:
+         window = Lex(text2[R:W])
+         if W >= len(text2):
+            b = n
+            break
+         if window and window[-1].T == TokenType.BR:
+            q = W - dO
+            b = self.FindToken(q)
+            if 0 < b < n and self.GetOffset(b) == q and tokens[b-1].T == TokenType.BR:
+               break
+         # e.g. an opened triple quote: extend by a growing number of lines
+         for _ in range(lines):
+            W = _NextLineEnd(text2, W)
+         lines *= 2
+      for t in window:
+         t.L += L
+         t.O += R
+      m = len(window)
+
+      # merge the pending shift with the one of this edit, applying it
+      # eagerly only to the tokens between the two edits
+      k = self.shift_i
+      if not self._HasShift():
+         shift_i = r + m
+      elif k < r:
+         self._ApplyShift(k, r, self.shift_L, self.shift_O)
+         shift_i = r + m
+      elif k > b:
+         self._ApplyShift(b, k, dL, dO)
+         shift_i = k + m - (b - r)
+      else:
+         shift_i = r + m
+      tokens[r:b] = window
+      self.shift_i = shift_i
+      self.shift_L += dL
+      self.shift_O += dO
+      self.text = text2
+      if self.chunk_starts is not None:
+         self._SpliceChunks(r, b, m)
+      return r, r + m
+
+   def _SpliceChunks(self, r, b, m):
+      starts = self.chunk_starts
+      # the chunk before the edited lines is dirty too: its last scope may
+      # now end earlier or run into them
+      c0 = max(bisect_left(starts, r) - 1, 0)
+      c1 = max(bisect_left(starts, b), c0 + 1)
+      starts[c0:c1] = [starts[c0]]
+      self.chunk_trees[c0:c1] = [None]
+      self.chunk_nodes[c0:c1] = [None]
+      shift = m - (b - r)
+      if shift:
+         for c in range(c0 + 1, len(starts)):
+            starts[c] += shift
+
+   def Decorate(self):
+      """Decorated top-level tokens of the current text."""
+      tokens = self.Flush()
+      n = len(tokens)
+      env = TokenDecorateEnv(tokens, decorate_map_root)
+      if self.chunk_starts is None:
+         self.chunk_starts = [0]
+         self.chunk_trees = [None]
+         self.chunk_nodes = [None]
+      starts = self.chunk_starts
+      trees = self.chunk_trees
+      nodes = self.chunk_nodes
+      c = 0
+      while c < len(starts):
+         if trees[c] is not None:
+            # reused chunk: decorated tokens copied L/C/O of their keyword
+            for t, anchor in nodes[c]:
+               t.L = anchor.L
+               t.C = anchor.C
+               t.O = anchor.O
+            c += 1
+            continue
+         c1 = c + 1
+         while c1 < len(starts) and trees[c1] is None:
+            c1 += 1
+         bounds = _ScanChunks(env, starts[c], starts[c1:])
+         stop = bounds[-1]
+         c1 = bisect_left(starts, stop, c1) if stop < n else len(starts)
+         chunk_trees = []
+         chunk_nodes = []
+         for z in range(len(bounds)-1):
+            tree = _DecorateChunk(tokens, bounds[z], bounds[z+1])
+            chunk_trees.append(tree)
+            chunk_nodes.append(_CollectNodes(tokens[bounds[z]:bounds[z+1]], tree))
+         bounds.pop()
+         starts[c:c1] = bounds
+         trees[c:c1] = chunk_trees
+         nodes[c:c1] = chunk_nodes
+         c += len(bounds)
+      return [t for tree in trees for t in tree]
+
+
+def _NextLineEnd(text, i):
+   j = text.find('\n', i)
+   return len(text) if j < 0 else j + 1
+
+
+def _ScanChunks(env, i, clean_starts):
+   """
+   Top-level chunk boundaries from chunk start i: logical lines starting at
+   column 0 with code, not following a decorator line. Decorating chunks
+   one by one gives the same tree as decorating the whole stream, since no
+   scope runs past such a line.
+
+   Returns:
+      boundaries from i, ending with the first one found in clean_starts
+      or with env.n
+   """
+   bounds = [i]
+   after_decorator = False
+   while i < env.n:
+      start = i
+      code = False
+      while i < env.n:
+         token = env.GetToken(i)
+         if token.T not in _EMPTY_LINE_TYPES:
+            code = True
+         if token.N in bracket_pairs:
+            i = _FindBracketEnd(env, i)
+         elif token.N == '\\':
+            i += 2
+         elif token.T == TokenType.BR:
+            i += 1
+            break
+         else:
+            i += 1
+      if not code:
+         continue
+      token = env.GetToken(start)
+      if (
+         start != bounds[0] and
+         not after_decorator and
+         token.T not in _EMPTY_LINE_TYPES and
+         not _IsEmptyLine(env, start)[0]
+      ):
+         bounds.append(start)
+         z = bisect_left(clean_starts, start)
+         if z < len(clean_starts) and clean_starts[z] == start:
+            return bounds
+      after_decorator = token.N == '@'
+   bounds.append(env.n)
+   return bounds
+
+
+def _DecorateChunk(tokens, i, j):
+   # keep the first line of the next chunk visible: a scope running to the
+   # end of the stream also takes its trailing line break, while one closed
+   # by the next statement leaves it to the parent
+   k = j
+   while k < len(tokens) and tokens[k].T != TokenType.BR:
+      k += 1
+   env = TokenDecorateEnv(tokens[i:k+1], decorate_map_root)
+   return TokenDecorate(env, 0, j-i-1).tokens
+
+
+def _CollectNodes(chunk, tree):
+   # pair decorated tokens with the keyword token they copied L/C/O from
+   by_offset = {t.O: t for t in chunk}
+   out = []
+   stack = [tree]
+   while stack:
+      for t in stack.pop():
+         data = t.data
+         if type(data) != dict:
+            continue
+         out.append((t, by_offset[t.O]))
+         if "children" in data:
+            stack.append(data["children"])
+         if data.get("decorator", None):
+            stack.append(data["decorator"])
+   return out
@@ -0,0 +1,37 @@
+import os
+import importlib
+
+# file extension -> language module of this package; a module provides
+# lang, keywords, Lex(text) and Decorate(tokens)
+language_modules = {
+   ".py": "python",
+   ".pyi": "python",
+   ".pyw": "python",
+   ".c": "cpp",
+   ".h": "cpp",
+   ".cc": "cpp",
+   ".cpp": "cpp",
+   ".cxx": "cpp",
+   ".hh": "cpp",
+   ".hpp": "cpp",
+   ".hxx": "cpp",
+}
+
+_loaded = {}
+
+
+def GetLanguage(path):
+   """
+   Language module for a file path, imported on first use so only the
+   rule tables of languages actually seen get loaded and compiled.
+
+   Returns:
+      module, or None if the extension is not supported
+   """
+   name = language_modules.get(os.path.splitext(path)[1].lower(), None)
+   if name is None:
+      return None
+   module = _loaded.get(name, None)
+   if module is None:
+      module = _loaded[name] = importlib.import_module("." + name, __package__)
+   return module
@@ -0,0 +1,117 @@
+import re
+import string
+
+from .common import Token, TokenType
+
+# word characters as TokenizeText sees them: anything but ASCII punctuation
+# and whitespace, plus '_' that MergeSymUnderline glues into words
+DEFAULT_WORD = '[^\\s' + re.escape(string.punctuation.replace('_', '')) + ']'
+
+
+class LexerRules(object):
+   """
+   Lexical rules of a language, compiled by CompileLexer into one combined
+   regular expression plus a dispatch table.
+
+   Args:
+      strings: (open, close, multiline) string delimiters; longer
+               delimiters are tried first, a backslash escapes one char
+               and a single-line string stops before an unescaped line break
+      line_comments: markers starting a comment that runs to the line end
+      block_comments: (open, close) comment delimiters
+      indent: leading blanks of a line form one INDENT token
+      word: regex class of characters making up a SYM word
+   """
+
+   def __init__(
+      self,
+      strings=(),
+      line_comments=(),
+      block_comments=(),
+      indent=False,
+      word=DEFAULT_WORD,
+   ):
+      self.strings = tuple(strings)
+      self.line_comments = tuple(line_comments)
+      self.block_comments = tuple(block_comments)
+      self.indent = indent
+      self.word = word
+      self.lexer = None
+
+
+class Lexer(object):
+   def __init__(self, rules):
+      alternatives = []
+      # dispatch table: regex group -> token type
+      self.dispatch = {}
+      def _Add(T, pattern):
+         group = f'g{len(alternatives)}'
+         alternatives.append(f'(?P<{group}>{pattern})')
+         self.dispatch[group] = T
+         return group
+
+      self.br = _Add(TokenType.BR, r'\n')
+      self.indent = None
+      if rules.indent:
+         # only at the text start or right after a line break
+         self.indent = _Add(TokenType.INDENT, r'(?<![^\n])[ \t]+')
+      _Add(TokenType.SPACE, r'[ \t]')
+      for marker in rules.line_comments:
+         _Add(TokenType.COMMENT, re.escape(marker) + r'[^\n]*')
+      # groups whose tokens may span lines
+      self.multiline = set()
+      for open_, close in rules.block_comments:
+         self.multiline.add(_Add(TokenType.COMMENT, re.escape(open_) + r'[\s\S]*?(?:' + re.escape(close) + r'|\Z)'))
+      for open_, close, multiline in sorted(rules.strings, key=lambda s: -len(s[0])):
+         c = re.escape(close)
+         head = re.escape(close[0])
+         tail = re.escape(close[1:])
+         if multiline:
+            body = r'(?:[^' + head + r'\\]|\\[\s\S]?|' + head + (r'(?!' + tail + r')' if tail else '(?!)') + r')*'
+            self.multiline.add(_Add(TokenType.STRING, re.escape(open_) + body + r'(?:' + c + r'|\Z)'))
+         else:
+            body = r'(?:[^' + head + r'\\\n]|\\[^\n]?' + ((r'|' + head + r'(?!' + tail + r')') if tail else '') + r')*'
+            _Add(TokenType.STRING, re.escape(open_) + body + r'(?:' + c + r')?')
+      _Add(TokenType.SYM, rules.word + '+')
+      # anything else is a one char SYM (punctuation, other whitespace)
+      _Add(TokenType.SYM, r'[\s\S]')
+      self.regex = re.compile('|'.join(alternatives))
+
+   def Lex(self, text: str):
+      """
+      Split text into extract-stage tokens with L/C/O set.
+
+      Returns:
+         list: List of tokens
+      """
+      out = []
+      dispatch = self.dispatch
+      br = self.br
+      indent = self.indent
+      multiline = self.multiline
+      L = 0
+      line_start = 0
+      for m in self.regex.finditer(text):
+         group = m.lastgroup
+         O = m.start()
+         N = m.group()
+         t = Token(N, dispatch[group], L, O - line_start, O=O)
+         out.append(t)
+         if group == br:
+            L += 1
+            line_start = O + 1
+         elif group == indent:
+            t.data = len(N) + 7 * N.count('\t')
+         elif group in multiline:
+            k = N.count('\n')
+            if k:
+               L += k
+               line_start = O + N.rindex('\n') + 1
+      return out
+
+
+def CompileLexer(rules):
+   """Lexer of rules, compiled on first use and kept on the rules."""
+   if rules.lexer is None:
+      rules.lexer = Lexer(rules)
+   return rules.lexer
@@ -0,0 +1,57 @@
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+# offsets per bucket in the offset -> line lookup table
+_BUCKET_SHIFT = 6
+
+
+class LineIndex(object):
+   """
+   Line-start offset table of one text, for O(1) conversion between a text
+   offset and a (line, column) pair. Lines and columns are 0-based like
+   Token.L and Token.C, and only '\\n' breaks a line (see MarkLineNumber).
+   """
+
+   def __init__(self, text: str):
+      self.text = text
+      self.n = len(text)
+      # starts[L] is the offset of line L; the newline scan runs in C
+      # through str.split and accumulate
+      self.starts = array('q', accumulate(
+         map(len, text.split('\n')), lambda a, b: a + b + 1, initial=0
+      ))
+      self.starts.pop()
+      # bucket[k] is the line holding offset k << _BUCKET_SHIFT, so that
+      # ToLineCol only walks the few line starts inside a single bucket
+      self.bucket = array('q', [
+         bisect_right(self.starts, k << _BUCKET_SHIFT) - 1
+         for k in range((self.n >> _BUCKET_SHIFT) + 1)
+      ])
+
+   def LineCount(self):
+      return len(self.starts)
+
+   def ToOffset(self, L, C):
+      return self.starts[L] + C
+
+   def ToLineCol(self, offset):
+      L = self.bucket[offset >> _BUCKET_SHIFT]
+      last = len(self.starts) - 1
+      while L < last and self.starts[L+1] <= offset:
+         L += 1
+      return L, offset - self.starts[L]
+
+   def GetLine(self, L):
+      """Text of line L without its line break."""
+      start = self.starts[L]
+      end = self.starts[L+1]-1 if L+1 < len(self.starts) else self.n
+      return self.text[start:end]
+
+   def SourceSlice(self, token):
+      """Source text a token was extracted from."""
+      return self.text[token.O:token.O+len(token.N)]
+
+   def SourceSlices(self, tokens):
+      text = self.text
+      return [text[t.O:t.O+len(t.N)] for t in tokens]
@@ -0,0 +1,294 @@
+"""
+Structural (Merkle) hashes of decorated nodes and tree diffs based on them.
+
+The hash of a node covers its name and data: the normalised tokens it
+holds (layout and comments left out, so positions do not matter) and the
+hashes of its decorated children. Handlers set data["hash"] as they build
+nodes, children first, so hashing a file is one more pass over its tokens.
+Two subtrees with the same hash are taken as unchanged without visiting
+them, which keeps a diff proportional to the edit.
+
+IndexTokens stores the file_tokens rows of the contents of an index. A
+content that replaced another one in a file is diffed against the arena
+stored with the old rows, and only its changed subtrees are rewritten.
+"""
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from util.sysfs import ReadText
+from util.filetype import TEXT
+from util.instrument import Stage
+
+from .common import TokenType
+from .arena import NONE, DATA_DICT, TokenArena
+from .lang import GetLanguage
+
+# left out of hashes
+_LAYOUT_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+   TokenType.COMMENT,
+)
+_LAYOUT_KINDS = tuple(t.value for t in _LAYOUT_TYPES)
+
+# files parsed per worker task
+_CHUNK_SIZE = 64
+
+# nodes reported by name in a diff
+_SYMBOL_NAMES = ("def", "class")
+
+
+def _Digest(parts):
+   return hashlib.blake2b('\0'.join(parts).encode('utf-8', 'surrogatepass'), digest_size=8).hexdigest()
+
+
+def NodeHash(t):
+   """
+   Structural hash of a decorated token, from the hashes its children
+   already carry (computed for those missing, e.g. below lazy nodes).
+   Spaces, indents and comments are left out and line breaks count once
+   per run, so reformatting and moving a node keep its hash.
+   """
+   parts = [t.N, t.T.name]
+   for key, value in t.data.items():
+      if key == "hash":
+         continue
+      parts.append(key)
+      if value is None or type(value) == str:
+         parts.append(str(value))
+      elif value and isinstance(value[0], list):
+         for sub in value:
+            parts.append('|')
+            _AddParts(parts, sub)
+      else:
+         _AddParts(parts, value)
+   return _Digest(parts)
+
+
+def _AddParts(parts, tokens):
+   br = False
+   for x in tokens:
+      T = x.T
+      if T in _LAYOUT_TYPES:
+         if T == TokenType.BR and not br:
+            parts.append('\n')
+            br = True
+         continue
+      br = False
+      if type(x.data) == dict:
+         h = x.data.get("hash", None)
+         parts.append(NodeHash(x) if h is None else h)
+      else:
+         parts.append(x.N)
+
+
+class TreeDiff(object):
+   """
+   Attributes:
+      changed: qualified names ("A.f") of def/class nodes in both trees
+               whose own tokens differ (changes of nested def/class nodes
+               are reported for those only)
+      added: qualified names of def/class nodes only in the new tree
+      removed: qualified names of def/class nodes only in the old tree
+      same: (old node, new node) pairs of the topmost subtrees with
+            equal hashes
+   """
+
+   def __init__(self):
+      self.changed = []
+      self.added = []
+      self.removed = []
+      self.same = []
+
+
+def _Key(arena, z, counts):
+   # siblings match by (kind, name, occurrence): the n-th "if", the n-th
+   # "def f" (redefinitions)
+   key = (arena.GetName(z), arena.GetAttr(z, "name"))
+   k = counts.get(key, 0)
+   counts[key] = k + 1
+   return key + (k,)
+
+
+def _Nodes(arena, z):
+   # decorated children of z (top-level nodes for NONE) by match key
+   nodes = {}
+   counts = {}
+   for c in (arena.Roots() if z == NONE else arena.Children(z)):
+      if arena.data_tag[c] == DATA_DICT:
+         nodes[_Key(arena, c, counts)] = c
+   return nodes
+
+
+def _Qualify(qual, key):
+   # qualified name of a def/class below the def/class names qual
+   if key[0] not in _SYMBOL_NAMES:
+      return qual
+   name = key[1] if key[2] == 0 else f"{key[1]}#{key[2]}"
+   return qual + (name,)
+
+
+def _Symbols(arena, z, qual, key):
+   # qualified names of the def/class nodes of the subtree of z
+   out = []
+   stack = [(z, key, qual)]
+   while stack:
+      y, key, qual = stack.pop()
+      qual = _Qualify(qual, key)
+      if key[0] in _SYMBOL_NAMES:
+         out.append('.'.join(qual))
+      stack.extend((c, k, qual) for k, c in _Nodes(arena, y).items())
+   return out
+
+
+def _ShallowHash(arena, z):
+   # the tokens of z and of the blocks below it, nested def/class nodes
+   # taken by kind and name only
+   parts = []
+   stack = [z]
+   while stack:
+      y = stack.pop()
+      parts.append(arena.GetName(y))
+      parts.append(str(arena.GetAttr(y, "name")))
+      children = list(arena.Children(y, None))
+      for c in reversed(children):
+         if arena.kind[c] in _LAYOUT_KINDS:
+            continue
+         if arena.data_tag[c] != DATA_DICT:
+            parts.append(arena.GetName(c))
+         elif arena.GetName(c) in _SYMBOL_NAMES:
+            parts.append(arena.GetName(c))
+            parts.append(str(arena.GetAttr(c, "name")))
+         else:
+            stack.append(c)
+   return _Digest(parts)
+
+
+def DiffArenas(old, new):
+   """
+   Diff two TokenArena trees (see TokenArena.FromTree) of one file by
+   their "hash" attributes, descending only into subtrees that differ.
+
+   Returns:
+      TreeDiff
+   """
+   diff = TreeDiff()
+   # (old node, new node, qualified name of the enclosing def/class)
+   stack = [(NONE, NONE, ())]
+   while stack:
+      oz, nz, qual = stack.pop()
+      old_nodes = _Nodes(old, oz)
+      new_nodes = _Nodes(new, nz)
+      for key, z in new_nodes.items():
+         y = old_nodes.get(key, None)
+         if y is None:
+            diff.added.extend(_Symbols(new, z, qual, key))
+            continue
+         h = new.GetAttr(z, "hash")
+         if h is not None and h == old.GetAttr(y, "hash"):
+            diff.same.append((y, z))
+            continue
+         if key[0] in _SYMBOL_NAMES and _ShallowHash(old, y) != _ShallowHash(new, z):
+            diff.changed.append('.'.join(_Qualify(qual, key)))
+         stack.append((y, z, _Qualify(qual, key)))
+      for key, y in old_nodes.items():
+         if key not in new_nodes:
+            diff.removed.extend(_Symbols(old, y, qual, key))
+   return diff
+
+
+def ReusableSubtrees(old, new, same):
+   """
+   (old node, new node, line delta) of the pairs of same whose subtrees
+   differ by a line shift only, i.e. whose file_tokens rows can be kept
+   with lrow moved.
+   """
+   out = []
+   for y, z in same:
+      ey = old.SubtreeEnd(y)
+      ez = new.SubtreeEnd(z)
+      if ey - y != ez - z or old.C[y:ey] != new.C[z:ez]:
+         continue
+      dL = new.L[z] - old.L[y]
+      if any(b - a != dL for a, b in zip(old.L[y:ey], new.L[z:ez])):
+         continue
+      if old.kind[y:ey] != new.kind[z:ez]:
+         continue
+      if [old.strings[s] for s in old.name[y:ey]] != [new.strings[s] for s in new.name[z:ez]]:
+         continue
+      out.append((y, z, dL))
+   return out
+
+
+def FileArena(full_path):
+   """
+   TokenArena of a file, or None if it is not in a supported language or
+   cannot be read as text. Parsed without the parse cache: FromTree needs
+   the extract tokens the tree was decorated from.
+   """
+   language = GetLanguage(full_path)
+   if language is None:
+      return None
+   try:
+      with Stage("read", full_path):
+         text = ReadText(full_path)
+   except (OSError, UnicodeDecodeError):
+      return None
+   with Stage("tokenize", full_path):
+      tokens = language.Lex(text)
+   with Stage("decorate", full_path):
+      tree = language.Decorate(tokens)
+   with Stage("arena", full_path):
+      return TokenArena.FromTree(tokens, tree)
+
+
+def _StoreArenas(db, arenas):
+   # a content replacing one whose rows wait in the database is stored as
+   # a delta of them
+   replaced = db.GetTokenReplacements()
+   for hid, arena in arenas:
+      if arena is None:
+         continue
+      old_hid = replaced.get(hid, None)
+      old = None if old_hid is None else db.GetFileArena(old_hid)
+      with Stage("db_write"):
+         if old is None:
+            db.UpdateFileTokens(hid, arena)
+         else:
+            reuse = ReusableSubtrees(old, arena, DiffArenas(old, arena).same)
+            db.UpdateFileTokensDelta(old_hid, hid, old, arena, reuse)
+
+
+def IndexTokens(db, root_path, workers=None):
+   """
+   Store the file_tokens rows of the file hashes of a DatabaseManager that
+   have none yet (run after UpdateRepository or UpdateRepositories). The
+   rows of a file whose content changed are moved over from its old
+   content where the subtree is unchanged (see
+   DatabaseManager.UpdateFileTokensDelta).
+
+   Args:
+      workers: worker processes parsing the files (default:
+               os.cpu_count(), 1 parses in this process); arenas come
+               back pickled as plain buffers
+
+   Returns:
+      int: number of file hashes indexed
+   """
+   done = db.GetTokenHashes()
+   paths = {
+      hid: path for hid, path in db.GetContentPaths(root_path, TEXT).items()
+      if hid not in done and GetLanguage(path) is not None
+   }
+   hids = list(paths)
+   tasks = [paths[hid] for hid in hids]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      _StoreArenas(db, zip(hids, map(FileArena, tasks)))
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         results = executor.map(FileArena, tasks, chunksize=_CHUNK_SIZE)
+         _StoreArenas(db, zip(hids, results))
+   return len(hids)
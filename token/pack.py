@@ -0,0 +1,185 @@
+"""
+Compact binary form of a (decorated) token list, to move tokenizer results
+between processes as one buffer instead of pickling every Token object.
+
+Layout: a header of counts, the integer body (string lengths, one record
+of _FIELDS per distinct Token, then the structure ops) in int32, or int64
+when a value does not fit, and the utf-8 string blob. Token identity is
+kept: a Token listed in several places (e.g. class "children" and
+"parent") is stored once.
+"""
+import struct
+from array import array
+from itertools import accumulate
+
+from .common import Token, TokenType, TokenLang
+
+_MAGIC = b'CNPK'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHqqqq')
+
+# record fields: name id, type, L, C, O, lang, langver, data tag, data int
+_FIELDS = 9
+_NONE = -1
+
+# record data tags
+_DATA_NONE = 0
+_DATA_INT = 1
+_DATA_DICT = 2
+
+# dict value kinds in the ops stream
+_VALUE_NONE = 0
+_VALUE_STR = 1
+_VALUE_TOKENS = 2
+_VALUE_TOKEN_LISTS = 3
+
+_TOKEN_TYPES = {t.value: t for t in TokenType}
+_TOKEN_LANGS = {t.value: t for t in TokenLang}
+
+
+def PackTokens(tokens) -> bytes:
+   names = {}
+   def _Name(s):
+      nid = names.get(s, None)
+      if nid is None:
+         nid = names[s] = len(names)
+      return nid
+
+   # assign record ids to distinct tokens, breadth first
+   ids = {}
+   records = []
+   def _Ref(t):
+      rid = ids.get(id(t), None)
+      if rid is None:
+         rid = ids[id(t)] = len(records)
+         records.append(t)
+      return rid
+
+   ops = array('q')
+   ops.append(len(tokens))
+   ops.extend(_Ref(t) for t in tokens)
+   body = array('q')
+   k = 0
+   while k < len(records):
+      t = records[k]
+      k += 1
+      data = t.data
+      if data is None:
+         tag, value = _DATA_NONE, 0
+      elif type(data) == int:
+         tag, value = _DATA_INT, data
+      elif type(data) == dict:
+         tag, value = _DATA_DICT, len(data)
+         for key, v in data.items():
+            ops.append(_Name(key))
+            if v is None:
+               ops.append(_VALUE_NONE)
+            elif type(v) == str:
+               ops.append(_VALUE_STR)
+               ops.append(_Name(v))
+            elif isinstance(v, list) and v and isinstance(v[0], list):
+               ops.append(_VALUE_TOKEN_LISTS)
+               ops.append(len(v))
+               for sub in v:
+                  ops.append(len(sub))
+                  ops.extend(_Ref(x) for x in sub)
+            elif isinstance(v, list):
+               ops.append(_VALUE_TOKENS)
+               ops.append(len(v))
+               ops.extend(_Ref(x) for x in v)
+            else:
+               raise ValueError(f"Unsupported token data: {key}={type(v).__name__}")
+      else:
+         raise ValueError(f"Unsupported token data: {type(data).__name__}")
+      body.extend((
+         _Name(t.N),
+         t.T.value,
+         t.L,
+         t.C,
+         t.O,
+         _NONE if t.lang is None else t.lang.value,
+         _NONE if t.langver is None else t.langver,
+         tag,
+         value,
+      ))
+
+   strings = list(names)
+   ints = array('q', map(len, strings))
+   ints.extend(body)
+   ints.extend(ops)
+   try:
+      ints = array('i', ints)
+   except OverflowError:
+      pass
+   blob = ''.join(strings).encode('utf-8', 'surrogatepass')
+   header = _HEADER.pack(
+      _MAGIC, _VERSION, ints.itemsize, len(strings), len(records), len(ops), len(blob)
+   )
+   return b''.join((header, ints.tobytes(), blob))
+
+
+def UnpackTokens(buf):
+   buf = memoryview(buf)
+   magic, version, itemsize, nnames, nrecords, nops, nblob = _HEADER.unpack_from(buf, 0)
+   if magic != _MAGIC or version != _VERSION:
+      raise ValueError("Not a packed token buffer")
+   ints = array('i' if itemsize == array('i').itemsize else 'q')
+   ints.frombytes(buf[_HEADER.size:len(buf)-nblob])
+   text = str(buf[len(buf)-nblob:], 'utf-8', 'surrogatepass')
+   ints = ints.tolist()
+   bounds = list(accumulate(ints[:nnames], initial=0))
+   strings = [text[bounds[z]:bounds[z+1]] for z in range(nnames)]
+
+   records = []
+   dict_records = []
+   types = _TOKEN_TYPES
+   langs = dict(_TOKEN_LANGS)
+   langs[_NONE] = None
+   p = nnames + _FIELDS * nrecords
+   body = iter(ints[nnames:p])
+   for nid, T, L, C, O, lang, langver, tag, value in zip(*[body] * _FIELDS):
+      t = Token(
+         strings[nid], types[T], L, C, langs[lang],
+         None if langver == _NONE else langver,
+         value if tag == _DATA_INT else None,
+         O,
+      )
+      if tag == _DATA_DICT:
+         t.data = value # key count, replaced below
+         dict_records.append(t)
+      records.append(t)
+
+   ops = ints[p:p+nops]
+   q = 1
+   def _Read(count):
+      nonlocal q
+      out = [records[r] for r in ops[q:q+count]]
+      q += count
+      return out
+   tokens = _Read(ops[0])
+   for t in dict_records:
+      data = {}
+      for _ in range(t.data):
+         key = strings[ops[q]]
+         kind = ops[q+1]
+         q += 2
+         if kind == _VALUE_NONE:
+            data[key] = None
+         elif kind == _VALUE_STR:
+            data[key] = strings[ops[q]]
+            q += 1
+         elif kind == _VALUE_TOKENS:
+            count = ops[q]
+            q += 1
+            data[key] = _Read(count)
+         else:
+            value = []
+            count = ops[q]
+            q += 1
+            for _ in range(count):
+               sub_count = ops[q]
+               q += 1
+               value.append(_Read(sub_count))
+            data[key] = value
+      t.data = data
+   return tokens
@@ -0,0 +1,154 @@
+"""
+Inverted index of identifier occurrences.
+
+Each file content (file hash) gets, per identifier it uses, the sorted text
+offsets of the occurrences, delta encoded as LEB128 varints: one to three
+bytes per occurrence for typical files instead of a token row. Postings
+are keyed by (name id, file hash), so identical files share their lists
+and a name's postings are one range of the table's primary key.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from util.instrument import Stage
+from util.budget import BoundedMap, FileCost
+from util.sysfs import ReadText
+from util.filetype import TEXT
+
+from .common import TokenType
+from .lang import GetLanguage
+
+# files lexed per worker task
+_CHUNK_SIZE = 64
+
+
+def EncodePostings(offsets) -> bytes:
+   """Delta + varint encoding of ascending offsets."""
+   out = bytearray()
+   prev = 0
+   for offset in offsets:
+      delta = offset - prev
+      prev = offset
+      while delta >= 0x80:
+         out.append((delta & 0x7f) | 0x80)
+         delta >>= 7
+      out.append(delta)
+   return bytes(out)
+
+
+def DecodePostings(buf):
+   """Offsets of an EncodePostings buffer."""
+   out = []
+   prev = 0
+   value = 0
+   shift = 0
+   for b in buf:
+      value |= (b & 0x7f) << shift
+      if b & 0x80:
+         shift += 7
+         continue
+      prev += value
+      out.append(prev)
+      value = 0
+      shift = 0
+   return out
+
+
+def IdentifierOffsets(tokens, keywords=()):
+   """
+   Text offsets of the identifiers of a Lex() token list, by name, in
+   ascending order.
+
+   Args:
+      keywords: words left out, the language module's keywords
+   """
+   occurrences = {}
+   for t in tokens:
+      if t.T == TokenType.SYM and t.N.isidentifier() and t.N not in keywords:
+         offsets = occurrences.get(t.N, None)
+         if offsets is None:
+            occurrences[t.N] = [t.O]
+         else:
+            offsets.append(t.O)
+   return occurrences
+
+
+def FilePostings(tokens, keywords=()):
+   """
+   Rows of DatabaseManager.UpdatePostings for a Lex() token list.
+
+   Returns:
+      list: (name, occurrence count, EncodePostings buffer)
+   """
+   return [
+      (name, len(offsets), EncodePostings(offsets))
+      for name, offsets in IdentifierOffsets(tokens, keywords).items()
+   ]
+
+
+def _FilePostings(full_path):
+   language = GetLanguage(full_path)
+   try:
+      with Stage("read", full_path):
+         text = ReadText(full_path)
+   except (OSError, UnicodeDecodeError):
+      return []
+   with Stage("tokenize", full_path):
+      tokens = language.Lex(text)
+   with Stage("extract", full_path):
+      return FilePostings(tokens, language.keywords)
+
+
+def IndexPostings(db, root_path, workers=None, budget=None):
+   """
+   Store the postings of the file hashes of a DatabaseManager that have
+   none yet (run after UpdateRepository or UpdateRepositories); a content
+   shared by several files, of one or several repositories, is lexed once.
+
+   Args:
+      workers: worker processes lexing the files (default: os.cpu_count(),
+               1 lexes in this process)
+      budget: util.budget.MemoryBudget; worker results not stored yet are
+              held against it (by file size) instead of queueing up
+
+   Returns:
+      int: number of file hashes indexed
+   """
+   done = db.GetPostingHashes()
+   paths = {
+      hid: path for hid, path in db.GetContentPaths(root_path, TEXT).items()
+      if hid not in done and GetLanguage(path) is not None
+   }
+   hids = list(paths)
+   tasks = [paths[hid] for hid in hids]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      db.UpdatePostings(zip(hids, map(_FilePostings, tasks)))
+   elif budget is not None:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         db.UpdatePostings(zip(hids, BoundedMap(executor, _FilePostings, tasks, budget, FileCost)))
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         db.UpdatePostings(zip(hids, executor.map(_FilePostings, tasks, chunksize=_CHUNK_SIZE)))
+   return len(hids)
+
+
+def FindReferences(db, names, match_all=False):
+   """
+   Occurrences of identifiers in the indexed files of a DatabaseManager,
+   those of UpdateRepository and of UpdateRepositories.
+
+   Args:
+      names: identifiers looked up
+      match_all: only files using every one of names (AND), otherwise
+                 files using any of them (OR)
+
+   Returns:
+      list: (repository, filepath, name, offsets) sorted by repository,
+            filepath and name; repository is "" for the files of
+            UpdateRepository
+   """
+   return [
+      (repository, filepath, name, DecodePostings(buf))
+      for repository, filepath, name, buf in db.GetPostings(names, match_all)
+   ]
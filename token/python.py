@@ -1,3 +1,5 @@
+from keyword import kwlist
+
 from .common import (
    Token,
    TokenType,
@@ -16,7 +18,10 @@ from .extract import (
 from .decorate import \
    TokenScope,        \
    TokenDecorate,     \
-   TokenDecorateEnv
+   TokenDecorateEnv,  \
+   TokenLazyChildren
+from .lexer import LexerRules, CompileLexer
+from .merkle import NodeHash
 
 
 def _MergeIndent(env, out):
@@ -28,26 +33,22 @@ def _MergeIndent(env, out):
       env.C += 1
       return True
    # mark as indent
-   L = env.L
-   C = env.C
-   t = Token(env.GetToken(env.i), TokenType.INDENT, L, C)
-   count = 1
+   t = Token(env.GetToken(env.i), TokenType.INDENT, env.L, env.C)
+   count = 8 if t.N == '\t' else 1
    for i in range(env.i+1, env.n):
       token = env.GetToken(i)
       if token == ' ':
          t.N += token
          count += 1
-         C += 1
       elif token == '\t':
          t.N += token
          count += 8
-         C += 1
       else:
          break
    t.data = count
    env.i += len(t.N)
    out.append(t)
-   env.C = C
+   env.C += len(t.N)
    return True
 
 def _ExtractTriquote(env, out):
@@ -59,20 +60,22 @@ def _ExtractTriquote(env, out):
    if env.i+2 >= env.n or env.GetToken(env.i+1) != start_token or env.GetToken(env.i+2) != start_token:
       return False
    t = Token(start_token*3, TokenType.STRING, L, C)
+   C += 3
    for i in range(env.i+3, env.n):
       token = env.GetToken(i)
+      t.N += token
       if token == '\n':
          L += 1
          C = 0
-      t.N += token
-      C += len(token)
+      else:
+         C += len(token)
       if skip:
          skip = False
          continue
       if token == '\\':
          skip = True
       elif token == start_token:
-         if i+2 < env.n and env.GetToken(i+1) == start_token or env.GetToken(i+2) == start_token:
+         if i+2 < env.n and env.GetToken(i+1) == start_token and env.GetToken(i+2) == start_token:
             t.N += start_token * 2
             env.L = L
             env.C = C+2
@@ -87,20 +90,18 @@ def _ExtractTriquote(env, out):
 
 
 def _ExtractLineComment(env, out):
-   C = env.C
-   t = Token('#', TokenType.COMMENT, env.L, C)
+   t = Token('#', TokenType.COMMENT, env.L, env.C)
    out.append(t)
    env.i += 1
    for i in range(env.i, env.n):
       token = env.GetToken(i)
       if token == '\n':
+         # leave line break to MarkLineNumber
          break
       else:
          t.N += token
-         C += len(token)
          env.i += 1
-   env.C += C - env.C
-   env.i += 1
+   env.C += len(t.N)
    return True
 
 
@@ -121,93 +122,104 @@ def Extract(tokens):
    return TokenExtract(env)
 
 
+lang = TokenLang.PYTHON
+
+# reserved words, not identifiers
+keywords = frozenset(kwlist)
+
+# the rules of extract_map_root for the table-driven lexer
+lexer_rules = LexerRules(
+   strings=[
+      ("'''", "'''", True),
+      ('"""', '"""', True),
+      ("'", "'", False),
+      ('"', '"', False),
+   ],
+   line_comments=['#'],
+   indent=True,
+)
+
+
+def Lex(text: str):
+   """Same tokens as Extract(TokenizeText(text)), in one regex pass."""
+   return CompileLexer(lexer_rules).Lex(text)
+
+
 def _DecorateFrom(env, scope):
-   t0 = env.GetToken(env.i)
-   data = {}
-   t = Token("import", TokenType.BLOCK, t0.L, t0.C, TokenLang.PYTHON, 2000, data=data)
    data_path = []
-   data["path"] = data_path
    for i in range(env.i+1, env.n):
       token = env.GetToken(i)
       if token.N == 'import':
          env.i = i+1
          break
+      if token.T == TokenType.BR:
+         # raise ... from ..., yield from ...
+         return False
       if token.T != TokenType.SPACE:
          data_path.append(token)
+   else:
+      return False
+   # the node is named and placed after its "import" token
+   t = Token("import", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2000, data={"path": data_path}, O=token.O)
    return _DecorateImport(env, scope, t)
 
 
 def _DecorateImport(env, scope, t=None):
    if not t:
       t0 = env.GetToken(env.i)
-      t = Token("import", TokenType.BLOCK, t0.L, t0.C, TokenLang.PYTHON, 2000, data={})
+      t = Token("import", TokenType.BLOCK, t0.L, t0.C, TokenLang.PYTHON, 2000, data={}, O=t0.O)
    data = t.data
-   bracket = 0
-   escbr = 0
    data_sym = []
    data["sym"] = data_sym
-   for i in range(env.i+1, env.n):
+   close = -1
+   i = env.i+1
+   while i < env.n:
       token = env.GetToken(i)
-      if token.T == TokenType.BR:
-         if bracket == 0 and escbr == 0:
-            env.i = i+1
-            break
-         escbr = 0
-      if token.N == '(':
-         bracket += 1
-         continue
-      elif token.N == ')':
-         bracket -= 1
-         continue
-      elif token.N == '\\': # TODO: check [\\ \n]
-         escbr = 1
+      if token.T == TokenType.BR and i >= close:
+         break
+      if token.N == '\\': # \ \n
+         i += 2
          continue
-      if (
+      if token.N == '(' and i >= close:
+         close = _FindBracketEnd(env, i)
+      elif (
+         token.N != '(' and
+         token.N != ')' and
          token.T != TokenType.SPACE and
          token.T != TokenType.BR and
          token.T != TokenType.INDENT and
          token.T != TokenType.COMMENT
       ):
          data_sym.append(token)
+      i += 1
+   env.i = min(i+1, env.n)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    return True
 
 
 bracket_pairs = {"(": ")", "[": "]", "{": "}",}
 def _FindBracketEnd(env, i):
-   left = bracket_pairs.keys()
-   right = bracket_pairs.values()
-   bstack = [bracket_pairs[env.GetToken(i).N]]
-   for j in range(i+1, env.n):
-      token = env.GetToken(j)
-      if token.N in left:
-         bstack.append(bracket_pairs[token.N])
-      elif token.N in right:
-         if bstack[-1] == token.N:
-            bstack.pop()
-         else:
-            # TODO: bracket miss match
-            return j+1
-         if len(bstack) == 0:
-            return j+1
-   return env.n
+   """Index after the closing bracket of the one opened at i (see BuildBracketEnds)."""
+   end = env.GetBracketEnds(bracket_pairs)[i]
+   return end if end >= 0 else ~end
+
+
+_EMPTY_LINE_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+   TokenType.COMMENT,
+   TokenType.STRING,
+)
 
 
 def _IsEmptyLine(env, i):
-   empty = True
-   for j in range(i+1, env.n):
+   for j in range(i, env.n):
       token = env.GetToken(j)
       if token.N == '\n':
          return True, j+1
-      if token.T == TokenType.SPACE:
-         continue
-      if token.T == TokenType.BR:
-         continue
-      if token.T == TokenType.INDENT:
-         continue
-      if token.T == TokenType.COMMENT:
-         continue
-      if token.T == TokenType.STRING:
+      if token.T in _EMPTY_LINE_TYPES:
          continue
       return False, i
    return True, env.n
@@ -252,31 +264,36 @@ def _GetScopeJ(env, i):
    if inline:
       return j
 
+   # j starts a line: skip empty lines, the first code line sets the
+   # block indent and the block ends before the next one indented less
+   lines = env.GetLineTable(bracket_pairs, _EMPTY_LINE_TYPES)
    indent_base = -1
    while j < env.n:
-      is_empty_line, nextj = _IsEmptyLine(env, j)
-      if is_empty_line:
-         j = nextj
+      k = lines.line_of[j]
+      if not lines.cont[k]:
+         # on a logical line start, the rest is in the table
+         k = lines.next_code[k]
+         if k < len(lines.starts) and indent_base < 0:
+            indent_base = lines.indent[k]
+            if indent_base == 0:
+               return lines.starts[k]-1
+            k = lines.below[k]
+         while k < len(lines.starts) and lines.indent[k] >= indent_base:
+            k = lines.below[k]
+         return lines.starts[k]-1 if k < len(lines.starts) else env.n
+
+      # inside a logical line of the table, e.g. for an inline if
+      if lines.empty[k]:
+         j = lines.starts[k+1] if k+1 < len(lines.starts) else env.n
          continue
-
-      token = env.GetToken(j)
-      if indent_base < 0 and token.T == TokenType.INDENT:
-         indent_base = token.data
-         j += 1
-      elif (token.T == TokenType.INDENT and indent_base > token.data) or token.T != TokenType.INDENT:
+      indent = lines.indent[k]
+      if indent_base < 0:
+         if indent == 0:
+            return j-1
+         indent_base = indent
+      elif indent < indent_base:
          return j-1
-
-      while j < env.n:
-         token = env.GetToken(j)
-         if token.N in bracket_left:
-            j = _FindBracketEnd(env, j)
-         elif token.N == '\\':
-            j += 2
-         elif token.N == '\n':
-            j += 1
-            break
-         else:
-            j += 1
+      j = lines.GetLogicalEnd(j)
    return env.n
 
 
@@ -292,6 +309,8 @@ def _AbsorbDecorator(data, scope, parent_scope):
          continue
       if token.T == TokenType.BR:
          continue
+      if token.T == TokenType.INDENT:
+         continue
       if token.N == '@':
          last_decorator_j = j+1
          if "decorator" not in data:
@@ -301,7 +320,11 @@ def _AbsorbDecorator(data, scope, parent_scope):
          continue
       break
    if last_decorator_j >= 0:
-      parent_scope.tokens = parent_scope.tokens[:j] + [t for t in parent_scope.tokens[j:] if t.N != '@']
+      # j+1 is the token that stopped the walk, or 0 at the scope start
+      tokens = parent_scope.tokens
+      tail = [t for t in tokens[j+1:] if t.N != '@']
+      del tokens[j+1:]
+      tokens.extend(tail)
    decorator = data.get("decorator", None)
    if decorator:
       decorator.reverse()
@@ -352,12 +375,15 @@ def _ParseClassScope(data, scope):
 
 def _DecorateClass(env, scope):
    j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
    _ParseClassScope(data, subscope)
    _AbsorbDecorator(data, subscope, scope)
-   t = Token("class", TokenType.KLASS, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("class", TokenType.KLASS, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -381,12 +407,55 @@ def _ParseDefScope(data, scope):
 
 def _DecorateDef(env, scope):
    j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
    _ParseDefScope(data, subscope)
    _AbsorbDecorator(data, subscope, scope)
-   t = Token("def", TokenType.FUNC, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("def", TokenType.FUNC, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
+   scope.tokens.append(t)
+   env.i = j
+   return True
+
+
+def _HeaderScope(env, i, j):
+   # raw tokens of a def/class for _Parse*Scope, which stop at the header
+   return TokenScope(env.GetToken(z) for z in range(i, j))
+
+
+def _DecorateClassLazy(env, scope):
+   j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
+   token = env.GetToken(env.i)
+   children = TokenLazyChildren(env, env.i+1, j-1)
+   data = { "children": children }
+   _ParseClassScope(data, _HeaderScope(env, env.i+1, j))
+   decorate_map = env.GetDecorateMap()
+   if any(x.N in decorate_map for bases in data.get("parent", None) or () for x in bases):
+      # a base like "A if c else B" is decorated in the eager tree, so
+      # parse the bases from the decorated children
+      data.pop("parent", None)
+      _ParseClassScope(data, TokenScope(children.Expand()))
+   _AbsorbDecorator(data, None, scope)
+   t = Token("class", TokenType.KLASS, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   scope.tokens.append(t)
+   env.i = j
+   return True
+
+
+def _DecorateDefLazy(env, scope):
+   j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
+   token = env.GetToken(env.i)
+   data = { "children": TokenLazyChildren(env, env.i+1, j-1) }
+   _ParseDefScope(data, _HeaderScope(env, env.i+1, j))
+   _AbsorbDecorator(data, None, scope)
+   t = Token("def", TokenType.FUNC, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -397,9 +466,10 @@ def _DecorateIf(env, scope):
    if j < 0:
       return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("if", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("if", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -407,10 +477,13 @@ def _DecorateIf(env, scope):
 
 def _DecorateElif(env, scope):
    j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("elif", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("elif", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -421,9 +494,10 @@ def _DecorateElse(env, scope):
    if j < 0:
       return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("else", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("else", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -431,10 +505,13 @@ def _DecorateElse(env, scope):
 
 def _DecorateWhile(env, scope):
    j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("while", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("while", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -445,9 +522,10 @@ def _DecorateFor(env, scope):
    if j < 0:
       return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("for", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("for", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -455,10 +533,13 @@ def _DecorateFor(env, scope):
 
 def _DecorateWith(env, scope):
    j = _GetScopeJ(env, env.i)
+   if j < 0:
+      return False
    token = env.GetToken(env.i)
-   subscope = TokenDecorate(env, env.i+1, j-1)
+   subscope = yield env.i+1, j-1
    data = { "children": subscope.tokens }
-   t = Token("with", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("with", TokenType.BLOCK, token.L, token.C, TokenLang.PYTHON, 2, data=data, O=token.O)
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    env.i = j
    return True
@@ -471,7 +552,7 @@ def _DecorateDecorator(env, scope):
       "path": data_path,
       "param": None,
    }
-   t = Token("@", TokenType.MARKER, t0.L, t0.C, TokenLang.PYTHON, 2, data=data)
+   t = Token("@", TokenType.MARKER, t0.L, t0.C, TokenLang.PYTHON, 2, data=data, O=t0.O)
    for i in range(env.i+1, env.n):
       token = env.GetToken(i)
       if token.N == '(':
@@ -480,9 +561,12 @@ def _DecorateDecorator(env, scope):
          env.i = j+1
          break
       if token.N == '\n':
+         env.i = i
          break
       data_path.append(token)
-      env.i = i+1
+   else:
+      env.i = env.n
+   data["hash"] = NodeHash(t)
    scope.tokens.append(t)
    return True
 
@@ -504,8 +588,24 @@ decorate_map_root = {
 }
 
 
-def Decorate(tokens):
-   env = TokenDecorateEnv(tokens, decorate_map_root)
+# def/class children decorated on first access
+decorate_map_lazy = dict(decorate_map_root)
+decorate_map_lazy["class"] = [_DecorateClassLazy]
+decorate_map_lazy["def"] = [_DecorateDefLazy]
+
+
+def Decorate(tokens, lazy=False):
+   """
+   Decorate extract tokens into a tree of scopes.
+
+   Args:
+      lazy: leave def/class children undecorated until first accessed
+            (see TokenLazyChildren); the outline (names, bases,
+            decorators, imports and top-level blocks) is built right away;
+            eager nodes carry their structural hash in data["hash"]
+            (see merkle.NodeHash), lazy def/class nodes do not
+   """
+   env = TokenDecorateEnv(tokens, decorate_map_lazy if lazy else decorate_map_root)
    return TokenDecorate(env).tokens
 
 
@@ -0,0 +1,264 @@
+"""
+Position to scope index of one file: which def/class/block encloses a
+(line, column).
+
+Decorated scopes nest, so their spans cut the file into segments each
+owned by one innermost scope. The index keeps the sorted segment bounds
+and their owners; a lookup is one bisect, and a batch of positions is
+bisected in one map() call. IndexScopes stores the index of every content
+of a repository that has none yet.
+"""
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from util.filetype import TEXT
+
+from .common import TokenType
+from .lang import GetLanguage
+from .symbols import ParseFile
+
+_MAGIC = b'CNSI'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHqqq')
+
+# no scope
+NONE = -1
+
+_LAYOUT_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+)
+
+_SYMBOL_NAMES = ("def", "class")
+
+# files parsed per worker task
+_CHUNK_SIZE = 64
+
+
+def _Key(L, C):
+   return (L << 32) | C
+
+
+def _TokenEnd(t):
+   # position right after a token, which may span lines
+   k = t.N.count('\n')
+   if k:
+      return t.L + k, len(t.N) - t.N.rindex('\n') - 1
+   return t.L, t.C + len(t.N)
+
+
+def _ScopeEnd(t):
+   # end of the last token below a scope node
+   while True:
+      children = t.data.get("children", None) or ()
+      last = None
+      for x in reversed(children):
+         if x.T not in _LAYOUT_TYPES:
+            last = x
+            break
+      if last is None:
+         return _TokenEnd(t)
+      if type(last.data) != dict or "children" not in last.data:
+         return _TokenEnd(last)
+      t = last
+
+
+class ScopeIndex(object):
+   """
+   Attributes:
+      kinds: scope node name per scope id ("def", "class", "if"...)
+      names: qualified name in the file ("A.f") of the def/class scope
+             or, for a block, of the def/class holding it ("" at the top)
+      parents: enclosing scope id or NONE
+      starts, ends: span keys, (L << 32) | C, end excluded
+      bounds, owners: segment k runs from bounds[k] to bounds[k+1] and
+                      is owned by scope owners[k] (NONE: no scope)
+   """
+
+   def __init__(self, kinds, names, parents, starts, ends):
+      self.kinds = kinds
+      self.names = names
+      self.parents = parents
+      self.starts = starts
+      self.ends = ends
+      self.bounds = array('q')
+      self.owners = array('i')
+      self._BuildSegments()
+
+   def __len__(self):
+      return len(self.kinds)
+
+   def _BuildSegments(self):
+      bounds = self.bounds
+      owners = self.owners
+      def _Emit(key, owner):
+         if bounds and bounds[-1] == key:
+            owners[-1] = owner
+         else:
+            bounds.append(key)
+            owners.append(owner)
+
+      starts = self.starts
+      ends = self.ends
+      order = sorted(range(len(self)), key=lambda z: (starts[z], -ends[z]))
+      stack = []
+      for z in order:
+         while stack and ends[stack[-1]] <= starts[z]:
+            y = stack.pop()
+            _Emit(ends[y], stack[-1] if stack else NONE)
+         _Emit(starts[z], z)
+         stack.append(z)
+      while stack:
+         y = stack.pop()
+         _Emit(ends[y], stack[-1] if stack else NONE)
+
+   @classmethod
+   def FromTree(cls, tree):
+      """Index of the scopes (decorated nodes with children) of a tree."""
+      kinds = []
+      names = []
+      parents = array('i')
+      starts = array('q')
+      ends = array('q')
+      # (child iterator, enclosing scope id, enclosing qualified name)
+      stack = [(iter(tree), NONE, "")]
+      while stack:
+         t = next(stack[-1][0], None)
+         if t is None:
+            stack.pop()
+            continue
+         data = t.data
+         if type(data) != dict or "children" not in data:
+            continue
+         _, parent, qualname = stack[-1]
+         name = data.get("name", None)
+         if t.N in _SYMBOL_NAMES and name is not None:
+            qualname = f"{qualname}.{name}" if qualname else name
+         L, C = t.L, t.C
+         for d in data.get("decorator", None) or ():
+            if (d.L, d.C) < (L, C):
+               L, C = d.L, d.C
+         z = len(kinds)
+         kinds.append(t.N)
+         names.append(qualname)
+         parents.append(parent)
+         starts.append(_Key(L, C))
+         ends.append(_Key(*_ScopeEnd(t)))
+         stack.append((iter(data["children"]), z, qualname))
+      return cls(kinds, names, parents, starts, ends)
+
+   def Lookup(self, L, C=0):
+      """Innermost scope id holding position (L, C), or NONE."""
+      k = bisect_right(self.bounds, _Key(L, C)) - 1
+      return NONE if k < 0 else self.owners[k]
+
+   def LookupMany(self, positions):
+      """Lookup of each (L, C) of positions, as a list."""
+      owners = self.owners
+      ks = map(partial(bisect_right, self.bounds), (_Key(L, C) for L, C in positions))
+      return [NONE if k == 0 else owners[k-1] for k in ks]
+
+   def Symbol(self, z):
+      """Innermost def/class scope id enclosing scope z (z itself too)."""
+      while z != NONE and self.kinds[z] not in _SYMBOL_NAMES:
+         z = self.parents[z]
+      return z
+
+   def LookupSymbols(self, positions, module=""):
+      """
+      Qualified name of the innermost def/class holding each (L, C) of
+      positions, module prefixed; the module name (or None without one)
+      outside of any def/class.
+      """
+      out = []
+      for z in self.LookupMany(positions):
+         z = self.Symbol(z)
+         if z == NONE:
+            out.append(module or None)
+         else:
+            out.append(f"{module}.{self.names[z]}" if module else self.names[z])
+      return out
+
+   def Span(self, z):
+      """(L, C, end L, end C) of scope z, end excluded."""
+      start = self.starts[z]
+      end = self.ends[z]
+      return start >> 32, start & 0xffffffff, end >> 32, end & 0xffffffff
+
+   def ToBytes(self):
+      strings = '\n'.join(self.kinds + self.names).encode('utf-8', 'surrogatepass')
+      return b''.join((
+         _HEADER.pack(_MAGIC, _VERSION, 0, len(self), len(self.bounds), len(strings)),
+         self.parents.tobytes(),
+         self.starts.tobytes(),
+         self.ends.tobytes(),
+         self.bounds.tobytes(),
+         self.owners.tobytes(),
+         strings,
+      ))
+
+   @classmethod
+   def FromBytes(cls, buf):
+      magic, version, _, n, m, size = _HEADER.unpack_from(buf)
+      if magic != _MAGIC or version != _VERSION:
+         raise ValueError("Not a scope index buffer")
+      p = _HEADER.size
+      def _Read(typecode, count):
+         nonlocal p
+         a = array(typecode)
+         a.frombytes(buf[p:p + count * a.itemsize])
+         p += count * a.itemsize
+         return a
+
+      index = cls.__new__(cls)
+      index.parents = _Read('i', n)
+      index.starts = _Read('q', n)
+      index.ends = _Read('q', n)
+      index.bounds = _Read('q', m)
+      index.owners = _Read('i', m)
+      strings = bytes(buf[p:p + size]).decode('utf-8', 'surrogatepass').split('\n') if n else []
+      index.kinds = strings[:n]
+      index.names = strings[n:]
+      return index
+
+
+def _FileScopes(task):
+   full_path, cache_path = task
+   tree = ParseFile(full_path, cache_path)
+   return None if tree is None else ScopeIndex.FromTree(tree).ToBytes()
+
+
+def IndexScopes(db, root_path, workers=None, cache_path=None):
+   """
+   Store the scope index of the file hashes of a DatabaseManager that have
+   none yet (run after UpdateRepository or UpdateRepositories).
+
+   Args:
+      workers: worker processes parsing the files (default:
+               os.cpu_count(), 1 parses in this process)
+      cache_path: ParseCache file of the workers, None to always parse
+
+   Returns:
+      int: number of file hashes indexed
+   """
+   done = db.GetScopeHashes()
+   paths = {
+      hid: path for hid, path in db.GetContentPaths(root_path, TEXT).items()
+      if hid not in done and GetLanguage(path) is not None
+   }
+   hids = list(paths)
+   tasks = [(paths[hid], cache_path) for hid in hids]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      results = map(_FileScopes, tasks)
+      db.UpdateScopeIndexes((hid, buf) for hid, buf in zip(hids, results) if buf is not None)
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         results = executor.map(_FileScopes, tasks, chunksize=_CHUNK_SIZE)
+         db.UpdateScopeIndexes((hid, buf) for hid, buf in zip(hids, results) if buf is not None)
+   return len(hids)
@@ -0,0 +1,207 @@
+"""
+Symbol table of a decorated tree: the def/class nodes under their fully
+qualified names (pkg.mod.Class.method), with location, decorators and
+bases, ready for DatabaseManager.UpdateSymbols. IndexSymbols keeps the
+stored symbols of a repository up to date, parsing the files whose
+content changed in a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from util.instrument import Stage
+from util.sysfs import ReadText
+from util.filetype import TEXT
+
+from .common import TokenType, TokenLang
+from .lang import GetLanguage
+from .cache import GetCache
+
+# left out of dotted names
+_LAYOUT_TYPES = (
+   TokenType.SPACE,
+   TokenType.BR,
+   TokenType.INDENT,
+   TokenType.COMMENT,
+)
+
+# nodes named in qualified names; other decorated nodes (blocks) are
+# walked through
+_SYMBOL_NAMES = ("def", "class")
+
+# files parsed per worker task
+_CHUNK_SIZE = 64
+
+
+class Symbol(object):
+   """
+   Args:
+      qualname: fully qualified name, module included
+      name: def/class name
+      kind: TokenType of the node (FUNC, KLASS)
+      container: qualified name of the enclosing def/class or the module
+      L, C: position of the def/class keyword
+      decorators: dotted decorator names, outermost first
+      bases: class bases as written, e.g. "typing.Generic[T]"
+   """
+
+   def __init__(self, qualname, name, kind, container, L, C, decorators=(), bases=()):
+      self.qualname = qualname
+      self.name = name
+      self.kind = kind
+      self.container = container
+      self.L = L
+      self.C = C
+      self.decorators = list(decorators)
+      self.bases = list(bases)
+
+   def __repr__(self):
+      return f'({self.qualname},{self.kind},#{self.L}-#{self.C})'
+
+
+def PackageDirs(paths):
+   """Directories of repository relative paths holding an __init__.py."""
+   return {
+      os.path.dirname(os.path.normpath(path))
+      for path in paths
+      if os.path.splitext(os.path.basename(path))[0] == "__init__"
+   }
+
+
+def ModuleName(path, package_dirs=None):
+   """
+   Dotted module name of a repository relative file path:
+   "pkg/mod.py" -> "pkg.mod", "pkg/__init__.py" -> "pkg".
+
+   Args:
+      package_dirs: PackageDirs of the repository; when given, the name
+                    starts at the outermost package, as imports see it
+                    ("src/pkg/mod.py" -> "pkg.mod")
+   """
+   path = os.path.splitext(os.path.normpath(path))[0]
+   parts = [p for p in path.split(os.sep) if p and p != '.']
+   if package_dirs is not None:
+      # the directories above the file that are packages, innermost first
+      k = len(parts) - 1
+      while k > 0 and os.sep.join(parts[:k]) in package_dirs:
+         k -= 1
+      parts = parts[k:]
+   if parts and parts[-1] == "__init__":
+      parts.pop()
+   return '.'.join(parts)
+
+
+def _Text(tokens):
+   return ''.join(t.N for t in tokens if t.T not in _LAYOUT_TYPES)
+
+
+def ExtractSymbols(tree, module=""):
+   """
+   Symbols of a decorated tree in preorder. def/class nodes inside blocks
+   (if/for/with...) belong to the enclosing def/class.
+
+   Args:
+      tree: Decorate() output
+      module: dotted module name prefixed to every qualified name
+   """
+   out = []
+   # (child iterator, qualified name of the enclosing def/class)
+   stack = [(iter(tree), module)]
+   while stack:
+      children, container = stack[-1]
+      t = next(children, None)
+      if t is None:
+         stack.pop()
+         continue
+      data = t.data
+      if type(data) != dict or "children" not in data:
+         continue
+      name = data.get("name", None)
+      if t.N not in _SYMBOL_NAMES or name is None:
+         stack.append((iter(data["children"]), container))
+         continue
+      qualname = f"{container}.{name}" if container else name
+      out.append(Symbol(
+         qualname,
+         name,
+         t.T,
+         container,
+         t.L,
+         t.C,
+         (_Text(d.data["path"]) for d in data.get("decorator", None) or ()),
+         (_Text(base) for base in data.get("parent", None) or ()),
+      ))
+      stack.append((iter(data["children"]), qualname))
+   return out
+
+
+def IsPythonFile(path):
+   language = GetLanguage(path)
+   return language is not None and language.lang == TokenLang.PYTHON
+
+
+def ModuleNames(paths):
+   """Repository relative path -> dotted module name of the python files."""
+   package_dirs = PackageDirs(paths)
+   return {path: ModuleName(path, package_dirs) for path in paths}
+
+
+def ParseFile(full_path, cache_path=None):
+   """
+   Decorated tree of a file through the ParseCache at cache_path (None to
+   always parse), or None if it cannot be read as text.
+   """
+   language = GetLanguage(full_path)
+   try:
+      with Stage("read", full_path):
+         text = ReadText(full_path)
+   except (OSError, UnicodeDecodeError):
+      return None
+   if cache_path is not None:
+      with Stage("parse", full_path):
+         return GetCache(cache_path).Parse(text, language)
+   with Stage("tokenize", full_path):
+      tokens = language.Lex(text)
+   with Stage("decorate", full_path):
+      return language.Decorate(tokens)
+
+
+def _FileSymbols(task):
+   full_path, module, cache_path = task
+   tree = ParseFile(full_path, cache_path)
+   if tree is None:
+      return []
+   with Stage("extract", full_path):
+      return ExtractSymbols(tree, module)
+
+
+def IndexSymbols(db, root_path, workers=None, cache_path=None, force=False):
+   """
+   Bring the stored symbols of a DatabaseManager up to date with its
+   python files (run after UpdateRepository): the files whose content
+   changed since their symbols were extracted are parsed again; the
+   symbols of removed files go with their records.
+
+   Args:
+      workers: worker processes parsing the stale files (default:
+               os.cpu_count(), 1 parses in this process)
+      cache_path: ParseCache file of the workers, None to always parse
+      force: extract the symbols of every file again, e.g. after packages
+             moved
+
+   Returns:
+      list: files whose symbols were extracted
+   """
+   hashes = {path: hid for path, hid in db.GetFileHashes(TEXT).items() if IsPythonFile(path)}
+   names = ModuleNames(hashes)
+   known = db.GetSymbolSources()
+   stale = [path for path, hid in hashes.items() if force or known.get(path, None) != hid]
+   tasks = [(os.path.join(root_path, path), names[path], cache_path) for path in stale]
+   workers = workers or os.cpu_count() or 1
+   if workers == 1 or len(tasks) < _CHUNK_SIZE:
+      results = map(_FileSymbols, tasks)
+      db.UpdateFileSymbols((path, hashes[path], symbols) for path, symbols in zip(stale, results))
+   else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         results = executor.map(_FileSymbols, tasks, chunksize=_CHUNK_SIZE)
+         db.UpdateFileSymbols((path, hashes[path], symbols) for path, symbols in zip(stale, results))
+   return stale
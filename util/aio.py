@@ -0,0 +1,129 @@
+"""
+asyncio façade of an index (DatabaseManager or ShardedDatabase).
+
+The blocking work runs on bounded thread pools: one for walking, hashing
+and updates, one for queries, so a long repository update never holds the
+threads queries need. Updates report progress as an async iterator and
+stop at the next file when cancelled; the files done so far stay indexed.
+"""
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from .sysfs import IterateFiles, CalculateFileHash
+
+
+class UpdateCancelled(Exception):
+   """Raised in the update thread to stop a cancelled update."""
+
+
+class AsyncIndex(object):
+   """
+   Args:
+      db: DatabaseManager or ShardedDatabase
+      workers: threads walking, hashing and updating
+      query_workers: threads running queries
+      max_updates: updates running at once, the others wait for their turn
+   """
+
+   def __init__(self, db, workers=2, query_workers=4, max_updates=1):
+      self.db = db
+      self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="index")
+      self._query_executor = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="query")
+      self._updates = asyncio.Semaphore(max_updates)
+      self._queries = asyncio.Semaphore(query_workers)
+
+   def close(self):
+      self._executor.shutdown(wait=False, cancel_futures=True)
+      self._query_executor.shutdown(wait=False, cancel_futures=True)
+
+   async def __aenter__(self):
+      return self
+
+   async def __aexit__(self, *args):
+      self.close()
+
+   async def _Run(self, executor, function, *args, **kwargs):
+      return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+
+   async def Walk(self, root_path, exclusion_filter):
+      """IterateFiles in the index pool."""
+      return await self._Run(self._executor, IterateFiles, root_path, exclusion_filter)
+
+   async def Hash(self, filepath, algorithm='sha256'):
+      """CalculateFileHash in the index pool."""
+      return await self._Run(self._executor, CalculateFileHash, filepath, algorithm)
+
+   async def Update(self, root_path, file_list, **kwargs):
+      """
+      Async iterator running db.UpdateRepository in the index pool and
+      yielding (files done, files) progress, at most about a thousand
+      times per update. Leaving the iteration early, or cancelling the task
+      iterating, stops the update at the next file.
+
+      Args:
+         kwargs: more UpdateRepository arguments (trigrams...)
+      """
+      loop = asyncio.get_running_loop()
+      queue = asyncio.Queue()
+      cancelled = threading.Event()
+      last = [-1]
+      def _Progress(done, total):
+         if cancelled.is_set():
+            raise UpdateCancelled()
+         if done == total or done - last[0] >= max(1, total // 1000):
+            last[0] = done
+            loop.call_soon_threadsafe(queue.put_nowait, (done, total))
+
+      async with self._updates:
+         future = loop.run_in_executor(
+            self._executor,
+            partial(self.db.UpdateRepository, root_path, file_list, progress=_Progress, **kwargs),
+         )
+         get = None
+         try:
+            while True:
+               get = asyncio.ensure_future(queue.get())
+               await asyncio.wait((get, future), return_when=asyncio.FIRST_COMPLETED)
+               if not get.done():
+                  break
+               yield get.result()
+            # the progress of the update is queued before its completion
+            while not queue.empty():
+               yield queue.get_nowait()
+            future.result()
+         finally:
+            if get is not None:
+               get.cancel()
+            if not future.done():
+               cancelled.set()
+               # the update pool is free again once the thread stopped
+               await asyncio.wait((future,))
+               future.exception()
+
+   async def Index(self, root_path, file_list, **kwargs):
+      """Update run to its end."""
+      async for _ in self.Update(root_path, file_list, **kwargs):
+         pass
+
+   async def Run(self, function, *args, **kwargs):
+      """
+      function(db, *args) in the index pool, as one of the updates (e.g.
+      token.postings.IndexPostings).
+      """
+      async with self._updates:
+         return await self._Run(self._executor, function, self.db, *args, **kwargs)
+
+   async def Query(self, name, *args):
+      """
+      Result of a query method of db ("FindSymbol"...) in the query pool.
+      A cancelled query is dropped, not interrupted.
+      """
+      async with self._queries:
+         return await self._Run(self._query_executor, getattr(self.db, name), *args)
+
+   async def Call(self, function, *args, **kwargs):
+      """function(db, *args) in the query pool (e.g. token.postings.FindReferences)."""
+      async with self._queries:
+         return await self._Run(self._query_executor, function, self.db, *args, **kwargs)
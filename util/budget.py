@@ -0,0 +1,192 @@
+"""
+Memory budget of an indexing run.
+
+A MemoryBudget counts the approximate bytes held by in-flight work (file
+contents being hashed, results of worker processes not written yet);
+producers Acquire() before taking more and block while the budget is
+spent, which holds back the walker and the hashers. File lists go to a
+SpillList, which keeps a sorted run on disk whenever its buffer outgrows
+its share of the budget and iterates the merged runs in sorted order.
+"""
+import os
+import heapq
+import tempfile
+import threading
+from collections import deque
+
+# approximate bytes of a file path held in a Python list, past its length
+_PATH_OVERHEAD = 80
+
+
+class MemoryBudget(object):
+   """
+   Args:
+      max_bytes: bytes in flight before Acquire() blocks; a single
+                 request larger than that still goes through, alone
+   """
+
+   def __init__(self, max_bytes):
+      self.max_bytes = max_bytes
+      self.used = 0
+      self.peak = 0
+      self._cond = threading.Condition()
+
+   def Acquire(self, n):
+      with self._cond:
+         while self.used and self.used + n > self.max_bytes:
+            self._cond.wait()
+         self.used += n
+         if self.used > self.peak:
+            self.peak = self.used
+
+   def TryAcquire(self, n):
+      """Acquire without blocking; False if that would exceed the budget."""
+      with self._cond:
+         if self.used and self.used + n > self.max_bytes:
+            return False
+         self.used += n
+         if self.used > self.peak:
+            self.peak = self.used
+         return True
+
+   def Release(self, n):
+      with self._cond:
+         self.used -= n
+         self._cond.notify_all()
+
+   def Hold(self, n):
+      """Context manager holding n bytes of the budget."""
+      return _Hold(self, n)
+
+
+class _Hold(object):
+   __slots__ = ("budget", "n")
+
+   def __init__(self, budget, n):
+      self.budget = budget
+      self.n = n
+
+   def __enter__(self):
+      self.budget.Acquire(self.n)
+      return self
+
+   def __exit__(self, *args):
+      self.budget.Release(self.n)
+      return False
+
+
+def _WriteRun(paths):
+   # sorted paths to a temporary file, NUL terminated
+   f = tempfile.TemporaryFile()
+   for path in paths:
+      f.write(path.encode('utf-8', 'surrogateescape'))
+      f.write(b'\0')
+   f.seek(0)
+   return f
+
+
+def _ReadRun(f):
+   f.seek(0)
+   tail = b''
+   while True:
+      chunk = f.read(1 << 16)
+      if not chunk:
+         return
+      parts = (tail + chunk).split(b'\0')
+      tail = parts.pop()
+      for part in parts:
+         yield part.decode('utf-8', 'surrogateescape')
+
+
+class SpillList(object):
+   """
+   Append-only list of file paths within max_bytes of memory; iterates
+   in sorted order, duplicates kept.
+   """
+
+   def __init__(self, max_bytes):
+      self.max_bytes = max_bytes
+      self.buffer = []
+      self.buffer_bytes = 0
+      self.runs = []
+      self.count = 0
+
+   def append(self, path):
+      self.buffer.append(path)
+      self.buffer_bytes += len(path) + _PATH_OVERHEAD
+      self.count += 1
+      if self.buffer_bytes > self.max_bytes:
+         self.Spill()
+
+   def extend(self, paths):
+      for path in paths:
+         self.append(path)
+
+   def Spill(self):
+      """Write the buffer as a sorted run."""
+      if self.buffer:
+         self.buffer.sort()
+         self.runs.append(_WriteRun(self.buffer))
+         self.buffer = []
+         self.buffer_bytes = 0
+
+   def __len__(self):
+      return self.count
+
+   def __iter__(self):
+      self.buffer.sort()
+      return heapq.merge(*(_ReadRun(f) for f in self.runs), iter(list(self.buffer)))
+
+   def Close(self):
+      for f in self.runs:
+         f.close()
+      self.runs = []
+      self.buffer = []
+      self.buffer_bytes = 0
+      self.count = 0
+
+
+def SortedPaths(file_list):
+   """Sorted distinct paths of a list or SpillList, as an iterator."""
+   paths = iter(file_list) if isinstance(file_list, SpillList) else iter(sorted(file_list))
+   last = None
+   for path in paths:
+      if path != last:
+         yield path
+         last = path
+
+
+def FileCost(path):
+   """Bytes a file is expected to hold in memory: its size."""
+   try:
+      return os.path.getsize(path)
+   except OSError:
+      return 0
+
+
+def BoundedMap(executor, fn, tasks, budget, cost):
+   """
+   executor.map(fn, tasks) in order, a task being submitted only once
+   budget holds cost(task) for it until its result is consumed.
+   """
+   pending = deque()
+   try:
+      for task in tasks:
+         n = cost(task)
+         while pending and not budget.TryAcquire(n):
+            future, held = pending.popleft()
+            result = future.result()
+            budget.Release(held)
+            yield result
+         if not pending:
+            budget.Acquire(n)
+         pending.append((executor.submit(fn, task), n))
+      while pending:
+         future, held = pending.popleft()
+         result = future.result()
+         budget.Release(held)
+         yield result
+   finally:
+      for future, held in pending:
+         future.cancel()
+         budget.Release(held)
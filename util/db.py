@@ -118,11 +118,42 @@ conn.close()
 """
 
 import os
+import zlib
+import pickle
 import sqlite3
 from datetime import datetime
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .sysfs import CalculateFileHash, ReadFileWithHash
+from .filetype import ClassifyFile, TEXT, BINARY
+from .trigram import Trigrams, PackTrigrams, UnpackTrigrams
+from .instrument import Stage, Count
+from .budget import MemoryBudget, SortedPaths, FileCost, BoundedMap
+
+# bound parameters per statement, under SQLite's default limit
+_SQL_VARIABLES = 500
+
+# default memory budget of UpdateRepositories, and the bytes a hash task
+# holds without trigrams
+_REPOSITORIES_BUDGET = 256 << 20
+_HASH_COST = 1 << 16
+
+
+def _HashFile(full_path, trigrams):
+   # (mtime, hash, class, bytes when trigrams) of a file, None if it is gone
+   try:
+      with Stage("stat", full_path):
+         mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+      with Stage("hash", full_path):
+         if trigrams:
+            file_hash, data = ReadFileWithHash(full_path)
+         else:
+            file_hash, data = CalculateFileHash(full_path), None
+      return mtime, file_hash, ClassifyFile(full_path, data), data
+   except OSError:
+      return None
 
-from .sysfs import CalculateFileHash
 
 class DatabaseManager:
    def __init__(self, db_path):
@@ -143,9 +174,460 @@ class DatabaseManager:
          cursor.close()
          conn.close()
 
-   def UpdateRepository(self, root_path, file_list):
-      # Create tables if they don't exist
+   def UpdateRepository(self, root_path, file_list, trigrams=False, hashes=None, progress=None, budget=None):
+      """
+      Args:
+         trigrams: keep the trigram index of the file contents up to date
+                   (see util.trigram.Search); files are then hashed from
+                   the bytes indexed
+         hashes: filepath -> file hash already computed by the caller,
+                 used instead of hashing when trigrams are off
+         progress: called with (files done, files) as the files are
+                   processed; an exception it raises stops the update,
+                   the files done so far staying indexed
+         budget: util.budget.MemoryBudget of the update: the file list (a
+                 list or a util.budget.SpillList) and the stored records
+                 are then merge joined in path order instead of loaded
+                 into sets, and file contents read for trigrams are held
+                 against the budget
+      """
+      self._CreateTables()
+
+      # Update config
+      current_timestamp = datetime.now()
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            INSERT OR REPLACE INTO config (key, value, updated_at)
+            VALUES (?, ?, ?)
+         ''', ('root_path', root_path, current_timestamp))
+         
+         cursor.execute('''
+            INSERT OR REPLACE INTO config (key, value, updated_at)
+            VALUES (?, ?, ?)
+         ''', ('last_update', str(current_timestamp), current_timestamp))
+
+      if budget is None:
+         self._UpdateFiles(root_path, file_list, trigrams, hashes, progress)
+      else:
+         self._UpdateFilesBudgeted(root_path, file_list, trigrams, budget, progress)
+
+      # Trigrams of the contents hashed without them
+      if trigrams:
+         with self.GetCursor() as cursor:
+            cursor.execute('''
+               SELECT files.filepath, file_hash_mapping.hid, files.class
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+               WHERE file_hash_mapping.hid NOT IN (SELECT hid FROM trigram_sets)
+            ''')
+            for filepath, hid, file_class in cursor.fetchall():
+               if file_class == BINARY:
+                  self._IndexTrigrams(cursor, hid, None)
+                  continue
+               try:
+                  with open(os.path.join(root_path, filepath), 'rb') as f:
+                     data = f.read()
+               except OSError:
+                  continue
+               self._IndexTrigrams(cursor, hid, data)
+
+      # Clean up orphaned hashes (hashes with no file references)
+      with Stage("gc"), self.GetCursor() as cursor:
+         self._CollectGarbage(cursor)
+
+   def _UpdateFiles(self, root_path, file_list, trigrams, hashes, progress):
+      # Get existing files from database
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT fid, filepath FROM files')
+         existing_files = {row[1]: row[0] for row in cursor.fetchall()}
+
+      # Process current file list
+      current_files = set(file_list)
+      existing_filepaths = set(existing_files.keys())
+
+      # Files to remove (in DB but not in current list)
+      files_to_remove = existing_filepaths - current_files
+
+      # Files to add or update
+      files_to_process = current_files
+
+      # Remove obsolete files
+      if files_to_remove:
+         with self.GetCursor() as cursor:
+            self._RemoveFiles(cursor, list(files_to_remove))
+
+      # Process each file
+      for done, filepath in enumerate(files_to_process):
+         if progress is not None:
+            progress(done, len(files_to_process))
+         full_path = os.path.join(root_path, filepath)
+
+         # Get file modification time, skip if file doesn't exist
+         try:
+            with Stage("stat", filepath):
+               file_mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+         except OSError:
+            continue
+
+         # Check if file needs updating
+         needs_update = True
+         if filepath in existing_files:
+            with self.GetCursor() as cursor:
+               cursor.execute('SELECT ts FROM files WHERE filepath = ?', (filepath,))
+               result = cursor.fetchone()
+               if result and result[0]:
+                  # Parse stored timestamp
+                  stored_ts = datetime.fromisoformat(result[0])
+                  if stored_ts >= file_mtime:
+                     needs_update = False
+
+         if needs_update:
+            # Calculate file hash
+            with Stage("hash", filepath):
+               if trigrams:
+                  file_hash, data = ReadFileWithHash(full_path)
+               elif hashes is not None and filepath in hashes:
+                  file_hash = hashes[filepath]
+               else:
+                  file_hash = CalculateFileHash(full_path)
+            Count("files_hashed")
+            file_class = ClassifyFile(full_path, data if trigrams else None)
+
+            # Insert or update file record
+            with Stage("db_write", filepath), self.GetCursor() as cursor:
+               self._StoreFile(cursor, filepath, file_mtime, file_hash, file_class, data if trigrams else None)
+
+      if progress is not None:
+         progress(len(files_to_process), len(files_to_process))
+
+   def _UpdateFilesBudgeted(self, root_path, file_list, trigrams, budget, progress):
+      # _UpdateFiles as a merge join of the sorted file list with the file
+      # records read in path order (TEXT sorts as str), so neither side is
+      # held in memory
+      total = len(file_list)
+      removed = []
+      def _Remove(filepath):
+         removed.append(filepath)
+         if len(removed) >= _SQL_VARIABLES:
+            with self.GetCursor() as cursor:
+               self._RemoveFiles(cursor, removed)
+            del removed[:]
+
+      conn = sqlite3.connect(self.db_path)
+      try:
+         stored = conn.execute('SELECT filepath, ts FROM files ORDER BY filepath')
+         record = stored.fetchone()
+         for done, filepath in enumerate(SortedPaths(file_list)):
+            if progress is not None:
+               progress(done, total)
+            while record is not None and record[0] < filepath:
+               _Remove(record[0])
+               record = stored.fetchone()
+            stored_ts = None
+            if record is not None and record[0] == filepath:
+               stored_ts = record[1]
+               record = stored.fetchone()
+
+            full_path = os.path.join(root_path, filepath)
+            try:
+               with Stage("stat", filepath):
+                  file_mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+            except OSError:
+               continue
+            if stored_ts and datetime.fromisoformat(stored_ts) >= file_mtime:
+               continue
+
+            # the content read for trigrams is held until it is stored
+            with budget.Hold(FileCost(full_path) if trigrams else 0):
+               with Stage("hash", filepath):
+                  if trigrams:
+                     file_hash, data = ReadFileWithHash(full_path)
+                  else:
+                     file_hash, data = CalculateFileHash(full_path), None
+               file_class = ClassifyFile(full_path, data)
+               Count("files_hashed")
+               with Stage("db_write", filepath), self.GetCursor() as cursor:
+                  self._StoreFile(cursor, filepath, file_mtime, file_hash, file_class, data)
+         while record is not None:
+            _Remove(record[0])
+            record = stored.fetchone()
+      finally:
+         conn.close()
+      if removed:
+         with self.GetCursor() as cursor:
+            self._RemoveFiles(cursor, removed)
+      if progress is not None:
+         progress(total, total)
+
+   def _RemoveFiles(self, cursor, filepaths):
+      for i in range(0, len(filepaths), _SQL_VARIABLES):
+         chunk = filepaths[i:i + _SQL_VARIABLES]
+         placeholders = ','.join('?' * len(chunk))
+         # Delete from file_hash_mapping first (due to foreign key)
+         cursor.execute(f'''
+            DELETE FROM file_hash_mapping
+            WHERE fid IN (
+               SELECT fid FROM files WHERE filepath IN ({placeholders})
+            )
+         ''', chunk)
+
+         # Delete from files table
+         cursor.execute(f'''
+            DELETE FROM files WHERE filepath IN ({placeholders})
+         ''', chunk)
+
+   def _StoreFile(self, cursor, filepath, file_mtime, file_hash, file_class, data=None):
+      # file record, hash and mapping of an updated file, and the trigrams
+      # of its content when data is given; an existing record keeps its
+      # fid, so the rows keyed by it stay until their source hash changes
+      cursor.execute('''
+         INSERT INTO files (filepath, ts, class)
+         VALUES (?, ?, ?)
+         ON CONFLICT(filepath) DO UPDATE SET ts = excluded.ts, class = excluded.class
+      ''', (filepath, file_mtime, file_class))
+
+      # Get the file ID
+      cursor.execute('SELECT fid FROM files WHERE filepath = ?', (filepath,))
+      fid = cursor.fetchone()[0]
+
+      # Insert hash if it doesn't exist
+      cursor.execute('''
+         INSERT OR IGNORE INTO file_hashes (filehash)
+         VALUES (?)
+      ''', (file_hash,))
+
+      # Get hash ID
+      cursor.execute('SELECT hid FROM file_hashes WHERE filehash = ?', (file_hash,))
+      hid = cursor.fetchone()[0]
+
+      # The file_tokens rows of the old content are kept for a delta
+      # update (token.arena.IndexTokens); an earlier replacement not yet
+      # applied keeps its hid, the one with rows
+      cursor.execute('''
+         INSERT OR IGNORE INTO token_replacements (fid, old_hid)
+         SELECT fid, hid FROM file_hash_mapping
+         WHERE fid = ? AND hid != ? AND hid IN (SELECT hid FROM file_arenas)
+      ''', (fid, hid))
+
+      # Remove old mapping if exists
+      cursor.execute('DELETE FROM file_hash_mapping WHERE fid = ?', (fid,))
+
+      # Insert new mapping
+      cursor.execute('''
+         INSERT INTO file_hash_mapping (fid, hid)
+         VALUES (?, ?)
+      ''', (fid, hid))
+
+      if data is not None:
+         self._IndexTrigrams(cursor, hid, None if file_class == BINARY else data)
+
+   def UpdateRepositories(self, repositories, workers=None, trigrams=False, budget=None):
+      """
+      Index several repositories into the content tables they share: each
+      repository only has its own file table (repo_files), so a content
+      found in many of them is hashed into one file hash and tokenized,
+      posted and fingerprinted once by the hash keyed indexers.
+
+      Files of all repositories are hashed concurrently by a thread pool
+      (hashing and reading release the GIL); the rows of each repository
+      are written in one transaction as soon as its files are hashed.
+
+      Args:
+         repositories: (name, root_path, file_list) per repository; the
+                       repositories not listed are left as they are
+         workers: hashing threads (default: os.cpu_count())
+         trigrams: keep the trigram index of the contents up to date
+         budget: util.budget.MemoryBudget bounding the hashed results not
+                 written yet (file contents with trigrams)
+      """
+      self._CreateTables()
+      workers = workers or os.cpu_count() or 1
+      budget = budget or MemoryBudget(_REPOSITORIES_BUDGET)
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT name, rid FROM repositories')
+         rids = dict(cursor.fetchall())
+
+      def _Tasks():
+         # per repository: (repository, None, None) first, then
+         # (repository, filepath, full path) of each file to hash
+         for name, root_path, file_list in repositories:
+            stored = {}
+            rid = rids.get(name, None)
+            if rid is not None:
+               with self.GetCursor() as cursor:
+                  cursor.execute('SELECT filepath, ts FROM repo_files WHERE rid = ?', (rid,))
+                  stored = dict(cursor.fetchall())
+            file_list = set(file_list)
+            repository = (name, root_path, [filepath for filepath in stored if filepath not in file_list])
+            yield repository, None, None
+            for filepath in file_list:
+               full_path = os.path.join(root_path, filepath)
+               ts = stored.get(filepath, None)
+               if ts:
+                  try:
+                     mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+                     if datetime.fromisoformat(ts) >= mtime:
+                        continue
+                  except OSError:
+                     # gone: the hash task drops its row
+                     pass
+               yield repository, filepath, full_path
+
+      def _Hash(task):
+         _, filepath, full_path = task
+         return task, None if filepath is None else _HashFile(full_path, trigrams)
+
+      def _Cost(task):
+         # the contents read for trigrams are in flight until written
+         if task[1] is None:
+            return 0
+         return FileCost(task[2]) if trigrams else _HASH_COST
+
+      # results are written in order, one transaction per repository;
+      # a file is only hashed once the budget holds it
+      with ThreadPoolExecutor(max_workers=workers) as executor, self.GetCursor() as cursor:
+         rid = None
+         for (repository, filepath, _), result in BoundedMap(executor, _Hash, _Tasks(), budget, _Cost):
+            if filepath is None:
+               cursor.connection.commit()
+               name, root_path, removed = repository
+               cursor.execute('''
+                  INSERT INTO repositories (name, root_path, updated_at) VALUES (?, ?, ?)
+                  ON CONFLICT(name) DO UPDATE SET root_path = excluded.root_path, updated_at = excluded.updated_at
+               ''', (name, root_path, datetime.now()))
+               cursor.execute('SELECT rid FROM repositories WHERE name = ?', (name,))
+               rid = cursor.fetchone()[0]
+               cursor.executemany(
+                  'DELETE FROM repo_files WHERE rid = ? AND filepath = ?',
+                  ((rid, removed_path) for removed_path in removed),
+               )
+               continue
+            if result is None:
+               cursor.execute('DELETE FROM repo_files WHERE rid = ? AND filepath = ?', (rid, filepath))
+               continue
+            mtime, file_hash, file_class, data = result
+            with Stage("db_write", filepath):
+               cursor.execute('INSERT OR IGNORE INTO file_hashes (filehash) VALUES (?)', (file_hash,))
+               cursor.execute('SELECT hid FROM file_hashes WHERE filehash = ?', (file_hash,))
+               hid = cursor.fetchone()[0]
+               cursor.execute('''
+                  INSERT OR REPLACE INTO repo_files (rid, filepath, hid, ts, class)
+                  VALUES (?, ?, ?, ?, ?)
+               ''', (rid, filepath, hid, mtime, file_class))
+               if trigrams:
+                  self._IndexTrigrams(cursor, hid, None if file_class == BINARY else data)
+
+      if trigrams:
+         with self.GetCursor() as cursor:
+            cursor.execute('''
+               SELECT repositories.root_path, repo_files.filepath, repo_files.hid, repo_files.class
+               FROM repo_files JOIN repositories ON repositories.rid = repo_files.rid
+               WHERE repo_files.hid NOT IN (SELECT hid FROM trigram_sets)
+            ''')
+            for root_path, filepath, hid, file_class in cursor.fetchall():
+               if file_class == BINARY:
+                  self._IndexTrigrams(cursor, hid, None)
+                  continue
+               try:
+                  with open(os.path.join(root_path, filepath), 'rb') as f:
+                     data = f.read()
+               except OSError:
+                  continue
+               self._IndexTrigrams(cursor, hid, data)
+
+      with self.GetCursor() as cursor:
+         self._CollectGarbage(cursor)
+
+   def RemoveRepository(self, name):
+      """Drop a repository of UpdateRepositories, and the contents only it had."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT rid FROM repositories WHERE name = ?', (name,))
+         row = cursor.fetchone()
+         if row is None:
+            return
+         cursor.execute('DELETE FROM repo_files WHERE rid = ?', (row[0],))
+         cursor.execute('DELETE FROM repositories WHERE rid = ?', (row[0],))
+         self._CollectGarbage(cursor)
+
+   def GetRepositories(self):
+      """name -> root_path of the repositories of UpdateRepositories."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT name, root_path FROM repositories ORDER BY name')
+         return dict(cursor.fetchall())
+
+   def GetRepositoryFileHashes(self, name):
+      """filepath -> hid of the files of a repository."""
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT repo_files.filepath, repo_files.hid
+            FROM repo_files JOIN repositories ON repositories.rid = repo_files.rid
+            WHERE repositories.name = ?
+         ''', (name,))
+         return dict(cursor.fetchall())
+
+   def GetContentPaths(self, root_path=None, file_class=None):
+      """
+      hid -> full path of one file holding the content, for the indexers
+      keyed by file hash: files of UpdateRepository (under root_path, by
+      default the configured one) and of every repository.
+
+      Args:
+         file_class: only the files of this util.filetype class (files
+                     hashed before classes were recorded count as text)
+      """
+      where, params = '', ()
+      if file_class is not None:
+         where, params = 'WHERE IFNULL({}.class, ?) = ?', (TEXT, file_class)
+      with self.GetCursor() as cursor:
+         if root_path is None:
+            cursor.execute("SELECT value FROM config WHERE key = 'root_path'")
+            row = cursor.fetchone()
+            root_path = None if row is None else row[0]
+         paths = {}
+         cursor.execute('''
+            SELECT repositories.root_path, repo_files.filepath, repo_files.hid
+            FROM repo_files JOIN repositories ON repositories.rid = repo_files.rid
+         ''' + where.format('repo_files'), params)
+         for root, filepath, hid in cursor.fetchall():
+            paths[hid] = os.path.join(root, filepath)
+         if root_path is not None:
+            cursor.execute('''
+               SELECT files.filepath, file_hash_mapping.hid
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+            ''' + where.format('files'), params)
+            for filepath, hid in cursor.fetchall():
+               paths[hid] = os.path.join(root_path, filepath)
+         return paths
+
+   def GetContentLocations(self, hids):
+      """
+      hid -> (repository name, filepath) of the files holding each content,
+      sorted; repository is "" for the files of UpdateRepository.
+      """
+      hids = list(hids)
+      out = {}
       with self.GetCursor() as cursor:
+         for i in range(0, len(hids), _SQL_VARIABLES):
+            chunk = hids[i:i + _SQL_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+               SELECT file_hash_mapping.hid, '', files.filepath
+               FROM file_hash_mapping JOIN files ON files.fid = file_hash_mapping.fid
+               WHERE file_hash_mapping.hid IN ({placeholders})
+               UNION ALL
+               SELECT repo_files.hid, repositories.name, repo_files.filepath
+               FROM repo_files JOIN repositories ON repositories.rid = repo_files.rid
+               WHERE repo_files.hid IN ({placeholders})
+               ORDER BY 2, 3
+            ''', chunk + chunk)
+            for hid, name, filepath in cursor.fetchall():
+               out.setdefault(hid, []).append((name, filepath))
+      return out
+
+   def _CreateTables(self):
+      """Create the tables and indexes that do not exist yet."""
+      with self.GetCursor() as cursor:
+         # Readers do not wait for a writer, nor block it
+         cursor.execute('PRAGMA journal_mode=WAL')
          # Config table
          cursor.execute('''
             CREATE TABLE IF NOT EXISTS config (
@@ -159,7 +641,8 @@ class DatabaseManager:
             CREATE TABLE IF NOT EXISTS files (
                fid INTEGER PRIMARY KEY AUTOINCREMENT,
                filepath TEXT UNIQUE NOT NULL,
-               ts TIMESTAMP
+               ts TIMESTAMP,
+               class TEXT
             )
          ''')
          # File hashes table
@@ -195,137 +678,1111 @@ class DatabaseManager:
                 FOREIGN KEY (hid) REFERENCES file_hash(hid)
             )
          ''')
+         # Arena of the file_tokens rows of a file hash (pickled, see
+         # token.arena.TokenArena), the old side of a delta update
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_arenas (
+               hid INTEGER PRIMARY KEY,
+               buf BLOB NOT NULL
+            )
+         ''')
+         # File hash a file had when its content changed, while its
+         # file_tokens rows wait for a delta update to the new one
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_replacements (
+               fid INTEGER PRIMARY KEY,
+               old_hid INTEGER NOT NULL
+            )
+         ''')
+         # Symbols table: def/class nodes by qualified name
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbols (
+               sid INTEGER PRIMARY KEY AUTOINCREMENT,
+               fid INTEGER NOT NULL,
+               qualname TEXT NOT NULL,
+               name TEXT NOT NULL,
+               kind INTEGER NOT NULL,
+               container TEXT NOT NULL,
+               lrow INTEGER NOT NULL,
+               lcol INTEGER NOT NULL,
+               FOREIGN KEY (fid) REFERENCES files(fid) ON DELETE CASCADE
+            )
+         ''')
+         # Symbol decorators and class bases, in source order
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbol_decorators (
+               sid INTEGER NOT NULL,
+               pos INTEGER NOT NULL,
+               name TEXT NOT NULL,
+               PRIMARY KEY (sid, pos),
+               FOREIGN KEY (sid) REFERENCES symbols(sid) ON DELETE CASCADE
+            )
+         ''')
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbol_bases (
+               sid INTEGER NOT NULL,
+               pos INTEGER NOT NULL,
+               name TEXT NOT NULL,
+               PRIMARY KEY (sid, pos),
+               FOREIGN KEY (sid) REFERENCES symbols(sid) ON DELETE CASCADE
+            )
+         ''')
+         # File hash the symbols of a file were extracted from
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbol_sources (
+               fid INTEGER PRIMARY KEY,
+               hid INTEGER NOT NULL
+            )
+         ''')
+         # Call sites: caller and resolved target by qualified name, name
+         # being the last part of the callee as written
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS calls (
+               cid INTEGER PRIMARY KEY AUTOINCREMENT,
+               fid INTEGER NOT NULL,
+               caller TEXT NOT NULL,
+               callee TEXT NOT NULL,
+               name TEXT NOT NULL,
+               target TEXT,
+               lrow INTEGER NOT NULL,
+               lcol INTEGER NOT NULL,
+               local TEXT,
+               FOREIGN KEY (fid) REFERENCES files(fid) ON DELETE CASCADE
+            )
+         ''')
+         # File hash the call sites of a file were extracted from
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS call_sources (
+               fid INTEGER PRIMARY KEY,
+               hid INTEGER NOT NULL
+            )
+         ''')
+         # Position to scope index per file hash (token.scopeindex)
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scope_index (
+               hid INTEGER PRIMARY KEY,
+               buf BLOB NOT NULL,
+               FOREIGN KEY (hid) REFERENCES file_hashes(hid)
+            )
+         ''')
+         # Identifier occurrences per file hash (token.postings): name ids,
+         # and the delta + varint encoded offsets of a name in a content
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS identifiers (
+               iid INTEGER PRIMARY KEY AUTOINCREMENT,
+               name TEXT UNIQUE NOT NULL
+            )
+         ''')
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS postings (
+               iid INTEGER NOT NULL,
+               hid INTEGER NOT NULL,
+               count INTEGER NOT NULL,
+               buf BLOB NOT NULL,
+               PRIMARY KEY (iid, hid)
+            ) WITHOUT ROWID
+         ''')
+         # Trigram index per file hash (util.trigram): the sorted trigram
+         # set of a content, NULL if it is not indexed, and the postings
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trigram_sets (
+               hid INTEGER PRIMARY KEY,
+               buf BLOB
+            )
+         ''')
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trigram_postings (
+               trigram INTEGER NOT NULL,
+               hid INTEGER NOT NULL,
+               PRIMARY KEY (trigram, hid)
+            ) WITHOUT ROWID
+         ''')
+         # Clone detection units (token.clones) per file hash: the file
+         # ("") and its functions, with their winnowed fingerprints
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS clone_units (
+               uid INTEGER PRIMARY KEY AUTOINCREMENT,
+               hid INTEGER NOT NULL,
+               name TEXT NOT NULL,
+               lrow INTEGER NOT NULL,
+               size INTEGER NOT NULL
+            )
+         ''')
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS clone_fingerprints (
+               fp INTEGER NOT NULL,
+               uid INTEGER NOT NULL,
+               PRIMARY KEY (fp, uid)
+            ) WITHOUT ROWID
+         ''')
+         # Repositories sharing the content tables (UpdateRepositories),
+         # each with its own file table
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS repositories (
+               rid INTEGER PRIMARY KEY AUTOINCREMENT,
+               name TEXT UNIQUE NOT NULL,
+               root_path TEXT NOT NULL,
+               updated_at TIMESTAMP
+            )
+         ''')
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS repo_files (
+               rid INTEGER NOT NULL,
+               filepath TEXT NOT NULL,
+               hid INTEGER NOT NULL,
+               ts TIMESTAMP,
+               class TEXT,
+               PRIMARY KEY (rid, filepath)
+            ) WITHOUT ROWID
+         ''')
+         # Module names of the indexed files
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS modules (
+               module TEXT PRIMARY KEY,
+               filepath TEXT NOT NULL
+            )
+         ''')
+         # Import edges by target module name, resolved through modules:
+         # fallback is the module to use when target is not one
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS imports (
+               src TEXT NOT NULL,
+               target TEXT NOT NULL,
+               fallback TEXT,
+               lrow INTEGER NOT NULL
+            )
+         ''')
+         # File hash the import edges of a file were computed from
+         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS import_sources (
+               src TEXT PRIMARY KEY,
+               hid INTEGER NOT NULL
+            )
+         ''')
          # Create indexes for better performance
          cursor.execute('CREATE INDEX IF NOT EXISTS idx_filepath ON files(filepath)')
          cursor.execute('CREATE INDEX IF NOT EXISTS idx_filehash ON file_hashes(filehash)')
          cursor.execute('CREATE INDEX IF NOT EXISTS idx_tokenname ON file_tokens(name)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_token_hid ON file_tokens(hid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_mapping_hid ON file_hash_mapping(hid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_postings_hid ON postings(hid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_repo_file_hid ON repo_files(hid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_clone_unit_hid ON clone_units(hid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_clone_fingerprint_uid ON clone_fingerprints(uid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_qualname ON symbols(qualname)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_name ON symbols(name)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_container ON symbols(container)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_fid ON symbols(fid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_symbol_base ON symbol_bases(name)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_caller ON calls(caller)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_target ON calls(target)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_name ON calls(name)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_fid ON calls(fid)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_import_src ON imports(src)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_import_target ON imports(target)')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_import_fallback ON imports(fallback)')
+         # file class (util.filetype) of indexes created without it; the
+         # files hashed before have none and are taken as text
+         for table in ('files', 'repo_files'):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if 'class' not in [row[1] for row in cursor.fetchall()]:
+               cursor.execute(f'ALTER TABLE {table} ADD COLUMN class TEXT')
+         # call target as resolved within its file, of indexes created
+         # without it; the stored target stands for it
+         cursor.execute('PRAGMA table_info(calls)')
+         if 'local' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE calls ADD COLUMN local TEXT')
+            cursor.execute('UPDATE calls SET local = target')
+         cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_local ON calls(local)')
 
-      # Update config
-      current_timestamp = datetime.now()
+   def _CollectGarbage(self, cursor):
+      """Drop the content rows of the hashes no file of any repository has."""
+      cursor.execute('DROP TABLE IF EXISTS temp.live_hashes')
+      cursor.execute('''
+         CREATE TEMP TABLE live_hashes AS
+         SELECT hid FROM file_hash_mapping UNION SELECT hid FROM repo_files
+      ''')
+      cursor.execute('CREATE INDEX temp.idx_live_hashes ON live_hashes(hid)')
+      cursor.execute('''
+            DELETE FROM token_replacements
+            WHERE fid NOT IN (
+               SELECT fid FROM files
+            )
+      ''')
+      # Trigram postings go through the trigram set of each hash
+      cursor.execute('''
+            SELECT hid, buf FROM trigram_sets
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+            )
+      ''')
+      for hid, buf in cursor.fetchall():
+         if buf is not None:
+            cursor.executemany(
+               'DELETE FROM trigram_postings WHERE trigram = ? AND hid = ?',
+               ((trigram, hid) for trigram in UnpackTrigrams(buf)),
+            )
+         cursor.execute('DELETE FROM trigram_sets WHERE hid = ?', (hid,))
+      cursor.execute('''
+            DELETE FROM file_hashes
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+            )
+      ''')
+      # rows waiting for a delta update stay
+      cursor.execute('''
+            DELETE FROM file_tokens
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+               UNION SELECT old_hid FROM token_replacements
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM file_arenas
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+               UNION SELECT old_hid FROM token_replacements
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM scope_index
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM postings
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM clone_fingerprints
+            WHERE uid IN (
+               SELECT uid FROM clone_units
+               WHERE hid NOT IN (
+                  SELECT hid FROM live_hashes
+               )
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM clone_units
+            WHERE hid NOT IN (
+               SELECT hid FROM live_hashes
+            )
+      ''')
+      # Symbols of removed files, and of replaced file records
+      cursor.execute('''
+            DELETE FROM symbols
+            WHERE fid NOT IN (
+               SELECT fid FROM files
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM symbol_sources
+            WHERE fid NOT IN (
+               SELECT fid FROM files
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM calls
+            WHERE fid NOT IN (
+               SELECT fid FROM files
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM call_sources
+            WHERE fid NOT IN (
+               SELECT fid FROM files
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM symbol_decorators
+            WHERE sid NOT IN (
+               SELECT sid FROM symbols
+            )
+      ''')
+      cursor.execute('''
+            DELETE FROM symbol_bases
+            WHERE sid NOT IN (
+               SELECT sid FROM symbols
+            )
+      ''')
+      cursor.execute('DROP TABLE temp.live_hashes')
+
+   def _IndexTrigrams(self, cursor, hid, data):
+      # data None (a binary) leaves the content without trigrams
+      cursor.execute('SELECT 1 FROM trigram_sets WHERE hid = ?', (hid,))
+      if cursor.fetchone() is not None:
+         return
+      trigrams = None if data is None else Trigrams(data)
+      if trigrams is None:
+         cursor.execute('INSERT INTO trigram_sets (hid, buf) VALUES (?, NULL)', (hid,))
+         return
+      cursor.execute('INSERT INTO trigram_sets (hid, buf) VALUES (?, ?)', (hid, PackTrigrams(trigrams)))
+      cursor.executemany(
+         'INSERT OR IGNORE INTO trigram_postings (trigram, hid) VALUES (?, ?)',
+         ((trigram, hid) for trigram in trigrams),
+      )
+
+   def GetTrigramCandidates(self, groups):
+      """
+      Files that may hold a match of a trigram query, those of
+      UpdateRepository (repository "") and of every repository.
+
+      Args:
+         groups: AND of OR groups of trigram lists; a file is a candidate
+                 when, for every group, it holds all trigrams of one list
+                 of it. Files without a trigram set are always candidates,
+                 binaries never.
+
+      Returns:
+         list: (repository, root_path, filepath) sorted by repository and
+               filepath
+      """
+      where = []
+      params = []
+      for group in groups:
+         alternatives = []
+         for trigrams in group:
+            alternatives.append('SELECT hid FROM (' + ' INTERSECT '.join(
+               'SELECT hid FROM trigram_postings WHERE trigram = ?' for _ in trigrams
+            ) + ')')
+            params.extend(trigrams)
+         where.append('{hid} IN (' + ' UNION '.join(alternatives) + ')')
+      match = ''
+      if where:
+         match = f'''
+            AND (({' AND '.join(where)}) OR {{hid}} NOT IN (
+               SELECT hid FROM trigram_sets WHERE buf IS NOT NULL
+            ))
+         '''
+      query = '''
+         SELECT '', ?, files.filepath FROM files
+         JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+         WHERE files.class IS NOT ?
+      ''' + match.format(hid='file_hash_mapping.hid') + '''
+         UNION ALL
+         SELECT repositories.name, repositories.root_path, repo_files.filepath FROM repo_files
+         JOIN repositories ON repositories.rid = repo_files.rid
+         WHERE repo_files.class IS NOT ?
+      ''' + match.format(hid='repo_files.hid') + ' ORDER BY 1, 3'
       with self.GetCursor() as cursor:
-         cursor.execute('''
-            INSERT OR REPLACE INTO config (key, value, updated_at)
-            VALUES (?, ?, ?)
-         ''', ('root_path', root_path, current_timestamp))
-         
-         cursor.execute('''
-            INSERT OR REPLACE INTO config (key, value, updated_at)
-            VALUES (?, ?, ?)
-         ''', ('last_update', str(current_timestamp), current_timestamp))
+         cursor.execute("SELECT value FROM config WHERE key = 'root_path'")
+         row = cursor.fetchone()
+         root_path = None if row is None else row[0]
+         cursor.execute(query, [root_path, BINARY] + params + [BINARY] + params)
+         return cursor.fetchall()
 
-      # Get existing files from database
+   def GetTokenHashes(self):
+      """Set of the file hashes whose file_tokens rows are stored."""
       with self.GetCursor() as cursor:
-         cursor.execute('SELECT fid, filepath FROM files')
-         existing_files = {row[1]: row[0] for row in cursor.fetchall()}
+         cursor.execute('SELECT hid FROM file_arenas')
+         return {row[0] for row in cursor.fetchall()}
 
-      # Process current file list
-      current_files = set(file_list)
-      existing_filepaths = set(existing_files.keys())
+   def GetTokenReplacements(self):
+      """
+      new hid -> old hid of the changed files whose old content rows
+      wait for a delta update (UpdateFileTokensDelta); only old hids no
+      file of any repository has are given.
+      """
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT file_hash_mapping.hid, token_replacements.old_hid
+            FROM token_replacements
+            JOIN file_hash_mapping ON file_hash_mapping.fid = token_replacements.fid
+            WHERE token_replacements.old_hid NOT IN (SELECT hid FROM file_hash_mapping)
+            AND token_replacements.old_hid NOT IN (SELECT hid FROM repo_files)
+         ''')
+         return dict(cursor.fetchall())
 
-      # Files to remove (in DB but not in current list)
-      files_to_remove = existing_filepaths - current_files
+   def GetFileArena(self, hid):
+      """token.arena.TokenArena stored with the file_tokens rows of a file hash, or None."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT buf FROM file_arenas WHERE hid = ?', (hid,))
+         row = cursor.fetchone()
+      return None if row is None else pickle.loads(zlib.decompress(row[0]))
 
-      # Files to add or update
-      files_to_process = current_files
+   def _StoreArena(self, cursor, hid, arena):
+      # the arena of the rows of hid; the files now holding hid are done
+      # waiting for a delta update
+      cursor.execute(
+         'INSERT OR REPLACE INTO file_arenas (hid, buf) VALUES (?, ?)',
+         (hid, zlib.compress(pickle.dumps(arena, pickle.HIGHEST_PROTOCOL), 1)),
+      )
+      cursor.execute('''
+         DELETE FROM token_replacements
+         WHERE fid IN (SELECT fid FROM file_hash_mapping WHERE hid = ?)
+      ''', (hid,))
 
-      # Remove obsolete files
-      if files_to_remove:
-         with self.GetCursor() as cursor:
-            # Delete from file_hash_mapping first (due to foreign key)
-            placeholders = ','.join('?' * len(files_to_remove))
-            cursor.execute(f'''
-               DELETE FROM file_hash_mapping 
-               WHERE fid IN (
-                  SELECT fid FROM files WHERE filepath IN ({placeholders})
-               )
-            ''', tuple(files_to_remove))
+   def UpdateFileTokens(self, hid, arena):
+      """
+      Replace the file_tokens rows of a file hash with the nodes of a
+      token.arena.TokenArena, pid linking each row to its parent node.
+      """
+      with self.GetCursor() as cursor:
+         cursor.execute('DELETE FROM file_tokens WHERE hid = ?', (hid,))
+         self._StoreArena(cursor, hid, arena)
+         # tids are assigned here so that pids are known before insertion
+         cursor.execute('SELECT COALESCE(MAX(tid), 0) + 1 FROM file_tokens')
+         base_tid = cursor.fetchone()[0]
+         cursor.executemany('''
+            INSERT INTO file_tokens (tid, pid, type, lrow, lcol, hid, name, langid, langv)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+         ''', arena.FileTokenRows(hid, base_tid))
 
-            # Delete from files table
-            cursor.execute(f'''
-               DELETE FROM files WHERE filepath IN ({placeholders})
-            ''', tuple(files_to_remove))
+   def UpdateFileTokensDelta(self, old_hid, new_hid, old_arena, new_arena, reuse):
+      """
+      Store the file_tokens rows of new_hid from those of old_hid: rows
+      of unchanged subtrees are moved over, the others deleted and
+      inserted from new_arena. old_hid must no longer be mapped to a file
+      (see GetTokenReplacements).
 
-      # Process each file
-      for filepath in files_to_process:
-         full_path = os.path.join(root_path, filepath)
+      Args:
+         reuse: (old node, new node, line delta) of the unchanged subtrees
+                (see token.merkle.ReusableSubtrees)
 
-         # Skip if file doesn't exist
-         if not os.path.exists(full_path):
-            continue
+      Returns:
+         int: number of rows kept
+      """
+      kept = 0
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT tid, pid, type, lrow, lcol, name FROM file_tokens WHERE hid = ?', (old_hid,))
+         old_tids = old_arena.MatchFileTokenRows(cursor.fetchall())
+         tids = [0] * len(new_arena)
+         roots = []
+         for y, z, dL in reuse:
+            end = old_arena.SubtreeEnd(y)
+            if min(old_tids[y:end]) < 0:
+               # rows not found: rewritten instead
+               continue
+            subtree = [tid for tid in old_tids[y:end] if tid > 0]
+            # one UPDATE per run of consecutive tids
+            subtree.sort()
+            start = prev = subtree[0]
+            for tid in subtree[1:] + [None]:
+               if tid != prev + 1:
+                  cursor.execute(
+                     'UPDATE file_tokens SET hid = ?, lrow = lrow + ? WHERE hid = ? AND tid BETWEEN ? AND ?',
+                     (new_hid, dL, old_hid, start, prev),
+                  )
+                  kept += cursor.rowcount
+                  start = tid
+               prev = tid
+            for d in range(end - y):
+               tids[z+d] = -old_tids[y+d]
+            roots.append((z, old_tids[y]))
+         cursor.execute('DELETE FROM file_tokens WHERE hid = ?', (old_hid,))
+         cursor.execute('DELETE FROM file_arenas WHERE hid = ?', (old_hid,))
+         self._StoreArena(cursor, new_hid, new_arena)
 
-         # Get file modification time
-         file_mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+         cursor.execute('SELECT COALESCE(MAX(tid), 0) + 1 FROM file_tokens')
+         base_tid = cursor.fetchone()[0]
+         for z in range(len(tids)):
+            if tids[z] == 0:
+               tids[z] = base_tid + z
+         # reused subtree roots under a rewritten parent
+         cursor.executemany(
+            'UPDATE file_tokens SET pid = ? WHERE tid = ?',
+            (
+               (None if new_arena.parent[z] < 0 else abs(tids[new_arena.parent[z]]), tid)
+               for z, tid in roots
+            ),
+         )
+         cursor.executemany('''
+            INSERT INTO file_tokens (tid, pid, type, lrow, lcol, hid, name, langid, langv)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+         ''', new_arena.FileTokenRows(new_hid, base_tid, tids))
+      return kept
 
-         # Check if file needs updating
-         needs_update = True
-         if filepath in existing_files:
-            with self.GetCursor() as cursor:
-               cursor.execute('SELECT ts FROM files WHERE filepath = ?', (filepath,))
-               result = cursor.fetchone()
-               if result and result[0]:
-                  # Parse stored timestamp
-                  stored_ts = datetime.fromisoformat(result[0])
-                  if stored_ts >= file_mtime:
-                     needs_update = False
+   def UpdateScopeIndex(self, hid, buf):
+      """Store the ScopeIndex.ToBytes() buffer of a file hash."""
+      self.UpdateScopeIndexes([(hid, buf)])
 
-         if needs_update:
-            # Calculate file hash
-            file_hash = CalculateFileHash(full_path)
+   def GetScopeHashes(self):
+      """File hashes whose scope index is stored."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT hid FROM scope_index')
+         return {row[0] for row in cursor.fetchall()}
 
-            # Insert or update file record
-            with self.GetCursor() as cursor:
-               cursor.execute('''
-                  INSERT OR REPLACE INTO files (filepath, ts)
-                  VALUES (?, ?)
-               ''', (filepath, file_mtime))
+   def UpdateScopeIndexes(self, entries):
+      """Store (hid, ScopeIndex.ToBytes() buffer) entries in one transaction."""
+      with self.GetCursor() as cursor:
+         cursor.executemany('INSERT OR REPLACE INTO scope_index (hid, buf) VALUES (?, ?)', entries)
 
-               # Get the file ID
-               cursor.execute('SELECT fid FROM files WHERE filepath = ?', (filepath,))
-               fid = cursor.fetchone()[0]
+   def GetScopeIndex(self, filepath):
+      """ScopeIndex buffer of a file (see ScopeIndex.FromBytes), or None."""
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT scope_index.buf FROM files
+            JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+            JOIN scope_index ON scope_index.hid = file_hash_mapping.hid
+            WHERE files.filepath = ?
+         ''', (filepath,))
+         row = cursor.fetchone()
+         return None if row is None else row[0]
 
-               # Insert hash if it doesn't exist
-               cursor.execute('''
-                  INSERT OR IGNORE INTO file_hashes (filehash)
-                  VALUES (?)
-               ''', (file_hash,))
+   def UpdateSymbols(self, filepath, symbols):
+      """
+      Replace the symbols of a file with token.symbols.ExtractSymbols
+      output of its current content; run after UpdateRepository for the
+      files it updated.
+      """
+      self.UpdateFileSymbols([(filepath, None, symbols)])
 
-               # Get hash ID
-               cursor.execute('SELECT hid FROM file_hashes WHERE filehash = ?', (file_hash,))
-               hid = cursor.fetchone()[0]
+   def GetSymbolSources(self):
+      """filepath -> hid the stored symbols of a file come from."""
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT files.filepath, symbol_sources.hid
+            FROM symbol_sources JOIN files ON files.fid = symbol_sources.fid
+         ''')
+         return dict(cursor.fetchall())
 
-               # Remove old mapping if exists
-               cursor.execute('DELETE FROM file_hash_mapping WHERE fid = ?', (fid,))
+   def UpdateFileSymbols(self, entries):
+      """
+      Replace the symbols of files in one transaction.
 
-               # Insert new mapping
+      Args:
+         entries: (filepath, hid, symbols) per file, symbols being
+                  token.symbols.ExtractSymbols output of the content hid
+                  (None: the current content of the file)
+      """
+      with self.GetCursor() as cursor:
+         for filepath, hid, symbols in entries:
+            cursor.execute('''
+               SELECT files.fid, file_hash_mapping.hid
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+               WHERE files.filepath = ?
+            ''', (filepath,))
+            row = cursor.fetchone()
+            if row is None:
+               continue
+            fid = row[0]
+            cursor.execute('''
+               DELETE FROM symbol_decorators
+               WHERE sid IN (SELECT sid FROM symbols WHERE fid = ?)
+            ''', (fid,))
+            cursor.execute('''
+               DELETE FROM symbol_bases
+               WHERE sid IN (SELECT sid FROM symbols WHERE fid = ?)
+            ''', (fid,))
+            cursor.execute('DELETE FROM symbols WHERE fid = ?', (fid,))
+            for symbol in symbols:
                cursor.execute('''
-                  INSERT INTO file_hash_mapping (fid, hid)
-                  VALUES (?, ?)
-               ''', (fid, hid))
+                  INSERT INTO symbols (fid, qualname, name, kind, container, lrow, lcol)
+                  VALUES (?, ?, ?, ?, ?, ?, ?)
+               ''', (
+                  fid,
+                  symbol.qualname,
+                  symbol.name,
+                  symbol.kind.value,
+                  symbol.container,
+                  symbol.L,
+                  symbol.C,
+               ))
+               sid = cursor.lastrowid
+               cursor.executemany(
+                  'INSERT INTO symbol_decorators (sid, pos, name) VALUES (?, ?, ?)',
+                  ((sid, pos, name) for pos, name in enumerate(symbol.decorators)),
+               )
+               cursor.executemany(
+                  'INSERT INTO symbol_bases (sid, pos, name) VALUES (?, ?, ?)',
+                  ((sid, pos, name) for pos, name in enumerate(symbol.bases)),
+               )
+            cursor.execute(
+               'INSERT OR REPLACE INTO symbol_sources (fid, hid) VALUES (?, ?)',
+               (fid, row[1] if hid is None else hid),
+            )
 
-      # Clean up orphaned hashes (hashes with no file references)
+   def GetSymbolTable(self):
+      """
+      Every symbol, for a resident symbol table.
+
+      Returns:
+         (rows, bases): rows are (sid, filepath, qualname, kind, lrow,
+         lcol, name, container) ordered as FindSymbol results, bases
+         (sid, base name) in source order
+      """
       with self.GetCursor() as cursor:
          cursor.execute('''
-               DELETE FROM file_hashes
-               WHERE hid NOT IN (
-                  SELECT DISTINCT hid FROM file_hash_mapping
-               )
+            SELECT symbols.sid, files.filepath, symbols.qualname, symbols.kind,
+                   symbols.lrow, symbols.lcol, symbols.name, symbols.container
+            FROM symbols JOIN files ON files.fid = symbols.fid
+            ORDER BY files.filepath, symbols.lrow
          ''')
+         rows = cursor.fetchall()
+         cursor.execute('SELECT sid, name FROM symbol_bases ORDER BY sid, pos')
+         return rows, cursor.fetchall()
+
+   def _QuerySymbols(self, where, params):
+      with self.GetCursor() as cursor:
+         cursor.execute(f'''
+            SELECT files.filepath, symbols.qualname, symbols.kind, symbols.lrow, symbols.lcol
+            FROM symbols JOIN files ON files.fid = symbols.fid
+            WHERE {where}
+            ORDER BY files.filepath, symbols.lrow
+         ''', params)
+         return cursor.fetchall()
+
+   def FindSymbol(self, qualname):
+      """
+      Definitions of a qualified name ("pkg.mod.Class.method").
+
+      Returns:
+         list: (filepath, qualname, kind, lrow, lcol) rows
+      """
+      return self._QuerySymbols('symbols.qualname = ?', (qualname,))
+
+   def FindSymbolsByName(self, name):
+      """Definitions of an unqualified def/class name, as FindSymbol."""
+      return self._QuerySymbols('symbols.name = ?', (name,))
+
+   def ListMembers(self, qualname):
+      """def/class nodes directly inside a class, function or module."""
+      return self._QuerySymbols('symbols.container = ?', (qualname,))
+
+   def FindSubclasses(self, base):
+      """Classes listing base (as written, e.g. "mod.Base") as a base."""
+      return self._QuerySymbols(
+         'symbols.sid IN (SELECT sid FROM symbol_bases WHERE name = ?)',
+         (base,),
+      )
+
+   def UpdateCalls(self, filepath, calls):
+      """
+      Replace the call sites of a file with token.calls.ExtractCalls
+      output of its current content; run after UpdateRepository for the
+      files it updated.
+      """
+      self.UpdateFileCalls([(filepath, None, calls)])
+
+   def GetCallSources(self):
+      """filepath -> hid the stored call sites of a file come from."""
+      with self.GetCursor() as cursor:
          cursor.execute('''
-               DELETE FROM file_tokens
-               WHERE hid NOT IN (
-                  SELECT DISTINCT hid FROM file_hash_mapping
+            SELECT files.filepath, call_sources.hid
+            FROM call_sources JOIN files ON files.fid = call_sources.fid
+         ''')
+         return dict(cursor.fetchall())
+
+   def UpdateFileCalls(self, entries):
+      """
+      Replace the call sites of files in one transaction.
+
+      Args:
+         entries: (filepath, hid, calls) per file, calls being
+                  token.calls.ExtractCalls output of the content hid
+                  (None: the current content of the file)
+      """
+      with self.GetCursor() as cursor:
+         for filepath, hid, calls in entries:
+            cursor.execute('''
+               SELECT files.fid, file_hash_mapping.hid
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+               WHERE files.filepath = ?
+            ''', (filepath,))
+            row = cursor.fetchone()
+            if row is None:
+               continue
+            fid = row[0]
+            cursor.execute('DELETE FROM calls WHERE fid = ?', (fid,))
+            cursor.executemany('''
+               INSERT INTO calls (fid, caller, callee, name, target, lrow, lcol, local)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+               (fid, c.caller, c.callee, c.callee.rpartition('.')[2], c.target, c.L, c.C, c.local)
+               for c in calls
+            ))
+            cursor.execute(
+               'INSERT OR REPLACE INTO call_sources (fid, hid) VALUES (?, ?)',
+               (fid, row[1] if hid is None else hid),
+            )
+
+   def GetCallTargets(self):
+      """
+      Distinct (local target, target) of the stored call sites: the
+      target as resolved within the file and across modules.
+      """
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT DISTINCT local, target FROM calls WHERE local IS NOT NULL')
+         return cursor.fetchall()
+
+   def UpdateCallTargets(self, targets):
+      """Set the target of the call sites of each (local target, target) in one transaction."""
+      with self.GetCursor() as cursor:
+         cursor.executemany(
+            'UPDATE calls SET target = ? WHERE local = ?',
+            ((target, local) for local, target in targets),
+         )
+
+   def _QueryCalls(self, where, params):
+      with self.GetCursor() as cursor:
+         cursor.execute(f'''
+            SELECT files.filepath, calls.caller, calls.callee, calls.target, calls.lrow, calls.lcol
+            FROM calls JOIN files ON files.fid = calls.fid
+            WHERE {where}
+            ORDER BY files.filepath, calls.lrow, calls.lcol
+         ''', params)
+         return cursor.fetchall()
+
+   def FindCallers(self, qualname):
+      """
+      Call sites resolved to a qualified name.
+
+      Returns:
+         list: (filepath, caller, callee, target, lrow, lcol) rows
+      """
+      return self._QueryCalls('calls.target = ?', (qualname,))
+
+   def FindCallees(self, qualname):
+      """Call sites in the body of a def/class or module, as FindCallers."""
+      return self._QueryCalls('calls.caller = ?', (qualname,))
+
+   def FindUnresolvedCalls(self, name):
+      """Unresolved call sites of a bare name ("join" of "x.join()")."""
+      return self._QueryCalls('calls.name = ? AND calls.target IS NULL', (name,))
+
+   def GetPostingHashes(self):
+      """File hashes whose identifier postings are stored."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT DISTINCT hid FROM postings')
+         return {row[0] for row in cursor.fetchall()}
+
+   def UpdatePostings(self, entries):
+      """
+      Replace the identifier postings of file hashes in one transaction.
+
+      Args:
+         entries: (hid, rows) per file hash, rows being
+                  token.postings.FilePostings output
+      """
+      with self.GetCursor() as cursor:
+         for hid, rows in entries:
+            cursor.execute('DELETE FROM postings WHERE hid = ?', (hid,))
+            names = [name for name, _, _ in rows]
+            cursor.executemany('INSERT OR IGNORE INTO identifiers (name) VALUES (?)', ((name,) for name in names))
+            iids = {}
+            for k in range(0, len(names), _SQL_VARIABLES):
+               chunk = names[k:k + _SQL_VARIABLES]
+               cursor.execute(
+                  f'SELECT name, iid FROM identifiers WHERE name IN ({",".join("?" * len(chunk))})',
+                  chunk,
+               )
+               iids.update(cursor.fetchall())
+            cursor.executemany(
+               'INSERT INTO postings (iid, hid, count, buf) VALUES (?, ?, ?, ?)',
+               ((iids[name], hid, count, buf) for name, count, buf in rows),
+            )
+
+   def GetIdentifiers(self):
+      """name -> iid of the interned identifier names."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT name, iid FROM identifiers')
+         return dict(cursor.fetchall())
+
+   def GetPostings(self, names, match_all=False):
+      """
+      Postings of identifiers expanded to the files holding them, the
+      files of UpdateRepository (repository "") and of every repository.
+
+      Args:
+         match_all: only files using every one of names
+
+      Returns:
+         list: (repository, filepath, name, postings buffer) sorted by
+               repository, filepath and name
+      """
+      names = sorted(set(names))
+      if not names:
+         return []
+      with self.GetCursor() as cursor:
+         cursor.execute(
+            f'SELECT iid FROM identifiers WHERE name IN ({",".join("?" * len(names))})',
+            names,
+         )
+         iids = [row[0] for row in cursor.fetchall()]
+         if not iids or match_all and len(iids) < len(names):
+            return []
+         where = f'postings.iid IN ({",".join("?" * len(iids))})'
+         params = list(iids)
+         if match_all and len(iids) > 1:
+            # hashes holding every name, intersected through the (iid, hid) key
+            where += ' AND postings.hid IN (' + ' INTERSECT '.join(
+               'SELECT hid FROM postings WHERE iid = ?' for _ in iids
+            ) + ')'
+            params += iids
+         cursor.execute(f'''
+            SELECT '', files.filepath, identifiers.name, postings.buf
+            FROM postings
+            JOIN identifiers ON identifiers.iid = postings.iid
+            JOIN file_hash_mapping ON file_hash_mapping.hid = postings.hid
+            JOIN files ON files.fid = file_hash_mapping.fid
+            WHERE {where}
+            UNION ALL
+            SELECT repositories.name, repo_files.filepath, identifiers.name, postings.buf
+            FROM postings
+            JOIN identifiers ON identifiers.iid = postings.iid
+            JOIN repo_files ON repo_files.hid = postings.hid
+            JOIN repositories ON repositories.rid = repo_files.rid
+            WHERE {where}
+            ORDER BY 1, 2, 3
+         ''', params + params)
+         return cursor.fetchall()
+
+   def GetCloneHashes(self):
+      """File hashes whose clone units are stored."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT DISTINCT hid FROM clone_units')
+         return {row[0] for row in cursor.fetchall()}
+
+   def UpdateCloneUnits(self, entries):
+      """
+      Replace the clone units of file hashes in one transaction.
+
+      Args:
+         entries: (hid, units) per file hash, units being
+                  token.clones.CloneUnits output
+      """
+      with self.GetCursor() as cursor:
+         for hid, units in entries:
+            cursor.execute('''
+               DELETE FROM clone_fingerprints
+               WHERE uid IN (SELECT uid FROM clone_units WHERE hid = ?)
+            ''', (hid,))
+            cursor.execute('DELETE FROM clone_units WHERE hid = ?', (hid,))
+            for name, L, fingerprints in units:
+               cursor.execute(
+                  'INSERT INTO clone_units (hid, name, lrow, size) VALUES (?, ?, ?, ?)',
+                  (hid, name, L, len(fingerprints)),
+               )
+               uid = cursor.lastrowid
+               cursor.executemany(
+                  'INSERT INTO clone_fingerprints (fp, uid) VALUES (?, ?)',
+                  ((fp, uid) for fp in fingerprints),
                )
+
+   def IterCloneFingerprints(self):
+      """(fingerprint, uid) of every clone unit, ordered by fingerprint."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT fp, uid FROM clone_fingerprints ORDER BY fp')
+         yield from cursor
+
+   def GetCloneUnits(self, uids):
+      """uid -> (hid, name, lrow, size) of clone units."""
+      uids = list(uids)
+      out = {}
+      with self.GetCursor() as cursor:
+         for i in range(0, len(uids), _SQL_VARIABLES):
+            chunk = uids[i:i + _SQL_VARIABLES]
+            cursor.execute(
+               f'SELECT uid, hid, name, lrow, size FROM clone_units WHERE uid IN ({",".join("?" * len(chunk))})',
+               chunk,
+            )
+            out.update((row[0], row[1:]) for row in cursor.fetchall())
+      return out
+
+   def GetClonePairs(self, min_similarity, max_frequency):
+      """
+      Units sharing fingerprints, through a join on the fingerprint key
+      (see token.clones.ClonePairs).
+
+      Returns:
+         list: (repository, filepath, name, lrow) of both units and the
+               similarity; a content is located at its first file, by
+               repository ("" for UpdateRepository) and filepath
+      """
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            WITH locations AS (
+               SELECT '' AS repository, files.filepath AS filepath, file_hash_mapping.hid AS hid
+               FROM file_hash_mapping JOIN files ON files.fid = file_hash_mapping.fid
+               UNION ALL
+               SELECT repositories.name, repo_files.filepath, repo_files.hid
+               FROM repo_files JOIN repositories ON repositories.rid = repo_files.rid
+            ),
+            common AS (
+               SELECT fp FROM clone_fingerprints
+               GROUP BY fp HAVING COUNT(*) BETWEEN 2 AND ?
+            ),
+            shared AS (
+               SELECT a.uid AS a, b.uid AS b, COUNT(*) AS n
+               FROM common
+               JOIN clone_fingerprints AS a ON a.fp = common.fp
+               JOIN clone_fingerprints AS b ON b.fp = common.fp AND a.uid < b.uid
+               GROUP BY a.uid, b.uid
+            ),
+            similar AS (
+               SELECT ua.hid AS hid_a, ua.name AS name_a, ua.lrow AS lrow_a,
+                      ub.hid AS hid_b, ub.name AS name_b, ub.lrow AS lrow_b,
+                      shared.n * 1.0 / (ua.size + ub.size - shared.n) AS similarity
+               FROM shared
+               JOIN clone_units AS ua ON ua.uid = shared.a
+               JOIN clone_units AS ub ON ub.uid = shared.b
+               WHERE (ua.name = '') = (ub.name = '')
+               -- a def holds the fingerprints of the defs nested in it
+               AND NOT (ua.hid = ub.hid AND (
+                  substr(ub.name, 1, length(ua.name) + 1) = ua.name || '.'
+                  OR substr(ua.name, 1, length(ub.name) + 1) = ub.name || '.'
+               ))
+            )
+            SELECT
+               (SELECT repository FROM locations WHERE hid = similar.hid_a ORDER BY repository, filepath LIMIT 1),
+               (SELECT filepath FROM locations WHERE hid = similar.hid_a ORDER BY repository, filepath LIMIT 1),
+               name_a, lrow_a,
+               (SELECT repository FROM locations WHERE hid = similar.hid_b ORDER BY repository, filepath LIMIT 1),
+               (SELECT filepath FROM locations WHERE hid = similar.hid_b ORDER BY repository, filepath LIMIT 1),
+               name_b, lrow_b,
+               similarity
+            FROM similar
+            WHERE similarity >= ?
+            ORDER BY similarity DESC
+         ''', (max_frequency, min_similarity))
+         return cursor.fetchall()
+
+   def GetRootPath(self):
+      """root_path of the last UpdateRepository, or None."""
+      with self.GetCursor() as cursor:
+         cursor.execute("SELECT value FROM config WHERE key = 'root_path'")
+         row = cursor.fetchone()
+         return None if row is None else row[0]
+
+   def GetFileRecords(self):
+      """filepath -> (timestamp, file hash) of the indexed files."""
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT files.filepath, files.ts, file_hashes.filehash
+            FROM files
+            JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+            JOIN file_hashes ON file_hashes.hid = file_hash_mapping.hid
          ''')
+         return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+   def GetFileHashes(self, file_class=None):
+      """
+      filepath -> hid of the indexed files, or of the ones of a
+      util.filetype class (see GetContentPaths).
+      """
+      with self.GetCursor() as cursor:
+         if file_class is None:
+            cursor.execute('''
+               SELECT files.filepath, file_hash_mapping.hid
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+            ''')
+         else:
+            cursor.execute('''
+               SELECT files.filepath, file_hash_mapping.hid
+               FROM files JOIN file_hash_mapping ON file_hash_mapping.fid = files.fid
+               WHERE IFNULL(files.class, ?) = ?
+            ''', (TEXT, file_class))
+         return dict(cursor.fetchall())
+
+   def UpdateModules(self, modules):
+      """Replace the module table with a module name -> filepath dict."""
+      with self.GetCursor() as cursor:
+         cursor.execute('DELETE FROM modules')
+         cursor.executemany('INSERT INTO modules (module, filepath) VALUES (?, ?)', modules.items())
+
+   def GetModules(self):
+      """module name -> filepath of the module table."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT module, filepath FROM modules')
+         return dict(cursor.fetchall())
+
+   def GetImportTargets(self):
+      """(importing file, target, fallback) of every stored import edge."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT src, target, fallback FROM imports')
+         return cursor.fetchall()
+
+   def GetImportSources(self):
+      """filepath -> hid the stored import edges of a file come from."""
+      with self.GetCursor() as cursor:
+         cursor.execute('SELECT src, hid FROM import_sources')
+         return dict(cursor.fetchall())
+
+   def UpdateImports(self, entries, removed=()):
+      """
+      Replace the import edges of files in one transaction.
+
+      Args:
+         entries: (filepath, hid, edges) per file, edges being
+                  token.imports.ResolveImports output
+         removed: files whose edges are dropped
+      """
+      with self.GetCursor() as cursor:
+         for src in removed:
+            cursor.execute('DELETE FROM imports WHERE src = ?', (src,))
+            cursor.execute('DELETE FROM import_sources WHERE src = ?', (src,))
+         for src, hid, edges in entries:
+            cursor.execute('DELETE FROM imports WHERE src = ?', (src,))
+            cursor.executemany(
+               'INSERT INTO imports (src, target, fallback, lrow) VALUES (?, ?, ?, ?)',
+               ((src, target, fallback, L) for target, fallback, L in edges),
+            )
+            cursor.execute('INSERT OR REPLACE INTO import_sources (src, hid) VALUES (?, ?)', (src, hid))
+
+   def GetImportEdges(self, srcs=None):
+      """
+      (importing file, imported file) pairs of the imports that resolve to
+      an indexed file.
+
+      Args:
+         srcs: importing files to restrict to, None for all
+      """
+      query = '''
+         SELECT DISTINCT imports.src, COALESCE(target.filepath, fallback.filepath)
+         FROM imports
+         LEFT JOIN modules AS target ON target.module = imports.target
+         LEFT JOIN modules AS fallback ON fallback.module = imports.fallback
+         WHERE COALESCE(target.filepath, fallback.filepath) IS NOT NULL
+      '''
+      with self.GetCursor() as cursor:
+         if srcs is None:
+            cursor.execute(query)
+            return cursor.fetchall()
+         edges = []
+         for src in srcs:
+            cursor.execute(query + ' AND imports.src = ?', (src,))
+            edges.extend(cursor.fetchall())
+         return edges
+
+   def GetImporters(self, filepath):
+      """Files importing filepath directly, one indexed query."""
+      with self.GetCursor() as cursor:
+         cursor.execute('''
+            SELECT DISTINCT imports.src FROM modules
+            JOIN imports ON imports.target = modules.module
+            WHERE modules.filepath = ?
+            UNION
+            SELECT DISTINCT imports.src FROM modules
+            JOIN imports ON imports.fallback = modules.module
+            LEFT JOIN modules AS target ON target.module = imports.target
+            WHERE modules.filepath = ? AND target.module IS NULL
+         ''', (filepath, filepath))
+         return [row[0] for row in cursor.fetchall()]
 
 if __name__ == "__main__":
+   # python -m util.db DB REPO [--profile] [--trace-memory]: stats go to
+   # stderr as JSON at the end, and on SIGUSR1 while running
    import sys
+   import logging
+   from . import instrument
    from .sysfs import IterateFiles
    from .sysfs import BuildExclusioinFilter, BuildGitignoreFilter
-   db_filepath = sys.argv[1]
-   repo_filepath = sys.argv[2]
+   logging.basicConfig()
+   args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+   db_filepath = args[0]
+   repo_filepath = args[1]
+   instrument.Enable(
+      slow_threshold=0.5,
+      profile='--profile' in sys.argv,
+      trace_memory='--trace-memory' in sys.argv,
+   )
+   instrument.InstallSignalHandler()
    db = DatabaseManager(db_filepath)
    f1 = BuildExclusioinFilter(['.git'])
    f2 = BuildGitignoreFilter('.gitignore')
    file_list = IterateFiles(repo_filepath, lambda x, y: f1(x, y) or f2(x, y))
-   print(file_list)
    db.UpdateRepository(repo_filepath, file_list)
+   instrument.DumpStats(stats=instrument.Disable().Stats())
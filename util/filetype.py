@@ -0,0 +1,123 @@
+"""
+Classification of the indexed files, before anything decodes them.
+
+A file is TEXT (tokenized, parsed and indexed), GENERATED (text hashed and
+searchable, but not worth parsing: lockfiles, minified code, multi-MB
+generated sources) or BINARY (hashed only). The class comes from the file
+name when its extension says enough, otherwise from the first block of the
+file: NUL bytes or invalid UTF-8 make it binary, its size, the length of
+its lines or a marker in a comment of its first lines generated.
+"""
+import os
+import codecs
+
+from .instrument import Stage, Count
+
+TEXT = "text"
+GENERATED = "generated"
+BINARY = "binary"
+
+# bytes of a file sniffed
+SNIFF_SIZE = 8192
+# larger text files are generated, as are the ones with longer lines;
+# text files from util.sysfs.MMAP_SIZE up to this size are read through mmap
+MAX_TEXT_SIZE = 32 << 20
+MAX_LINE_LENGTH = 1000
+
+# markers of generated files, in a comment of their first _MARKER_LINES
+_GENERATED_MARKERS = (b"@generated", b"DO NOT EDIT")
+_MARKER_LINES = 10
+_COMMENT_PREFIXES = (b"#", b"//", b"/*", b"*", b"--", b";", b"<!--")
+
+# file extension -> class known from it; TEXT is the allowlist of text
+# formats, sniffed for NUL bytes only so a legacy encoding stays text
+extension_classes = {
+   # sources and documents
+   ".py": TEXT, ".pyi": TEXT, ".pyw": TEXT,
+   ".c": TEXT, ".h": TEXT, ".cc": TEXT, ".cpp": TEXT, ".cxx": TEXT,
+   ".hh": TEXT, ".hpp": TEXT, ".hxx": TEXT,
+   ".js": TEXT, ".ts": TEXT, ".java": TEXT, ".go": TEXT, ".rs": TEXT,
+   ".sh": TEXT, ".txt": TEXT, ".md": TEXT, ".rst": TEXT,
+   # images, media, fonts
+   ".png": BINARY, ".gif": BINARY, ".jpg": BINARY, ".jpeg": BINARY,
+   ".ico": BINARY, ".bmp": BINARY, ".webp": BINARY, ".pdf": BINARY,
+   ".mp3": BINARY, ".mp4": BINARY, ".wav": BINARY,
+   ".ttf": BINARY, ".otf": BINARY, ".woff": BINARY, ".woff2": BINARY,
+   # archives and build outputs
+   ".zip": BINARY, ".gz": BINARY, ".bz2": BINARY, ".xz": BINARY,
+   ".tar": BINARY, ".jar": BINARY, ".whl": BINARY,
+   ".a": BINARY, ".o": BINARY, ".so": BINARY, ".dll": BINARY,
+   ".exe": BINARY, ".pyc": BINARY, ".class": BINARY, ".pickle": BINARY,
+   ".sqlite": BINARY, ".db": BINARY,
+   # generated text
+   ".lock": GENERATED, ".map": GENERATED,
+}
+
+# file names and name suffixes of generated files
+generated_names = {
+   "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "Cargo.lock",
+   "poetry.lock", "Pipfile.lock", "Gemfile.lock", "composer.lock", "go.sum",
+}
+generated_suffixes = (".min.js", ".min.css", "_pb2.py", ".pb.go")
+
+
+def ClassifyName(path):
+   """Class of a file known from its name, or None."""
+   name = os.path.basename(path)
+   if name in generated_names or name.endswith(generated_suffixes):
+      return GENERATED
+   return extension_classes.get(os.path.splitext(name)[1].lower(), None)
+
+
+def Classify(path, head, size):
+   """
+   Class of a file.
+
+   Args:
+      head: first bytes of the file, SNIFF_SIZE of them or the whole file
+      size: file size in bytes
+   """
+   known = ClassifyName(path)
+   if known is not None and known != TEXT:
+      return known
+   if b"\0" in head:
+      return BINARY
+   if known is None:
+      # a multi-byte character cut at the end of the block is fine
+      try:
+         codecs.getincrementaldecoder("utf-8")().decode(head, final=size <= len(head))
+      except UnicodeDecodeError:
+         return BINARY
+   if size > MAX_TEXT_SIZE:
+      return GENERATED
+   lines = head.split(b"\n")
+   if len(max(lines, key=len)) > MAX_LINE_LENGTH:
+      return GENERATED
+   for line in lines[:_MARKER_LINES]:
+      line = line.lstrip()
+      if line.startswith(_COMMENT_PREFIXES) and any(marker in line for marker in _GENERATED_MARKERS):
+         return GENERATED
+   return TEXT
+
+
+def ClassifyFile(path, data=None):
+   """
+   Class of a file, sniffing its first block.
+
+   Args:
+      data: content of the file when already read (e.g. for trigrams)
+
+   Raises:
+      OSError: if the file cannot be read
+   """
+   with Stage("classify", path):
+      file_class = ClassifyName(path)
+      if data is not None:
+         file_class = Classify(path, data[:SNIFF_SIZE], len(data))
+      elif file_class is None or file_class == TEXT:
+         with open(path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+            size = os.fstat(f.fileno()).st_size
+         file_class = Classify(path, head, size)
+   Count(f"files_{file_class}")
+   return file_class
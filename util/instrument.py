@@ -0,0 +1,220 @@
+"""
+Instrumentation of the indexing pipeline.
+
+Stages (walk, ignore, stat, hash, classify, read, tokenize, decorate,
+parse through the parse cache, extract, db_write, gc) are timed on the
+monotonic clock with Stage(); Count() adds to named counters. Nothing is
+recorded until Enable(): disabled, Stage() returns one shared no-op
+context manager, a global lookup and a call per use, and the pipeline only
+uses it per file or per transaction.
+
+Enabled, files taking longer than a threshold in one stage are logged,
+cProfile and tracemalloc can run for the whole capture, and Stats() gives
+everything as a JSON-ready dict, also written on SIGUSR1 once
+InstallSignalHandler() ran. Stages run in worker processes (indexers with
+workers > 1) are recorded by the workers themselves, and lost: profile
+with workers=1.
+"""
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# top profile and allocation entries in Stats()
+_TOP = 30
+
+_recorder = None
+
+
+class _NullStage(object):
+   __slots__ = ()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+   __slots__ = ("recorder", "name", "key", "start")
+
+   def __init__(self, recorder, name, key):
+      self.recorder = recorder
+      self.name = name
+      self.key = key
+
+   def __enter__(self):
+      self.start = time.perf_counter()
+      return self
+
+   def __exit__(self, *args):
+      self.recorder.Add(self.name, time.perf_counter() - self.start, self.key)
+      return False
+
+
+class Recorder(object):
+   """
+   Args:
+      slow_threshold: seconds above which a stage of one file is logged
+                      and kept in Stats()["slow"], None for no log
+      profile: run cProfile while enabled
+      trace_memory: run tracemalloc while enabled
+   """
+
+   def __init__(self, slow_threshold=None, profile=False, trace_memory=False):
+      self.slow_threshold = slow_threshold
+      self.start = time.perf_counter()
+      # stage -> [calls, seconds, max seconds]
+      self.stages = {}
+      self.counters = {}
+      self.slow = []
+      # stages are timed by hashing and writer threads too
+      self.lock = threading.Lock()
+      self.profiler = None
+      self.trace_memory = trace_memory
+      if profile:
+         import cProfile
+         self.profiler = cProfile.Profile()
+         self.profiler.enable()
+      if trace_memory:
+         import tracemalloc
+         tracemalloc.start()
+
+   def Add(self, name, seconds, key=None):
+      with self.lock:
+         stage = self.stages.get(name, None)
+         if stage is None:
+            stage = self.stages[name] = [0, 0.0, 0.0]
+         stage[0] += 1
+         stage[1] += seconds
+         if seconds > stage[2]:
+            stage[2] = seconds
+      if self.slow_threshold is not None and key is not None and seconds >= self.slow_threshold:
+         self.slow.append((name, key, seconds))
+         logger.warning("slow %s: %s %.3fs", name, key, seconds)
+
+   def Count(self, name, n=1):
+      with self.lock:
+         self.counters[name] = self.counters.get(name, 0) + n
+
+   def Stop(self):
+      if self.profiler is not None:
+         self.profiler.disable()
+      if self.trace_memory:
+         import tracemalloc
+         self.memory = self._Memory()
+         tracemalloc.stop()
+         self.trace_memory = False
+
+   def _Profile(self):
+      import pstats
+      stats = pstats.Stats(self.profiler)
+      rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:_TOP]
+      return [
+         {
+            "function": f"{filename}:{line}({name})",
+            "calls": nc,
+            "self": round(tt, 6),
+            "cumulative": round(ct, 6),
+         }
+         for (filename, line, name), (_, nc, tt, ct, _) in rows
+      ]
+
+   def _Memory(self):
+      import tracemalloc
+      current, peak = tracemalloc.get_traced_memory()
+      top = tracemalloc.take_snapshot().statistics('lineno')[:_TOP]
+      return {
+         "current": current,
+         "peak": peak,
+         "top": [{"line": str(s.traceback), "size": s.size, "count": s.count} for s in top],
+      }
+
+   def Stats(self):
+      out = {
+         "elapsed": round(time.perf_counter() - self.start, 6),
+         "stages": {
+            name: {"calls": calls, "seconds": round(seconds, 6), "max": round(longest, 6)}
+            for name, (calls, seconds, longest) in sorted(self.stages.items())
+         },
+         "counters": dict(sorted(self.counters.items())),
+         "slow": [
+            {"stage": name, "key": str(key), "seconds": round(seconds, 6)}
+            for name, key, seconds in sorted(self.slow, key=lambda x: -x[2])
+         ],
+      }
+      if self.profiler is not None:
+         out["profile"] = self._Profile()
+      if self.trace_memory:
+         out["memory"] = self._Memory()
+      elif hasattr(self, "memory"):
+         out["memory"] = self.memory
+      return out
+
+
+def Enable(slow_threshold=None, profile=False, trace_memory=False):
+   """Start recording (see Recorder); returns the recorder."""
+   global _recorder
+   Disable()
+   _recorder = Recorder(slow_threshold, profile, trace_memory)
+   return _recorder
+
+
+def Disable():
+   """Stop recording; returns the recorder that was active, or None."""
+   global _recorder
+   recorder = _recorder
+   _recorder = None
+   if recorder is not None:
+      recorder.Stop()
+   return recorder
+
+
+def Enabled():
+   return _recorder is not None
+
+
+def Stage(name, key=None):
+   """
+   Context manager timing one stage; key (a file path) names the slow
+   ones in the log.
+   """
+   recorder = _recorder
+   if recorder is None:
+      return _NULL_STAGE
+   return _Stage(recorder, name, key)
+
+
+def Count(name, n=1):
+   recorder = _recorder
+   if recorder is not None:
+      recorder.Count(name, n)
+
+
+def Stats():
+   """Stats of the active recorder, or None."""
+   recorder = _recorder
+   return None if recorder is None else recorder.Stats()
+
+
+def DumpStats(stream=None, stats=None):
+   """Write stats (by default the active recorder's) as one JSON line."""
+   stats = stats if stats is not None else Stats()
+   if stats is None:
+      return
+   stream = stream or sys.stderr
+   stream.write(json.dumps(stats) + "\n")
+   stream.flush()
+
+
+def InstallSignalHandler(signum=signal.SIGUSR1, stream=None):
+   """Dump the stats to stream (stderr) whenever signum is received."""
+   signal.signal(signum, lambda *_: DumpStats(stream))
@@ -0,0 +1,419 @@
+"""
+Index sharded by content hash across several SQLite files.
+
+Files are partitioned by the prefix of their content hash, so each shard
+is a complete DatabaseManager index of the files it owns and identical
+contents always land in the same shard. Indexing writes the shards in
+parallel, one writer thread per shard file (SQLite releases the GIL while
+it works), and queries run on every shard and merge their ordered rows.
+
+File hash ids handed out by ShardedDatabase are global: hid * count +
+shard, so the indexers (token.postings.IndexPostings, IndexClones,
+IndexScopes, and the per file IndexSymbols, IndexCalls and IndexImports)
+drive it like a single DatabaseManager, their results going to the shard
+of each content. The module table is kept whole in every shard, so the
+import edges of a shard resolve against all modules. Clone pairs are
+joined across shards by merging the fingerprint lists of the shards in
+fingerprint order.
+"""
+import os
+import heapq
+import threading
+from functools import partial
+from itertools import groupby
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import DatabaseManager
+from .sysfs import CalculateFileHash
+
+
+def ShardPath(db_path, shard, count):
+   """SQLite file of one shard of an index at db_path."""
+   base, ext = os.path.splitext(db_path)
+   return f"{base}.{shard}-of-{count}{ext or '.db'}"
+
+
+def ShardOf(filehash, count):
+   """Shard of a content by its hex hash prefix."""
+   return int(filehash[:8], 16) % count
+
+
+class ShardedDatabase(object):
+   """
+   Args:
+      db_path: path the shard files are named after (see ShardPath)
+      count: number of shards; an index must be reopened with the same
+   """
+
+   def __init__(self, db_path, count=4):
+      self.db_path = db_path
+      self.count = count
+      self.shards = [DatabaseManager(ShardPath(db_path, i, count)) for i in range(count)]
+      # shard writers, and query fan-out apart so updates do not hold it
+      self._executor = ThreadPoolExecutor(max_workers=count)
+      self._query_executor = ThreadPoolExecutor(max_workers=count)
+      for shard in self.shards:
+         shard._CreateTables()
+
+   def close(self):
+      self._executor.shutdown()
+      self._query_executor.shutdown()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def _FanOut(self, name, *args):
+      # results of a DatabaseManager method on every shard, in shard order
+      futures = [self._query_executor.submit(getattr(shard, name), *args) for shard in self.shards]
+      return [future.result() for future in futures]
+
+   def _Each(self, name, parts):
+      # results of a DatabaseManager method on every shard with its part
+      futures = [self._query_executor.submit(getattr(shard, name), parts[i]) for i, shard in enumerate(self.shards)]
+      return [future.result() for future in futures]
+
+   def _Merge(self, name, key, *args):
+      # rows of a method sorted by key on every shard, merged in that order
+      return list(heapq.merge(*self._FanOut(name, *args), key=key))
+
+   def _Global(self, shard, hid):
+      return hid * self.count + shard
+
+   def _Local(self, hid):
+      # (shard, hid in the shard) of a global hid
+      return hid % self.count, hid // self.count
+
+   def _LocalIds(self, pairs):
+      # local ids per shard of the global ids in pairs
+      parts = [set() for _ in self.shards]
+      for pair in pairs:
+         for x in pair:
+            shard, x = self._Local(x)
+            parts[shard].add(x)
+      return [sorted(part) for part in parts]
+
+   def _Split(self, entries, k):
+      # entries per shard, by the global hid at entry[k], made local; an
+      # entry with hid None goes to every shard
+      parts = [[] for _ in self.shards]
+      for entry in entries:
+         if entry[k] is None:
+            for part in parts:
+               part.append(entry)
+            continue
+         shard, hid = self._Local(entry[k])
+         parts[shard].append(entry[:k] + (hid,) + entry[k+1:])
+      return parts
+
+   def _Write(self, name, parts):
+      # a DatabaseManager update method on every shard with its part, each
+      # shard in its writer thread
+      futures = [
+         self._executor.submit(getattr(shard, name), parts[i])
+         for i, shard in enumerate(self.shards)
+      ]
+      for future in futures:
+         future.result()
+
+   def _GlobalSet(self, name):
+      # global hids of a DatabaseManager method returning a set of hids
+      return {
+         self._Global(shard, hid)
+         for shard, hids in enumerate(self._FanOut(name))
+         for hid in hids
+      }
+
+   def _GlobalDict(self, name):
+      # filepath -> global hid of a DatabaseManager method
+      out = {}
+      for shard, hashes in enumerate(self._FanOut(name)):
+         out.update((filepath, self._Global(shard, hid)) for filepath, hid in hashes.items())
+      return out
+
+   def UpdateRepository(self, root_path, file_list, trigrams=False, workers=None, progress=None):
+      """
+      DatabaseManager.UpdateRepository over the shards: files whose stored
+      record is older than the file are hashed (by a thread pool) to route
+      them, then every shard updates its part in parallel.
+
+      Args:
+         progress: called with (files done, files) over all shards, from
+                   the shard writer threads
+      """
+      records = {}
+      for shard, shard_records in enumerate(self._FanOut("GetFileRecords")):
+         for filepath, (ts, filehash) in shard_records.items():
+            records[filepath] = (ts, filehash, shard)
+
+      def _Route(filepath):
+         # (shard, hash computed here or None)
+         full_path = os.path.join(root_path, filepath)
+         record = records.get(filepath, None)
+         try:
+            mtime = datetime.fromtimestamp(os.path.getmtime(full_path))
+            if record is not None and record[0] and datetime.fromisoformat(record[0]) >= mtime:
+               return record[2], None
+            filehash = CalculateFileHash(full_path)
+         except OSError:
+            return None, None
+         return ShardOf(filehash, self.count), filehash
+
+      file_list = list(file_list)
+      parts = [[] for _ in self.shards]
+      hashes = [{} for _ in self.shards]
+      with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+         for filepath, (shard, filehash) in zip(file_list, executor.map(_Route, file_list)):
+            if shard is None:
+               continue
+            parts[shard].append(filepath)
+            if filehash is not None:
+               hashes[shard][filepath] = filehash
+      callbacks = [None] * self.count
+      if progress is not None:
+         lock = threading.Lock()
+         counts = [0] * self.count
+         total = sum(len(part) for part in parts)
+         def _Callback(shard, done, _):
+            with lock:
+               counts[shard] = done
+               progress(sum(counts), total)
+         callbacks = [partial(_Callback, i) for i in range(self.count)]
+      futures = [
+         self._executor.submit(shard.UpdateRepository, root_path, parts[i], trigrams, hashes[i], callbacks[i])
+         for i, shard in enumerate(self.shards)
+      ]
+      for future in futures:
+         future.result()
+
+   def GetFileHashes(self, file_class=None):
+      """filepath -> global hid of the indexed files."""
+      out = {}
+      for shard, hashes in enumerate(self._FanOut("GetFileHashes", file_class)):
+         out.update((filepath, self._Global(shard, hid)) for filepath, hid in hashes.items())
+      return out
+
+   def GetContentPaths(self, root_path=None, file_class=None):
+      """global hid -> full path of one file holding the content."""
+      out = {}
+      for shard, paths in enumerate(self._FanOut("GetContentPaths", root_path, file_class)):
+         out.update((self._Global(shard, hid), path) for hid, path in paths.items())
+      return out
+
+   def GetRootPath(self):
+      return next((root for root in self._FanOut("GetRootPath") if root is not None), None)
+
+   def GetPostingHashes(self):
+      return self._GlobalSet("GetPostingHashes")
+
+   def UpdatePostings(self, entries):
+      """DatabaseManager.UpdatePostings, each shard writing its entries."""
+      self._Write("UpdatePostings", self._Split(entries, 0))
+
+   def GetTokenHashes(self):
+      return self._GlobalSet("GetTokenHashes")
+
+   def UpdateFileTokens(self, hid, arena):
+      shard, hid = self._Local(hid)
+      self._executor.submit(self.shards[shard].UpdateFileTokens, hid, arena).result()
+
+   def GetTokenReplacements(self):
+      # a file and the content replaced in it are in one shard
+      return {
+         self._Global(shard, hid): self._Global(shard, old_hid)
+         for shard, replaced in enumerate(self._FanOut("GetTokenReplacements"))
+         for hid, old_hid in replaced.items()
+      }
+
+   def GetFileArena(self, hid):
+      shard, hid = self._Local(hid)
+      return self.shards[shard].GetFileArena(hid)
+
+   def UpdateFileTokensDelta(self, old_hid, new_hid, old_arena, new_arena, reuse):
+      shard, old_hid = self._Local(old_hid)
+      new_hid = self._Local(new_hid)[1]
+      return self._executor.submit(
+         self.shards[shard].UpdateFileTokensDelta, old_hid, new_hid, old_arena, new_arena, reuse,
+      ).result()
+
+   def GetIdentifiers(self):
+      """name -> iid of the identifier names of all shards; an iid is the one of a shard."""
+      out = {}
+      for identifiers in reversed(self._FanOut("GetIdentifiers")):
+         out.update(identifiers)
+      return out
+
+   def GetPostings(self, names, match_all=False):
+      return self._Merge("GetPostings", lambda row: row[:3], names, match_all)
+
+   def GetTrigramCandidates(self, groups):
+      return self._Merge("GetTrigramCandidates", lambda row: (row[0], row[2]), groups)
+
+   def UpdateSymbols(self, filepath, symbols):
+      # only the shard holding filepath has a record for it
+      symbols = list(symbols)
+      self._FanOut("UpdateSymbols", filepath, symbols)
+
+   def GetSymbolSources(self):
+      return self._GlobalDict("GetSymbolSources")
+
+   def UpdateFileSymbols(self, entries):
+      self._Write("UpdateFileSymbols", self._Split(entries, 1))
+
+   def GetSymbolTable(self):
+      """DatabaseManager.GetSymbolTable of all shards, sids made global."""
+      rows = []
+      bases = []
+      for shard, (shard_rows, shard_bases) in enumerate(self._FanOut("GetSymbolTable")):
+         rows.append([(self._Global(shard, row[0]),) + row[1:] for row in shard_rows])
+         bases.extend((self._Global(shard, sid), base) for sid, base in shard_bases)
+      return list(heapq.merge(*rows, key=lambda row: (row[1], row[4]))), bases
+
+   def UpdateCalls(self, filepath, calls):
+      calls = list(calls)
+      self._FanOut("UpdateCalls", filepath, calls)
+
+   def GetCallSources(self):
+      return self._GlobalDict("GetCallSources")
+
+   def UpdateFileCalls(self, entries):
+      self._Write("UpdateFileCalls", self._Split(entries, 1))
+
+   def GetCallTargets(self):
+      return list({row for rows in self._FanOut("GetCallTargets") for row in rows})
+
+   def UpdateCallTargets(self, targets):
+      # a local target may be in every shard
+      self._Write("UpdateCallTargets", [list(targets)] * self.count)
+
+   def GetScopeHashes(self):
+      return self._GlobalSet("GetScopeHashes")
+
+   def UpdateScopeIndexes(self, entries):
+      self._Write("UpdateScopeIndexes", self._Split(entries, 0))
+
+   def GetScopeIndex(self, filepath):
+      return next((buf for buf in self._FanOut("GetScopeIndex", filepath) if buf is not None), None)
+
+   def UpdateModules(self, modules):
+      """The whole module table goes to every shard."""
+      self._Write("UpdateModules", [modules] * self.count)
+
+   def GetModules(self):
+      return self.shards[0].GetModules()
+
+   def GetImportSources(self):
+      return self._GlobalDict("GetImportSources")
+
+   def UpdateImports(self, entries, removed=()):
+      """
+      DatabaseManager.UpdateImports, each shard writing its entries; the
+      edges of a removed file, or of one whose content moved it to another
+      shard, are dropped from the other shards (they are kept by path).
+      """
+      parts = self._Split(entries, 1)
+      removed = list(removed)
+      futures = [
+         self._executor.submit(shard.UpdateImports, parts[i], removed + [
+            entry[0] for j, part in enumerate(parts) if j != i for entry in part
+         ])
+         for i, shard in enumerate(self.shards)
+      ]
+      for future in futures:
+         future.result()
+
+   def GetImportTargets(self):
+      return [row for rows in self._FanOut("GetImportTargets") for row in rows]
+
+   def GetImportEdges(self, srcs=None):
+      srcs = None if srcs is None else list(srcs)
+      return [edge for edges in self._FanOut("GetImportEdges", srcs) for edge in edges]
+
+   def GetImporters(self, filepath):
+      return sorted({src for srcs in self._FanOut("GetImporters", filepath) for src in srcs})
+
+   def GetCloneHashes(self):
+      return self._GlobalSet("GetCloneHashes")
+
+   def UpdateCloneUnits(self, entries):
+      self._Write("UpdateCloneUnits", self._Split(entries, 0))
+
+   def _CloneFingerprints(self, shard):
+      for fp, uid in self.shards[shard].IterCloneFingerprints():
+         yield fp, self._Global(shard, uid)
+
+   def GetClonePairs(self, min_similarity, max_frequency):
+      """
+      DatabaseManager.GetClonePairs across the shards: the fingerprints of
+      every shard are merged in fingerprint order and the units sharing
+      each one counted by pair, uids being made global as hids are.
+      """
+      streams = [self._CloneFingerprints(shard) for shard in range(self.count)]
+      shared = {}
+      for _, group in groupby(heapq.merge(*streams), key=lambda row: row[0]):
+         uids = [uid for _, uid in group]
+         if not 2 <= len(uids) <= max_frequency:
+            continue
+         uids.sort()
+         for i, a in enumerate(uids):
+            for b in uids[i+1:]:
+               shared[(a, b)] = shared.get((a, b), 0) + 1
+      units = {}
+      for shard, shard_units in enumerate(self._Each("GetCloneUnits", self._LocalIds(shared))):
+         for uid, (hid, name, L, size) in shard_units.items():
+            units[self._Global(shard, uid)] = (self._Global(shard, hid), name, L, size)
+      pairs = []
+      for (a, b), n in shared.items():
+         hid_a, name_a, L_a, size_a = units[a]
+         hid_b, name_b, L_b, size_b = units[b]
+         if (name_a == '') != (name_b == ''):
+            continue
+         # a def holds the fingerprints of the defs nested in it
+         if hid_a == hid_b and (name_b.startswith(name_a + '.') or name_a.startswith(name_b + '.')):
+            continue
+         similarity = n / (size_a + size_b - n)
+         if similarity >= min_similarity:
+            pairs.append((hid_a, name_a, L_a, hid_b, name_b, L_b, similarity))
+      locations = {}
+      hids = self._LocalIds((row[0], row[3]) for row in pairs)
+      for shard, shard_locations in enumerate(self._Each("GetContentLocations", hids)):
+         locations.update((self._Global(shard, hid), found[0]) for hid, found in shard_locations.items())
+      pairs.sort(key=lambda row: row[6], reverse=True)
+      return [
+         locations.get(hid_a, (None, None)) + (name_a, L_a) + locations.get(hid_b, (None, None)) + (name_b, L_b, similarity)
+         for hid_a, name_a, L_a, hid_b, name_b, L_b, similarity in pairs
+      ]
+
+   def FindSymbol(self, qualname):
+      return self._Merge("FindSymbol", _SymbolKey, qualname)
+
+   def FindSymbolsByName(self, name):
+      return self._Merge("FindSymbolsByName", _SymbolKey, name)
+
+   def ListMembers(self, qualname):
+      return self._Merge("ListMembers", _SymbolKey, qualname)
+
+   def FindSubclasses(self, base):
+      return self._Merge("FindSubclasses", _SymbolKey, base)
+
+   def FindCallers(self, qualname):
+      return self._Merge("FindCallers", _CallKey, qualname)
+
+   def FindCallees(self, qualname):
+      return self._Merge("FindCallees", _CallKey, qualname)
+
+   def FindUnresolvedCalls(self, name):
+      return self._Merge("FindUnresolvedCalls", _CallKey, name)
+
+
+def _SymbolKey(row):
+   # ORDER BY of DatabaseManager._QuerySymbols
+   return row[0], row[3]
+
+
+def _CallKey(row):
+   # ORDER BY of DatabaseManager._QueryCalls
+   return row[0], row[4], row[5]
@@ -1,8 +1,12 @@
+import io
 import os
+import mmap
+import codecs
 import hashlib
 from typing import List
 
 from .sysfs_ignorepattern import IsPathIgnored, ParseIgnoreFile
+from .instrument import Stage, Count
 
 def BuildExclusioinFilter(exclusions: List[str] = None):
    exclusion_set = set(exclusions or [])
@@ -16,18 +20,21 @@ def BuildGitignoreFilter(gitignore_file_path):
       return IsPathIgnored(file_path, patterns)
    return filter
 
-def IterateFiles(root_path: str, exclusion_filter) -> List[str]:
+def IterateFiles(root_path: str, exclusion_filter, file_list=None) -> List[str]:
    """
    Iterate through all files in a directory tree, excluding specified directories.
 
    Args:
       root_path: The root directory to start iteration from
       exclusion_filter: filter function to exclude fn(name, path) (e.g., ['.git', '.svn'])
+      file_list: list the paths are appended to, e.g. a util.budget.SpillList
+                 keeping a large walk within a memory budget
 
    Returns:
       List of file paths relative to the root_path
    """
-   file_list = []
+   if file_list is None:
+      file_list = []
 
    # Normalize the root path
    try:
@@ -39,6 +46,13 @@ def IterateFiles(root_path: str, exclusion_filter) -> List[str]:
    # Check if root path exists and is accessible
    if not os.path.exists(root_path) or not os.access(root_path, os.R_OK):
       return file_list
+   with Stage("walk", root_path):
+      _Walk(root_path, exclusion_filter, file_list)
+   Count("files_walked", len(file_list))
+   return file_list
+
+
+def _Walk(root_path, exclusion_filter, file_list):
    for dirpath, dirnames, filenames in os.walk(root_path):
       # Remove excluded directories from dirnames to prevent os.walk from traversing them
       dirnames[:] = [d for d in dirnames]
@@ -49,10 +63,11 @@ def IterateFiles(root_path: str, exclusion_filter) -> List[str]:
          full_dir_path = os.path.join(dirpath, dirname)
          try:
             # Check if we have read and execute permissions for the directory
-            if (
-               (not os.access(full_dir_path, os.R_OK | os.X_OK)) or
-               exclusion_filter(dirname, full_dir_path)
-            ):
+            if not os.access(full_dir_path, os.R_OK | os.X_OK):
+               continue
+            with Stage("ignore"):
+               excluded = exclusion_filter(dirname, full_dir_path)
+            if excluded:
                continue
             accessible_dirs.append(dirname)
          except Exception:
@@ -65,10 +80,11 @@ def IterateFiles(root_path: str, exclusion_filter) -> List[str]:
             full_path = os.path.join(dirpath, filename)
 
             # Check if we can access the file
-            if (
-               not os.access(full_path, os.R_OK) or
-               exclusion_filter(filename, full_path)
-            ):
+            if not os.access(full_path, os.R_OK):
+               continue
+            with Stage("ignore"):
+               excluded = exclusion_filter(filename, full_path)
+            if excluded:
                continue
 
             # Get relative path from root
@@ -78,7 +94,6 @@ def IterateFiles(root_path: str, exclusion_filter) -> List[str]:
          except Exception:
             # Skip any files that cause errors (permission issues, broken symlinks, etc.)
             continue 
-   return file_list
 
 
 # Map algorithm names to hashlib functions
@@ -119,3 +134,53 @@ def CalculateFileHash(filepath: str, algorithm: str = 'sha256') -> str:
          hash_obj.update(chunk)
 
    return hash_obj.hexdigest()
+
+
+def ReadFileWithHash(filepath: str, algorithm: str = 'sha256'):
+   """
+   Read a file and hash it in one pass, for indexers needing the content
+   too (see CalculateFileHash).
+
+   Returns:
+      (hexadecimal hash, file bytes)
+   """
+   if algorithm not in HASH_ALGORITHM:
+      raise ValueError(f"Unsupported algorithm: {algorithm}. Supported: {list(HASH_ALGORITHM.keys())}")
+
+   if not os.path.isfile(filepath):
+      raise FileNotFoundError(f"File not found: {filepath}")
+
+   with open(filepath, 'rb') as f:
+      data = f.read()
+   return HASH_ALGORITHM[algorithm](data).hexdigest(), data
+
+
+# text files from this size are read through mmap
+MMAP_SIZE = 1 << 20
+# bytes decoded at a time from a mapped file
+_DECODE_CHUNK = 1 << 20
+
+
+def ReadText(filepath: str, encoding: str = 'utf-8') -> str:
+   """
+   Read a text file as open(filepath, 'r').read() does (newlines
+   translated); large files are mapped and decoded incrementally, so their
+   bytes are never copied into memory whole.
+
+   Raises:
+      OSError, UnicodeDecodeError
+   """
+   with open(filepath, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size < MMAP_SIZE:
+         text = f.read().decode(encoding)
+         if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+         return text
+      decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+      parts = []
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+         for i in range(0, len(m), _DECODE_CHUNK):
+            parts.append(decoder.decode(m[i:i + _DECODE_CHUNK]))
+      parts.append(decoder.decode(b'', final=True))
+      return ''.join(parts)
@@ -0,0 +1,170 @@
+"""
+Trigram index for substring and regex search.
+
+Each file content (file hash) is indexed by the set of byte trigrams it
+holds. A query is turned into trigrams every matching file must contain:
+a literal gives its own, a regex the literal runs it requires (an AND of
+ORs for alternations). Intersecting the posting lists of those trigrams
+leaves the candidate files, and only those are read, through mmap, to
+verify the match line by line with the str pattern.
+"""
+import os
+import re
+import mmap
+import zlib
+from array import array
+
+try:
+   from re import _parser as sre_parse
+except ImportError:
+   import sre_parse
+
+# possessive repeats and atomic groups are python 3.11+
+_REPEATS = tuple(
+   op for op in (
+      sre_parse.MAX_REPEAT,
+      sre_parse.MIN_REPEAT,
+      getattr(sre_parse, "POSSESSIVE_REPEAT", None),
+   )
+   if op is not None
+)
+_ATOMIC_GROUP = getattr(sre_parse, "ATOMIC_GROUP", None)
+
+# files above this size, and binary files, are not indexed: every search
+# verifies them
+MAX_INDEXED_SIZE = 1 << 20
+
+
+def Trigrams(data: bytes):
+   """
+   Sorted distinct trigram ids (b0 << 16 | b1 << 8 | b2) of a content, or
+   None if it is not indexed (too large or binary).
+   """
+   if len(data) > MAX_INDEXED_SIZE or b'\0' in data:
+      return None
+   return sorted(a << 16 | b << 8 | c for a, b, c in set(zip(data, data[1:], data[2:])))
+
+
+def PackTrigrams(trigrams) -> bytes:
+   return zlib.compress(array('i', trigrams).tobytes(), 1)
+
+
+def UnpackTrigrams(buf):
+   trigrams = array('i')
+   trigrams.frombytes(zlib.decompress(buf))
+   return trigrams
+
+
+def LiteralTrigrams(literal: bytes):
+   return sorted({a << 16 | b << 8 | c for a, b, c in zip(literal, literal[1:], literal[2:])})
+
+
+def _Literals(items):
+   # AND of OR groups of literals (bytes) that any match of the parsed
+   # regex items contains; runs shorter than a trigram add nothing
+   groups = []
+   run = []
+   def _Flush():
+      if len(run) >= 3:
+         groups.append([bytes(run)])
+      del run[:]
+
+   for op, arg in items:
+      if op is sre_parse.LITERAL:
+         run.extend(chr(arg).encode('utf-8'))
+         continue
+      _Flush()
+      if op is sre_parse.SUBPATTERN:
+         groups.extend(_Literals(arg[-1]))
+      elif op in _REPEATS:
+         if arg[0] >= 1:
+            groups.extend(_Literals(arg[2]))
+      elif op is _ATOMIC_GROUP:
+         groups.extend(_Literals(arg))
+      elif op is sre_parse.BRANCH:
+         # one literal per branch: the longest one it requires
+         alternatives = []
+         for branch in arg[1]:
+            best = max((x for group in _Literals(branch) if len(group) == 1 for x in group), key=len, default=None)
+            if best is None:
+               alternatives = None
+               break
+            alternatives.append(best)
+         if alternatives:
+            groups.append(alternatives)
+   _Flush()
+   return groups
+
+
+def RegexLiterals(pattern, flags=0):
+   """
+   Literal groups a match of a regex must contain: every group has one of
+   its literals. [] when nothing can be required (e.g. IGNORECASE).
+   """
+   parsed = sre_parse.parse(pattern, flags)
+   if (flags | parsed.state.flags) & re.IGNORECASE:
+      return []
+   return _Literals(parsed)
+
+
+def _LineMatches(f, regex, limit):
+   # (line number, line) of the matches in a file, read through mmap; every
+   # line is decoded (undecodable bytes as surrogates) and matched as str
+   try:
+      size = os.fstat(f.fileno()).st_size
+      if size == 0:
+         return []
+      view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+   except (OSError, ValueError):
+      return []
+   out = []
+   try:
+      L = 0
+      raw = view.readline()
+      while raw:
+         line = raw.rstrip(b'\n').decode('utf-8', 'surrogateescape')
+         count = sum(1 for _ in regex.finditer(line))
+         if count:
+            shown = line.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+            for _ in range(count):
+               out.append((L, shown))
+               if limit is not None and len(out) >= limit:
+                  return out
+         L += 1
+         raw = view.readline()
+   finally:
+      view.close()
+   return out
+
+
+def Search(db, pattern, literal=False, flags=0, limit=None):
+   """
+   Search the indexed files of a DatabaseManager (updated with
+   trigrams=True), those of UpdateRepository and of UpdateRepositories,
+   for a regex or a literal string.
+
+   Args:
+      limit: maximal matches per file, None for all
+
+   Returns:
+      list: (repository, filepath, line number, line) of every match;
+            repository is "" for the files of UpdateRepository
+   """
+   if literal:
+      groups = [[pattern.encode('utf-8')]] if len(pattern.encode('utf-8')) >= 3 else []
+      pattern = re.escape(pattern)
+   else:
+      groups = RegexLiterals(pattern, flags)
+   regex = re.compile(pattern, flags)
+   candidates = db.GetTrigramCandidates([
+      [LiteralTrigrams(x) for x in group] for group in groups
+   ])
+   out = []
+   for repository, root_path, filepath in candidates:
+      try:
+         with open(os.path.join(root_path or '', filepath), 'rb') as f:
+            matches = _LineMatches(f, regex, limit)
+      except OSError:
+         continue
+      out.extend((repository, filepath, L, line) for L, line in matches)
+   return out